@@ -3,8 +3,12 @@ from decimal import Decimal
 import datetime
 import os
 import logging
+import threading
+import weakref
+import cachetools
 from lib.application_base import ApplicationBase
 from lib.comms.mailer import Mailer, MailerMock
+from lib.comms.email_outbox import EmailOutbox
 from lib.rep_sys.email_auth import EmailAuthenticator
 from lib.rep_sys.rep_id import RepSysUserId
 
@@ -30,6 +34,14 @@ from .exchange import Exchange
 from .data import Match, Order, User, OrderType
 from .currency_rates import CurrencyConverter, CurrencyFreaksClient, CurrencyMockClient
 from .lazy_load import LazyMessageLoader
+from .outbound import OutboundDispatcher
+from .pipeline import KeyedPipeline
+from .session_store import SessionStore
+from .config import (
+    SESSIONS_CAPACITY,
+    SESSION_IDLE_TTL_SEC,
+    EMAIL_AUTHENTICATORS_CACHE_SIZE,
+)
 from .rep_sys import ReputationSystem
 
 
@@ -42,16 +54,28 @@ class Application(ApplicationBase):
         rep_sys: ReputationSystem,
         mailer: Mailer,
         admin_contacts: Optional[list[int]] = None,
+        snapshot_path: Optional[str] = None,
+        pipeline: Optional[KeyedPipeline] = None,
+        dispatcher: Optional[OutboundDispatcher] = None,
     ):
+        """
+        Args:
+            pipeline: if set, the incoming messages are processed on it, the users
+                concurrently, and the answers are sent when ready. Otherwise they are
+                processed one by one and returned to tg.
+            dispatcher: if set, the messages not returned to tg (answers processed
+                on the pipeline, match notifications) are sent through it.
+        """
         self._admin_contacts = admin_contacts
         self._db = db
         self._tg = tg
         self._tg.on_message = self._on_incoming_tg_message
         self._rep_sys = rep_sys
         self._mailer = mailer
-
-        # FIXME: should be (1) persistent, (2) LRU with limit, (3) created only when really needed
-        self._sessions: dict[int, dialogs.Main] = {}
+        self._pipeline = pipeline
+        self._outgoing: Tg | OutboundDispatcher = (
+            dispatcher if dispatcher is not None else tg
+        )
 
         # FIXME: move it out of here
         self.disclaimer_message_loader = LazyMessageLoader(
@@ -64,12 +88,59 @@ class Application(ApplicationBase):
         )
 
         currency_converter = CurrencyConverter(currency_client)
-        self._ex = Exchange(self._db, currency_converter, self._on_match)
+        self._ex = Exchange(
+            self._db, currency_converter, self._on_match, snapshot_path=snapshot_path
+        )
+        self._ex.schedule_expiry_check()
+        if snapshot_path:
+            self._ex.schedule_snapshot()
+        self._email_outbox = EmailOutbox(self._mailer, self._db.engine)
+        self._email_outbox.resume_pending()
+        self._sessions = SessionStore(
+            self._db.engine,
+            {
+                "app": self,
+                "exchange": self._ex,
+                "rep_sys": self._rep_sys,
+                "mailer": self._mailer,
+                "email_outbox": self._email_outbox,
+                "db_engine": self._db.engine,
+            },
+            capacity=SESSIONS_CAPACITY,
+            idle_ttl_sec=SESSION_IDLE_TTL_SEC,
+        )
+        # by the user's id, see get_email_authenticator(): the recently used ones and
+        # all the ones still referenced, by the dialog sessions in particular
+        self._email_authenticators: cachetools.LRUCache[
+            tuple[int | None, str | None], EmailAuthenticator
+        ] = cachetools.LRUCache(maxsize=EMAIL_AUTHENTICATORS_CACHE_SIZE)
+        self._live_email_authenticators: weakref.WeakValueDictionary[
+            tuple[int | None, str | None], EmailAuthenticator
+        ] = weakref.WeakValueDictionary()
+        self._email_authenticators_lock = threading.Lock()
         self._validator = business_rules.Validator()
 
+    def close(self):
+        """Save the sessions and stop the exchange, the DB is left to the owner"""
+        self._sessions.save_all()
+        self._ex.close()
+
     def get_email_authenticator(self, uid: RepSysUserId) -> EmailAuthenticator:
+        """
+        The same authenticator while the user's id stays the same, as long as it's
+        referenced: one evicted from the cache but held by a session is reused.
+        """
         ruid = self._rep_sys.enrich_user_id(uid)
-        return EmailAuthenticator(ruid, self._mailer, self._db.engine)
+        key = (ruid.telegram_user_id, ruid.email_hash)
+        with self._email_authenticators_lock:
+            au = self._live_email_authenticators.get(key)
+            if au is None:
+                au = EmailAuthenticator(
+                    ruid, self._mailer, self._db.engine, outbox=self._email_outbox
+                )
+                self._live_email_authenticators[key] = au
+            self._email_authenticators[key] = au
+            return au
 
     def _send_message(
         self,
@@ -96,20 +167,18 @@ class Application(ApplicationBase):
             parse_mode=parse_mode,
             inline_keyboard=keyboard,
         )
-        self._tg.send_message(m)
+        self._outgoing.send_message(m)
 
     def _process_incoming_tg_message(self, m: TgIncomingMsg) -> list[TgOutgoingMsg]:
         if m.user_id < 0:
             raise ValueError("We don't work with groups yet")
 
-        try:
-            _root = self._sessions[m.user_id]
-        except KeyError:
+        _root = self._sessions.get(m.user_id)
+        if _root is None:
             session = dialogs.Session(
                 m.user_id, m.user_name, self, self._ex, rep_sys=self._rep_sys
             )
             _root = dialogs.Main(session)
-            self._sessions[m.user_id] = _root
 
         top = _root.get_current_active()
         out: OutMessage | None
@@ -138,6 +207,8 @@ class Application(ApplicationBase):
 
         logging.info(f"Event: {event}; top: {top}")
         out = top.process_event(event)
+        # (re)stored after the event: it may have been evicted while being processed
+        self._sessions.put(m.user_id, _root)
         assert out is not None
 
         tg_out_messages: list[TgOutgoingMsg] = []
@@ -168,6 +239,17 @@ class Application(ApplicationBase):
 
     def _on_incoming_tg_message(self, m: TgIncomingMsg) -> list[TgOutgoingMsg]:
         logging.info(f"Got message: {m}")
+        if self._pipeline is None:
+            return self._handle_incoming_tg_message(m)
+        # keyed by user, so the user's messages are still processed in order
+        self._pipeline.submit(m.user_id, self._answer_incoming_tg_message, m)
+        return []
+
+    def _answer_incoming_tg_message(self, m: TgIncomingMsg):
+        for out in self._handle_incoming_tg_message(m):
+            self._outgoing.send_message(out)
+
+    def _handle_incoming_tg_message(self, m: TgIncomingMsg) -> list[TgOutgoingMsg]:
         try:
             res = self._process_incoming_tg_message(m)
         except ValueError as e:
@@ -198,9 +280,9 @@ class Application(ApplicationBase):
         self._ex.place_order(o)
 
     def _handle_remove_command(self, m: TgIncomingMsg, params: list):
-        self._validator.validate_remove_command_params(params, self._ex, m.user_id)
+        self._validator.validate_remove_command_params(params)
         remove_order_id = int(params[0])
-        self._ex.remove_order(remove_order_id)
+        self._ex.remove_user_order(User(m.user_id), remove_order_id)
         self._send_message(
             m.user_id, m.user_name, f"Order with id {remove_order_id} was removed"
         )
@@ -226,8 +308,10 @@ class Application(ApplicationBase):
             f" {m.amount:.2f} RUB, вы получите {m.price * m.amount:.2f} AMD)"
             f"\n\n{self.disclaimer_message_loader.message}"
         )
-        self._tg.send_message(TgOutgoingMsg(buyer_id, buyer_name, message_buyer))
-        self._tg.send_message(TgOutgoingMsg(seller_id, seller_name, message_seller))
+        self._outgoing.send_message(TgOutgoingMsg(buyer_id, buyer_name, message_buyer))
+        self._outgoing.send_message(
+            TgOutgoingMsg(seller_id, seller_name, message_seller)
+        )
         self._notify_admins_match(m)
 
     def _notify_admins_match(self, m: Match):
@@ -253,4 +337,6 @@ class Application(ApplicationBase):
             message_for_admins = "\n\n".join(lines)
 
             for uid in self._admin_contacts:
-                self._tg.send_message(TgOutgoingMsg(uid, None, message_for_admins))
+                self._outgoing.send_message(
+                    TgOutgoingMsg(uid, None, message_for_admins)
+                )
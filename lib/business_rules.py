@@ -80,15 +80,11 @@ class Validator:
                 f"Lifetime cannot be greater than {limit_sec // 3600} hours"
             )
 
-    def validate_remove_command_params(self, params, exchange, user_id):
+    def validate_remove_command_params(self, params):
+        """The order's owner is checked by Exchange.remove_user_order()"""
         if len(params) == 1:
             remove_order_id = params[0]
         else:
             raise ValueError(f"Invalid remove params: {params}")
         if not remove_order_id.isnumeric():
             raise ValueError(f"Invalid order id: {remove_order_id}")
-        if int(remove_order_id) not in exchange._orders:
-            raise ValueError(f"Invalid order id: {remove_order_id}")
-        if exchange._orders[int(remove_order_id)].user.id != user_id:
-            # User should not be able realize that order with this id exists
-            raise ValueError(f"Invalid order id: {remove_order_id}")
@@ -0,0 +1,253 @@
+"""
+Order book on parallel NumPy arrays, an optional engine for large books.
+
+The module is only imported when the engine is selected:
+Exchange(..., columnar_book=True).
+"""
+
+from decimal import Decimal
+from typing import Iterator
+import numpy as np
+from . import data, fixed_point
+from .exchange import OrderBook
+from .fixed_point import AMOUNT_SCALE
+
+_NOT_RELATIVE = -10000
+_MAX_EXACT_FACTOR = 2**31  # keeps rate * relative_rate products in int64
+
+
+class _ColumnarSide:
+    """
+    One side of the columnar book.
+
+    Matching goes through a view of the side's slots sorted by price-time priority,
+    with the sort keys and the slot generations the entries were made with. An added
+    or repriced order is inserted into the view with a binary search, the view is
+    only sorted anew after a bulk reprice or when mostly stale. An entry whose slot
+    has changed since (removed, reused or repriced order) is skipped.
+    """
+
+    def __init__(self, book: "ColumnarOrderBook", type: data.OrderType):
+        self._book = book
+        self._type = type
+        self._sign = -1 if type == data.OrderType.BUY else 1
+        self._view: np.ndarray | None = None
+        # the keys of the view's entries: signed price, creation time, id, generation
+        self._price = np.zeros(0, np.int64)
+        self._creation_time = np.zeros(0, np.float64)
+        self._id = np.zeros(0, np.int64)
+        self._gen = np.zeros(0, np.int64)
+        self._start = 0  # the view's entries before it are stale
+
+    def invalidate(self) -> None:
+        self._view = None
+
+    def insert(self, slot: int) -> None:
+        """Add the slot's order to the view, it's then skipped at its old place"""
+        view = self._view
+        if view is None:
+            return  # built when needed
+        if len(view) > 2 * len(self._book._slots) + 64:
+            self.invalidate()  # mostly stale
+            return
+        b = self._book
+        price = self._sign * int(b._price[slot])
+        creation_time = float(b._creation_time[slot])
+        _id = int(b._id[slot])
+        # the price level, then the place in it by time priority
+        lo = self._start + int(np.searchsorted(self._price[self._start :], price))
+        hi = lo + int(np.searchsorted(self._price[lo:], price, side="right"))
+        level_t, level_id = self._creation_time[lo:hi], self._id[lo:hi]
+        pos = lo + int(
+            np.count_nonzero(
+                (level_t < creation_time)
+                | ((level_t == creation_time) & (level_id < _id))
+            )
+        )
+        self._view = np.insert(view, pos, slot)
+        self._price = np.insert(self._price, pos, price)
+        self._creation_time = np.insert(self._creation_time, pos, creation_time)
+        self._id = np.insert(self._id, pos, _id)
+        self._gen = np.insert(self._gen, pos, b._gen[slot])
+
+    def _mask(self) -> np.ndarray:
+        b = self._book
+        return b._active & (b._side == self._type)
+
+    def __len__(self) -> int:
+        return int(np.count_nonzero(self._mask()))
+
+    @property
+    def total_amount_cents(self) -> int:
+        return int(self._book._amount_left[self._mask()].sum())
+
+    @property
+    def total_amount(self) -> Decimal:
+        return fixed_point.to_decimal(self.total_amount_cents, AMOUNT_SCALE)
+
+    def _sorted(self) -> np.ndarray:
+        if self._view is None:
+            self._rebuild()
+        assert self._view is not None
+        return self._view
+
+    def _rebuild(self) -> None:
+        b = self._book
+        slots = np.flatnonzero(self._mask())
+        price = self._sign * b._price[slots]
+        order = np.lexsort((b._id[slots], b._creation_time[slots], price))
+        self._view = slots = slots[order]
+        self._price = price[order]
+        self._creation_time = b._creation_time[slots]
+        self._id = b._id[slots]
+        self._gen = b._gen[slots]
+        self._start = 0
+
+    def best(self) -> data.CompactOrder | None:
+        view = self._sorted()
+        gen = self._book._gen
+        while (
+            self._start < len(view) and gen[view[self._start]] != self._gen[self._start]
+        ):
+            self._start += 1
+        if self._start == len(view):
+            return None
+        return self._book._by_slot[view[self._start]]
+
+    def __iter__(self) -> Iterator[data.CompactOrder]:
+        """
+        Iterate over the orders best first.
+
+        Orders may be removed from the side while iterating, removed orders are skipped.
+        """
+        view = self._sorted()
+        book = self._book
+        for slot, gen in zip(
+            view[self._start :].tolist(), self._gen[self._start :].tolist()
+        ):
+            if book._gen[slot] == gen:
+                yield book._by_slot[slot]  # type: ignore
+
+
+class ColumnarOrderBook(OrderBook):
+    """
+    OrderBook keeping the columns bulk operations need in NumPy arrays, one slot per order:
+    price, amount left, relative rate, expiration time and side.
+
+    Repricing after a rate change is one vectorized multiply, expiry is a mask,
+    side totals are reductions. The orders themselves are CompactOrders as in
+    OrderBook, the arrays are kept in sync with them.
+    """
+
+    def __init__(self, capacity: int = 1024):
+        super().__init__()
+        self._id = np.zeros(capacity, np.int64)
+        self._price = np.zeros(capacity, np.int64)
+        self._amount_left = np.zeros(capacity, np.int64)
+        self._relative_rate = np.zeros(capacity, np.int64)
+        self._expiration_time = np.zeros(capacity, np.float64)
+        self._creation_time = np.zeros(capacity, np.float64)
+        self._side = np.zeros(capacity, np.int8)
+        self._active = np.zeros(capacity, np.bool_)
+        self._gen = np.zeros(capacity, np.int64)  # bumped on every change of the slot
+        self._by_slot: list[data.CompactOrder | None] = [None] * capacity
+        self._slots: dict[int, int] = {}
+        self._free = list(range(capacity - 1, -1, -1))
+        self._sides = {
+            data.OrderType.SELL: _ColumnarSide(self, data.OrderType.SELL),
+            data.OrderType.BUY: _ColumnarSide(self, data.OrderType.BUY),
+        }
+
+    def add(self, order: data.Order) -> data.CompactOrder:
+        o = self._index(order)
+        if not self._free:
+            self._grow()
+        slot = self._free.pop()
+        self._slots[o._id] = slot
+        self._by_slot[slot] = o
+        self._id[slot] = o._id
+        self._price[slot] = o.price_cents
+        self._amount_left[slot] = o.amount_left_cents
+        self._relative_rate[slot] = o.relative_rate_cents
+        self._expiration_time[slot] = o.expiration_time
+        self._creation_time[slot] = o.creation_time
+        self._side[slot] = o.type
+        self._active[slot] = True
+        self._gen[slot] += 1
+        self._sides[o.type].insert(slot)
+        self.version += 1
+        return o
+
+    def remove(self, _id: int) -> data.CompactOrder:
+        o = self._unindex(_id)
+        slot = self._slots.pop(_id)
+        self._active[slot] = False
+        self._gen[slot] += 1
+        self._by_slot[slot] = None
+        self._free.append(slot)
+        self.version += 1
+        return o
+
+    def pop_expired(self, now: float) -> list[data.CompactOrder]:
+        """The orders whose lifetime is over, it's up to the caller to remove them"""
+        slots = np.flatnonzero(self._active & (self._expiration_time < now))
+        order = np.lexsort((self._id[slots], self._expiration_time[slots]))
+        return [self._by_slot[slot] for slot in slots[order].tolist()]
+
+    def reprice(self, o: data.CompactOrder, price_cents: int) -> None:
+        o.price_cents = price_cents
+        slot = self._slots[o._id]
+        self._price[slot] = price_cents
+        self._gen[slot] += 1
+        self._sides[o.type].insert(slot)
+        self._touched_users.add(o.user.id)
+        self.version += 1
+
+    def reprice_relative(self, rate: Decimal) -> list[data.CompactOrder]:
+        n, d = rate.as_integer_ratio()
+        if abs(n) >= _MAX_EXACT_FACTOR or d >= _MAX_EXACT_FACTOR:
+            return super().reprice_relative(rate)
+        slots = np.flatnonzero(self._active & (self._relative_rate != _NOT_RELATIVE))
+        # fixed_point.mul_half_even() on the whole column
+        q, r = np.divmod(self._relative_rate[slots] * n, d)
+        q += (2 * r > d) | ((2 * r == d) & (q % 2 == 1))
+        changed = q != self._price[slots]
+        slots, prices = slots[changed], q[changed]
+        if not len(slots):
+            return []
+        self._price[slots] = prices
+        moved = []
+        for slot, price_cents in zip(slots.tolist(), prices.tolist()):
+            o = self._by_slot[slot]
+            o.price_cents = price_cents
+            self._touched_users.add(o.user.id)
+            moved.append(o)
+        for side in self._sides.values():
+            side.invalidate()
+        self.version += 1
+        moved.sort(key=lambda o: o._id)
+        return moved
+
+    def fill(self, o: data.CompactOrder, amount_cents: int) -> None:
+        o.amount_left_cents -= amount_cents
+        self._amount_left[self._slots[o._id]] = o.amount_left_cents
+        self._touched_users.add(o.user.id)
+        self.version += 1
+
+    def _grow(self) -> None:
+        capacity = len(self._by_slot)
+        for name in (
+            "_id",
+            "_price",
+            "_amount_left",
+            "_relative_rate",
+            "_expiration_time",
+            "_creation_time",
+            "_side",
+            "_active",
+            "_gen",
+        ):
+            column = getattr(self, name)
+            setattr(self, name, np.concatenate([column, np.zeros_like(column)]))
+        self._by_slot.extend([None] * capacity)
+        self._free.extend(range(2 * capacity - 1, capacity - 1, -1))
@@ -0,0 +1,200 @@
+"""
+Outgoing emails queued in the DB, so the callers don't wait for the mail server.
+"""
+
+import concurrent.futures
+from enum import Enum
+import functools
+import logging
+import threading
+import time
+from typing import Optional
+from unittest import TestCase
+from sqlalchemy import Engine, create_engine, select, update
+from sqlalchemy.orm import DeclarativeBase, mapped_column, Mapped, Session
+from sqlalchemy.pool import StaticPool
+from .. import schema
+from .mailer import EmailAddress, Mailer, MailerMock
+
+
+class DeliveryStatus(Enum):
+    SENDING = 1
+    SENT = 2
+    FAILED = 3
+
+
+class EmailOutbox:
+    """
+    An email is stored in the outbox table and handed over to the mailer's
+    background queue, see Mailer.submit_email(), its status is updated when the
+    mailer is done. The text is erased once the email is sent or has failed, it
+    may contain a code. Failed emails aren't resent, the user asks for a new code.
+    The table is created by schema.create_all().
+    """
+
+    def __init__(self, mailer: Mailer, db_eng: Engine):
+        self._mailer = mailer
+        self._db_eng = db_eng
+
+    def enqueue(self, telegram_user_id: int, to: EmailAddress, text: str) -> int:
+        """Queue the email, returns its id in the outbox"""
+        with Session(self._db_eng) as session:
+            dbo = _OutboxEmail(
+                telegram_user_id=telegram_user_id,
+                to_addr=to.addr,
+                text=text,
+                status=DeliveryStatus.SENDING.value,
+                ctime=int(time.time()),
+            )
+            session.add(dbo)
+            session.commit()
+            email_id = dbo.id
+        self._submit(email_id, to, text)
+        return email_id
+
+    def last_status(self, telegram_user_id: int) -> Optional[DeliveryStatus]:
+        """The status of the latest email to the user, None if there is none"""
+        with Session(self._db_eng) as session:
+            status = session.scalar(
+                select(_OutboxEmail.status)
+                .where(_OutboxEmail.telegram_user_id == telegram_user_id)
+                .order_by(_OutboxEmail.id.desc())
+                .limit(1)
+            )
+        return DeliveryStatus(status) if status is not None else None
+
+    def resume_pending(self) -> int:
+        """Submit again the emails which were being sent when the process stopped"""
+        with Session(self._db_eng) as session:
+            pending = session.execute(
+                select(_OutboxEmail.id, _OutboxEmail.to_addr, _OutboxEmail.text).where(
+                    _OutboxEmail.status == DeliveryStatus.SENDING.value
+                )
+            ).all()
+        for email_id, to_addr, text in pending:
+            self._submit(email_id, EmailAddress(to_addr), text)
+        return len(pending)
+
+    def _submit(self, email_id: int, to: EmailAddress, text: str):
+        try:
+            future = self._mailer.submit_email(to, text)
+        except Exception:
+            logging.exception(f"Failed to queue email {email_id} to {to.obfuscated}")
+            self._set_status(email_id, DeliveryStatus.FAILED)
+            return
+        future.add_done_callback(functools.partial(self._on_done, email_id, to))
+
+    def _on_done(
+        self, email_id: int, to: EmailAddress, future: concurrent.futures.Future
+    ):
+        e = future.exception()
+        if e is None:
+            logging.info(f"Sent email {email_id} to {to.obfuscated}")
+            self._set_status(email_id, DeliveryStatus.SENT)
+        else:
+            logging.error(f"Failed to send email {email_id} to {to.obfuscated}: {e}")
+            self._set_status(email_id, DeliveryStatus.FAILED)
+
+    def _set_status(self, email_id: int, status: DeliveryStatus):
+        values: dict = {"status": status.value}
+        if status != DeliveryStatus.SENDING:
+            values["text"] = ""
+        with Session(self._db_eng) as session:
+            session.execute(
+                update(_OutboxEmail).where(_OutboxEmail.id == email_id).values(values)
+            )
+            session.commit()
+
+
+class _Base(DeclarativeBase):
+    pass
+
+
+class _OutboxEmail(_Base):
+    __tablename__ = "email_outbox"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    telegram_user_id: Mapped[int] = mapped_column(index=True)
+    to_addr: Mapped[str] = mapped_column(nullable=False)
+    text: Mapped[str] = mapped_column(nullable=False)
+    status: Mapped[int] = mapped_column(nullable=False)
+    ctime: Mapped[int] = mapped_column(nullable=False)
+
+
+class _BlockingMailer(MailerMock):
+    def __init__(self):
+        super().__init__()
+        self.release = threading.Event()
+        self.fail = False
+
+    def submit_email(self, to: EmailAddress, text: str) -> concurrent.futures.Future:
+        future: concurrent.futures.Future = concurrent.futures.Future()
+
+        def send():
+            self.release.wait(10)
+            if self.fail:
+                future.set_exception(ConnectionError("no route"))
+            else:
+                self.send_email(to, text)
+                future.set_result(None)
+
+        threading.Thread(target=send, daemon=True).start()
+        return future
+
+
+class T(TestCase):
+    def setUp(self):
+        # the same in-memory DB for the mailer threads
+        self.eng = create_engine(
+            "sqlite://",
+            poolclass=StaticPool,
+            connect_args={"check_same_thread": False},
+        )
+        schema.create_all(self.eng)
+        self.mailer = _BlockingMailer()
+        self.outbox = EmailOutbox(self.mailer, self.eng)
+        self.addCleanup(self.mailer.release.set)
+        self.to = EmailAddress("john@example.com")
+
+    def wait_status(self, status: DeliveryStatus):
+        for _ in range(1000):
+            if self.outbox.last_status(123) == status:
+                return
+            time.sleep(0.005)
+        self.fail(f"{self.outbox.last_status(123)} != {status}")
+
+    def test_sent(self):
+        self.assertIsNone(self.outbox.last_status(123))
+        self.outbox.enqueue(123, self.to, "code 1234")
+        self.assertEqual(DeliveryStatus.SENDING, self.outbox.last_status(123))
+        self.mailer.release.set()
+        self.wait_status(DeliveryStatus.SENT)
+        self.assertEqual(["code 1234"], self.mailer.sent[self.to])
+        with Session(self.eng) as session:
+            self.assertEqual([""], session.scalars(select(_OutboxEmail.text)).all())
+
+    def test_failed(self):
+        self.mailer.fail = True
+        self.mailer.release.set()
+        with self.assertLogs(level="ERROR"):
+            self.outbox.enqueue(123, self.to, "code 1234")
+            self.wait_status(DeliveryStatus.FAILED)
+        with Session(self.eng) as session:
+            self.assertEqual([""], session.scalars(select(_OutboxEmail.text)).all())
+
+    def test_resume_pending(self):
+        with Session(self.eng) as session:
+            session.add(
+                _OutboxEmail(
+                    telegram_user_id=123,
+                    to_addr=self.to.addr,
+                    text="code 1234",
+                    status=DeliveryStatus.SENDING.value,
+                    ctime=0,
+                )
+            )
+            session.commit()
+        self.mailer.release.set()
+        self.assertEqual(1, self.outbox.resume_pending())
+        self.wait_status(DeliveryStatus.SENT)
+        self.assertEqual(0, self.outbox.resume_pending())
@@ -1,8 +1,15 @@
+import concurrent.futures
+import contextlib
 from dataclasses import dataclass, field
 from email.mime.text import MIMEText
 from email_validator import validate_email, EmailNotValidError
+import logging
 import smtplib
-from typing import Dict, List
+import socket
+import socketserver
+import threading
+import time
+from typing import Callable, Dict, Iterator, List
 from unittest import TestCase
 from typing import Tuple
 
@@ -49,6 +56,18 @@ class Mailer:
     def send_email(self, to: "EmailAddress", text: str):
         raise NotImplementedError()
 
+    def submit_email(self, to: "EmailAddress", text: str) -> concurrent.futures.Future:
+        """Send the email in the background if the mailer can, here it's sent right away"""
+        future: concurrent.futures.Future = concurrent.futures.Future()
+        try:
+            future.set_result(self.send_email(to, text))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def close(self):
+        pass
+
     def init_allowed_destinations(self, allowed_mail_destinations: str | None) -> dict:
         allowed: dict = {
             "domains": set(),
@@ -96,6 +115,72 @@ class MailerMock(Mailer):
         self.sent[to].append(text)
 
 
+class _SmtpPool:
+    """
+    Authenticated SMTP sessions kept open between the sends, at most `size` at once.
+
+    A session idle for longer than `keepalive_sec` is checked with NOOP before
+    it's reused, the ones the server has dropped are replaced with new ones.
+    """
+
+    def __init__(self, connect: Callable[[], smtplib.SMTP], size: int, keepalive_sec: float):
+        self._connect = connect
+        self._keepalive_sec = keepalive_sec
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._idle: List[Tuple[smtplib.SMTP, float]] = []  # with the last use time
+        self.connects = 0
+
+    @contextlib.contextmanager
+    def connection(self) -> Iterator[smtplib.SMTP]:
+        with self._slots:
+            conn = self._take()
+            try:
+                yield conn
+            except BaseException:
+                _close_quietly(conn)  # its state is unknown
+                raise
+            with self._lock:
+                self._idle.append((conn, time.monotonic()))
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            _close_quietly(conn)
+
+    def _take(self) -> smtplib.SMTP:
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                conn, last_used = self._idle.pop()
+            if time.monotonic() - last_used < self._keepalive_sec:
+                return conn
+            try:
+                if conn.noop()[0] == 250:
+                    return conn
+            except (smtplib.SMTPException, OSError):
+                pass
+            _close_quietly(conn)
+        conn = self._connect()
+        self.connects += 1
+        return conn
+
+
+def _close_quietly(conn: smtplib.SMTP):
+    try:
+        conn.quit()
+    except (smtplib.SMTPException, OSError):
+        conn.close()
+
+
+def _is_transient(e: Exception) -> bool:
+    if isinstance(e, smtplib.SMTPResponseException):
+        return 400 <= e.smtp_code < 500
+    return isinstance(e, (smtplib.SMTPServerDisconnected, OSError))
+
+
 class MailerReal(Mailer):
     def __init__(
         self,
@@ -104,11 +189,29 @@ class MailerReal(Mailer):
         user: str,
         app_password: str,
         allowed_mail_destinations: str | None = None,
+        pool_size: int = 2,
+        keepalive_sec: float = 30,
+        retries: int = 3,
+        backoff_sec: float = 1,
+        use_tls: bool = True,
     ):
+        """
+        Args:
+            pool_size: SMTP sessions kept open, and the threads sending in the
+                background, see submit_email().
+            retries: how many times a send failed with a transient error (a dropped
+                connection, a 4xx reply) is retried, waiting backoff_sec, then twice
+                as long and so on.
+        """
         self.server: str = server
         self.port: int = port
         self.user: str = user
         self.password: str = app_password
+        self._use_tls = use_tls
+        self._retries = retries
+        self._backoff_sec = backoff_sec
+        self._pool = _SmtpPool(self._connect, pool_size, keepalive_sec)
+        self._queue = concurrent.futures.ThreadPoolExecutor(pool_size, thread_name_prefix="mailer")
         super().__init__(allowed_mail_destinations)
 
     def send_email(self, to: EmailAddress, text: str):
@@ -118,11 +221,99 @@ class MailerReal(Mailer):
         msg["From"] = self.user
         msg["To"] = to.addr
         msg["Subject"] = "Your code for Exhcange Bot"
-        server = smtplib.SMTP(self.server, self.port)
-        server.starttls()
-        server.login(self.user, self.password)
-        server.sendmail(self.user, to.addr, msg.as_string())
-        server.quit()
+        for attempt in range(self._retries + 1):
+            try:
+                with self._pool.connection() as conn:
+                    conn.sendmail(self.user, to.addr, msg.as_string())
+                return
+            except Exception as e:
+                if attempt == self._retries or not _is_transient(e):
+                    raise
+                delay = self._backoff_sec * 2**attempt
+                logging.warning(f"Failed to send to {to.obfuscated}: {e}, retrying in {delay}s")
+                time.sleep(delay)
+
+    def submit_email(self, to: EmailAddress, text: str) -> concurrent.futures.Future:
+        """Send the email in the background, the future is done when it's sent or failed"""
+        if not self.is_allowed(to):
+            raise ValueError(f"Email {to.obfuscated} is not allowed")
+        return self._queue.submit(self.send_email, to, text)
+
+    def close(self):
+        """Send the queued emails and close the SMTP sessions"""
+        self._queue.shutdown()
+        self._pool.close()
+
+    def _connect(self) -> smtplib.SMTP:
+        conn = smtplib.SMTP(self.server, self.port, timeout=30)
+        try:
+            if self._use_tls:
+                conn.starttls()
+            conn.login(self.user, self.password)
+        except BaseException:
+            _close_quietly(conn)
+            raise
+        return conn
+
+
+class _SmtpStandIn(socketserver.ThreadingTCPServer):
+    """A local SMTP server accepting anything, for the tests"""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _SmtpStandInHandler)
+        self.connections = 0
+        self.messages: List[Tuple[str, str]] = []  # (recipient, data)
+        self.fail_next_data = 0  # replies 451 to DATA this many times
+        threading.Thread(target=self.serve_forever, args=(0.05,), daemon=True).start()
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class _SmtpStandInHandler(socketserver.StreamRequestHandler):
+    server: _SmtpStandIn
+
+    def handle(self):
+        self.server.connections += 1
+        self._reply("220 localhost")
+        rcpt = ""
+        while line := self.rfile.readline():
+            cmd = line.decode().strip()
+            verb = cmd.split(" ", 1)[0].upper()
+            if verb == "EHLO":
+                self._reply("250-localhost\r\n250 AUTH PLAIN")
+            elif verb == "AUTH":
+                self._reply("235 OK")
+            elif verb == "RCPT":
+                rcpt = cmd.split(":", 1)[1].strip(" <>")
+                self._reply("250 OK")
+            elif verb == "DATA":
+                if self.server.fail_next_data:
+                    self.server.fail_next_data -= 1
+                    self._reply("451 Try again later")
+                    continue
+                self._reply("354 Go ahead")
+                data = b""
+                while (line := self.rfile.readline()) not in (b".\r\n", b""):
+                    data += line
+                self.server.messages.append((rcpt, data.decode()))
+                self._reply("250 OK")
+            elif verb == "QUIT":
+                self._reply("221 Bye")
+                return
+            else:  # MAIL, RSET, NOOP
+                self._reply("250 OK")
+
+    def _reply(self, s: str):
+        self.wfile.write(s.encode() + b"\r\n")
 
 
 class T(TestCase):
@@ -179,3 +370,36 @@ class T(TestCase):
         mm = MailerMock()
         self.assertTrue(mm.is_allowed(e1))
         self.assertTrue(mm.is_allowed(e2))
+
+
+class TestMailerReal(TestCase):
+    def setUp(self):
+        self.smtp = _SmtpStandIn()
+        self.addCleanup(self.smtp.stop)
+        self.mailer = MailerReal(
+            "127.0.0.1", self.smtp.port, "bot@example.com", "pwd", backoff_sec=0.01, use_tls=False
+        )
+        self.addCleanup(self.mailer.close)
+
+    def test_connection_reuse(self):
+        for i in range(3):
+            self.mailer.send_email(EmailAddress("john@example.com"), f"code {i}")
+        self.assertEqual(1, self.smtp.connections)
+        self.assertEqual(["john@example.com"] * 3, [m[0] for m in self.smtp.messages])
+        self.assertIn("code 2", self.smtp.messages[2][1])
+
+    def test_reconnect(self):
+        self.mailer.send_email(EmailAddress("john@example.com"), "one")
+        self.mailer._pool._idle[0][0].sock.shutdown(socket.SHUT_RDWR)  # dropped
+        self.mailer._pool._keepalive_sec = 0  # checked with NOOP
+        self.mailer.send_email(EmailAddress("john@example.com"), "two")
+        self.assertEqual(2, self.mailer._pool.connects)
+        self.assertEqual(2, len(self.smtp.messages))
+
+    def test_retry(self):
+        self.smtp.fail_next_data = 2
+        self.mailer.submit_email(EmailAddress("john@example.com"), "hello").result(10)
+        self.assertEqual(1, len(self.smtp.messages))
+        self.smtp.fail_next_data = 10
+        future = self.mailer.submit_email(EmailAddress("john@example.com"), "hello")
+        self.assertRaises(smtplib.SMTPDataError, future.result, 10)
@@ -1,2 +1,8 @@
 ORDER_LIFETIME_LIMIT = 30 * 24 * 60 * 60  # seconds
 CHECK_RATES_TIME_PERIOD_SEC = 6 * 60 * 60
+EXPIRY_CHECK_PERIOD_SEC = 60
+SNAPSHOT_PERIOD_SEC = 10 * 60
+PIPELINE_WORKERS = 8  # threads processing the incoming messages
+SESSIONS_CAPACITY = 10000  # dialog sessions kept in memory, see SessionStore
+SESSION_IDLE_TTL_SEC = 30 * 60
+EMAIL_AUTHENTICATORS_CACHE_SIZE = 1000
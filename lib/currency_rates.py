@@ -3,15 +3,38 @@ import threading
 import logging
 import os
 from decimal import Decimal
+from typing import Callable
 
 
-class CurrencyMockClient:
+class _RatesPublisher:
     def __init__(self):
+        self._listeners: list[Callable[[], None]] = []
+
+    def subscribe(self, callback: Callable[[], None]) -> None:
+        """Call `callback` every time new rates are delivered."""
+        self._listeners.append(callback)
+
+    def _notify_rates_updated(self) -> None:
+        for callback in self._listeners:
+            try:
+                callback()
+            except Exception:
+                logging.exception("Rates update listener failed")
+
+
+class CurrencyMockClient(_RatesPublisher):
+    def __init__(self):
+        super().__init__()
         self.rates = {
             "RUB": 0.1000,
             "AMD": 0.4540,
         }
 
+    def set_rates(self, rates: dict):
+        if rates != self.rates:
+            self.rates = rates
+            self._notify_rates_updated()
+
     def get_rate(self, currency):
         return {
             "rate": self.rates.get(currency),
@@ -25,8 +48,9 @@ class RepeatTimer(threading.Timer):
             self.function(*self.args, **self.kwargs)
 
 
-class CurrencyFreaksClient:
+class CurrencyFreaksClient(_RatesPublisher):
     def __init__(self, api_key):
+        super().__init__()
         self.api_key = api_key
         self.rates = {}
         self.date = None
@@ -48,8 +72,11 @@ class CurrencyFreaksClient:
                     f"https://api.currencyfreaks.com/v2.0/rates/latest?apikey={self.api_key}&symbols=RUB,AMD"
                 )
                 if response.status_code == 200:
-                    self.rates = response.json().get("rates", {})
+                    rates = response.json().get("rates", {})
                     self.date = response.json().get("date", None)
+                    if rates != self.rates:
+                        self.rates = rates
+                        self._notify_rates_updated()
                     return
                 else:
                     logging.error(f"Error: Response code {response.status_code}")
@@ -67,6 +94,9 @@ class CurrencyConverter:
     def __init__(self, currency_client=None):
         self.currency_client = currency_client
 
+    def subscribe(self, callback: Callable[[], None]) -> None:
+        self.currency_client.subscribe(callback)
+
     def get_rate(self, from_currency: str, to_currency: str):
         from_rate = self.currency_client.get_rate(from_currency)
         to_rate = self.currency_client.get_rate(to_currency)
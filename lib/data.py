@@ -3,7 +3,10 @@ import enum
 from decimal import Decimal
 import unittest
 import time
-from typing import Optional
+import tracemalloc
+from typing import Iterable, Optional
+from . import fixed_point
+from .fixed_point import AMOUNT_SCALE, PRICE_SCALE
 
 
 class OrderType(enum.IntEnum):
@@ -32,6 +35,9 @@ class Order:
         creation_time (int, optional): The creation time of the order in seconds since the epoch.
         _id (int, optional): The unique identifier of the order.
         amount_left (Decimal, optional): The amount of currency left in the order.
+
+    The fields changed since the order was last persisted are tracked in dirty_fields,
+    a new order is entirely dirty.
     """
 
     user: User
@@ -44,11 +50,169 @@ class Order:
     _id: Optional[int] = None
     amount_left: Decimal = Decimal(-1.0)
     relative_rate: Decimal = Decimal(-1.0)  # -1.0 means not set; why not None?
+    _dirty: set[str] = dataclasses.field(
+        default_factory=lambda: set(_ORDER_TRACKED_FIELDS),
+        init=False,
+        repr=False,
+        compare=False,
+    )
 
     def __post_init__(self):
         if self.amount_left == -1.0:
             self.amount_left = self.amount_initial
 
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        dirty = self.__dict__.get("_dirty")  # not there yet while in __init__
+        if dirty is not None and name in _ORDER_TRACKED_FIELDS:
+            dirty.add(name)
+
+    @property
+    def dirty_fields(self) -> set[str]:
+        return self._dirty
+
+    def mark_clean(self):
+        self._dirty = set()
+
+
+_ORDER_TRACKED_FIELDS = frozenset(
+    f.name for f in dataclasses.fields(Order) if f.name not in ("_id", "_dirty")
+)
+
+
+class CompactOrder:
+    """
+    Memory-lean form of an Order for the in-memory book.
+
+    Prices (x10^4) and amounts (x10^2) are integers, the same fixed point as
+    in the DB, so comparisons and arithmetic on them are plain integer operations.
+    The User object is shared by the orders of the same user, see from_order().
+    The Decimal properties are read-only views, to_order() gives a full Order.
+    """
+
+    __slots__ = (
+        "_id",
+        "user",
+        "type",
+        "price_cents",
+        "amount_initial_cents",
+        "amount_left_cents",
+        "min_op_threshold_cents",
+        "relative_rate_cents",  # x10^4 like price_cents, -10000 means not set
+        "lifetime_sec",
+        "creation_time",
+    )
+
+    def __init__(
+        self,
+        _id: int,
+        user: User,
+        type: OrderType,
+        price_cents: int,
+        amount_initial_cents: int,
+        amount_left_cents: int,
+        min_op_threshold_cents: int,
+        relative_rate_cents: int,
+        lifetime_sec: int,
+        creation_time: int,
+    ):
+        self._id = _id
+        self.user = user
+        self.type = type
+        self.price_cents = price_cents
+        self.amount_initial_cents = amount_initial_cents
+        self.amount_left_cents = amount_left_cents
+        self.min_op_threshold_cents = min_op_threshold_cents
+        self.relative_rate_cents = relative_rate_cents
+        self.lifetime_sec = lifetime_sec
+        self.creation_time = creation_time
+
+    @classmethod
+    def from_order(
+        cls, o: Order, users: dict[int, User] | None = None
+    ) -> "CompactOrder":
+        """
+        Args:
+            users: interned users by id, the order's user is added if it's not there.
+                The order keeps its own User if it differs from the interned one.
+        """
+        assert o._id is not None
+        user = o.user
+        if users is not None:
+            interned = users.setdefault(user.id, user)
+            if interned == user:
+                user = interned
+        return cls(
+            o._id,
+            user,
+            o.type,
+            # the values are truncated as they are in the DB
+            fixed_point.from_decimal(o.price, PRICE_SCALE),
+            fixed_point.from_decimal(o.amount_initial, AMOUNT_SCALE),
+            fixed_point.from_decimal(o.amount_left, AMOUNT_SCALE),
+            fixed_point.from_decimal(o.min_op_threshold, AMOUNT_SCALE),
+            fixed_point.from_decimal(o.relative_rate, PRICE_SCALE),
+            o.lifetime_sec,
+            o.creation_time,
+        )
+
+    def to_order(self, dirty: Iterable[str] = ()) -> Order:
+        """An Order with the same values, only the given fields are marked dirty"""
+        o = Order(
+            user=self.user,
+            type=self.type,
+            price=self.price,
+            amount_initial=self.amount_initial,
+            min_op_threshold=self.min_op_threshold,
+            lifetime_sec=self.lifetime_sec,
+            creation_time=self.creation_time,
+            _id=self._id,
+            amount_left=self.amount_left,
+            relative_rate=self.relative_rate,
+        )
+        o._dirty = set(dirty)
+        return o
+
+    @property
+    def price(self) -> Decimal:
+        return fixed_point.to_decimal(self.price_cents, PRICE_SCALE)
+
+    @property
+    def amount_initial(self) -> Decimal:
+        return fixed_point.to_decimal(self.amount_initial_cents, AMOUNT_SCALE)
+
+    @property
+    def amount_left(self) -> Decimal:
+        return fixed_point.to_decimal(self.amount_left_cents, AMOUNT_SCALE)
+
+    @property
+    def min_op_threshold(self) -> Decimal:
+        return fixed_point.to_decimal(self.min_op_threshold_cents, AMOUNT_SCALE)
+
+    @property
+    def relative_rate(self) -> Decimal:
+        return fixed_point.to_decimal(self.relative_rate_cents, PRICE_SCALE)
+
+    @property
+    def is_relative(self) -> bool:
+        return self.relative_rate_cents != -10000
+
+    @property
+    def expiration_time(self) -> int:
+        return self.creation_time + self.lifetime_sec
+
+    def _values(self) -> tuple:
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, CompactOrder):
+            return NotImplemented
+        return self._values() == other._values()
+
+    def __repr__(self) -> str:
+        fields = ", ".join(f"{n}={getattr(self, n)!r}" for n in self.__slots__)
+        return f"CompactOrder({fields})"
+
 
 @dataclasses.dataclass
 class Match:
@@ -76,3 +240,79 @@ class Operation:
 class T(unittest.TestCase):
     def testT(self):
         pass
+
+    def testDirtyFields(self):
+        o = Order(User(1), OrderType.SELL, Decimal(10), Decimal(100))
+        self.assertEqual(_ORDER_TRACKED_FIELDS, o.dirty_fields)
+        o.mark_clean()
+        o._id = 1
+        self.assertEqual(set(), o.dirty_fields)
+        o.amount_left -= 10
+        o.price = Decimal(11)
+        self.assertEqual({"amount_left", "price"}, o.dirty_fields)
+        self.assertEqual(o, dataclasses.replace(o))
+
+    def testCompactOrder(self):
+        users: dict[int, User] = {}
+        o = Order(
+            User(1, "Joe"),
+            OrderType.SELL,
+            Decimal("98.1234"),
+            Decimal("1299.50"),
+            Decimal("500.00"),
+            _id=7,
+            relative_rate=Decimal("1.0100"),
+        )
+        o.amount_left = Decimal("299.50")
+        c = CompactOrder.from_order(o, users)
+        self.assertEqual(981234, c.price_cents)
+        self.assertEqual(29950, c.amount_left_cents)
+        self.assertTrue(c.is_relative)
+        restored = c.to_order()
+        self.assertEqual(o, restored)
+        self.assertEqual(str(o), str(restored))
+        self.assertEqual(set(), restored.dirty_fields)
+        self.assertEqual({"price"}, c.to_order(dirty={"price"}).dirty_fields)
+
+        o._id = 8
+        self.assertIs(c.user, CompactOrder.from_order(o, users).user)
+        o.user = User(1, "Joseph")  # renamed, the order keeps its own user
+        self.assertEqual(o.user, CompactOrder.from_order(o, users).to_order().user)
+        self.assertFalse(
+            CompactOrder.from_order(
+                Order(User(2), OrderType.BUY, 1, 1, _id=9)
+            ).is_relative
+        )
+
+    def testCompactOrderFootprint(self):
+        def footprint(mk) -> float:
+            tracemalloc.start()
+            try:
+                objects = [mk(i) for i in range(1000)]
+                size, _ = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+            del objects
+            return size / 1000
+
+        user = User(1, "Joe")
+
+        def mk_order(i: int) -> Order:
+            # as loaded from the DB: a User per row, Decimals from the integer columns
+            return Order(
+                User(1, "Joe"),
+                OrderType.SELL,
+                Decimal(980000 + i).scaleb(-4),
+                Decimal(129900 + i).scaleb(-2),
+                Decimal(50000 + i).scaleb(-2),
+                _id=i,
+                amount_left=Decimal(29900 + i).scaleb(-2),
+                relative_rate=Decimal(10100 + i).scaleb(-4),
+            )
+
+        orders = [mk_order(i) for i in range(1000)]
+        order_size = footprint(mk_order)
+        compact_size = footprint(
+            lambda i: CompactOrder.from_order(orders[i], {1: user})
+        )
+        self.assertLess(compact_size, order_size / 3)
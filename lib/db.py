@@ -1,9 +1,65 @@
+import dataclasses
 from typing import Callable
 from sqlalchemy import Engine
 from decimal import Decimal
 from .data import Order
 
 
+@dataclasses.dataclass
+class OrderChanges:
+    """
+    DB side effects of an exchange operation, to be committed in one transaction.
+
+    Updates are coalesced by order id: the dirty fields of the latest state
+    of the order are written once.
+    """
+
+    updated: dict[int, Order] = dataclasses.field(default_factory=dict)
+    removed: set[int] = dataclasses.field(default_factory=set)
+    last_match_price: Decimal | None = None
+
+    def update(self, o: Order):
+        assert o._id is not None
+        older = self.updated.get(o._id)
+        if older is not None and older is not o:
+            o.dirty_fields.update(older.dirty_fields)
+        self.updated[o._id] = o
+
+    def remove(self, id: int):
+        self.updated.pop(id, None)
+        self.removed.add(id)
+
+    def merge(self, other: "OrderChanges"):
+        """Apply newer changes on top of these ones"""
+        for id, o in other.updated.items():
+            older = self.updated.get(id)
+            if older is not None and older is not o:
+                o.dirty_fields.update(older.dirty_fields)
+            self.updated[id] = o
+        for id in other.removed:
+            self.remove(id)
+        if other.last_match_price is not None:
+            self.last_match_price = other.last_match_price
+
+    def detach(self) -> "OrderChanges":
+        """
+        Copy the changes with snapshots of the updated orders.
+
+        The dirty fields move to the snapshots, the orders themselves become clean.
+        """
+        updated = {}
+        for id, o in self.updated.items():
+            snapshot = dataclasses.replace(o)
+            snapshot._dirty = o.dirty_fields
+            o.mark_clean()
+            updated[id] = snapshot
+        return OrderChanges(updated, set(self.removed), self.last_match_price)
+
+    @property
+    def is_empty(self) -> bool:
+        return not (self.updated or self.removed or self.last_match_price is not None)
+
+
 class Db:
     def get_order(self, id: int) -> Order:
         raise NotImplementedError()
@@ -11,15 +67,43 @@ class Db:
     def store_order(self, o: Order) -> Order:
         raise NotImplementedError()
 
+    def store_orders(self, orders: list[Order]) -> list[Order]:
+        raise NotImplementedError()
+
     def update_order(self, o: Order):
         raise NotImplementedError()
 
+    def apply_changes(self, changes: OrderChanges):
+        raise NotImplementedError()
+
     def remove_order(self, id: int):
         raise NotImplementedError()
 
-    def iterate_orders(self, callback: Callable[[Order], None]):
+    def iterate_orders(
+        self,
+        callback: Callable[[Order], None],
+        not_expired_at: float | None = None,
+    ):
+        raise NotImplementedError()
+
+    def remove_expired_orders(self, now: float):
         raise NotImplementedError()
 
+    def get_order_changes_seq(self) -> int:
+        raise NotImplementedError()
+
+    def get_orders_changed_since(self, seq: int) -> tuple[int, dict[int, Order | None]]:
+        raise NotImplementedError()
+
+    def prune_order_changes(self, upto_seq: int):
+        raise NotImplementedError()
+
+    def get_orders_count_and_max_id(self) -> tuple[int, int]:
+        raise NotImplementedError()
+
+    def flush(self):
+        """Wait until all the accepted changes are written, if they are written lazily"""
+
     def get_last_match_price(self) -> Decimal | None:
         raise NotImplementedError()
 
@@ -1,32 +1,206 @@
 import dataclasses
 from decimal import Decimal
+import logging
+import os
+import sys
+import tempfile
+import threading
+import timeit
 from typing import Callable, Any
 import unittest
-from sqlalchemy import create_engine, select, Engine
+from unittest import mock
+from sqlalchemy import (
+    create_engine,
+    delete,
+    event,
+    func,
+    insert,
+    select,
+    update,
+    Engine,
+)
 from sqlalchemy.orm import DeclarativeBase, mapped_column, Mapped, Session
-from .db import Db
+from sqlalchemy.pool import QueuePool
+from .db import Db, OrderChanges
 from .data import Order, OrderType, User
+from . import fixed_point
+from . import schema
+from .fixed_point import AMOUNT_SCALE, PRICE_SCALE
 
 
 class SqlDb(Db):
-    def __init__(self, conn_str: str = "sqlite://"):
-        self._eng = create_engine(conn_str, echo=False)
-        _Base.metadata.create_all(self._eng)
+    def __init__(
+        self,
+        conn_str: str = "sqlite://",
+        write_behind_interval_sec: float | None = None,
+        log_order_changes: bool = False,
+    ):
+        """
+        Args:
+            conn_str: SQLAlchemy connection string.
+            write_behind_interval_sec: if set, order mutations are queued and written
+                in batches by a background thread with this period. Use flush() as a
+                durability barrier and close() on shutdown.
+            log_order_changes: record the ids of the changed orders along with
+                the changes, for get_orders_changed_since(). The log grows until
+                it's pruned with prune_order_changes().
+
+        The tables of all the modules sharing the engine are created here, see
+        schema.create_all().
+        """
+        self._log_order_changes = log_order_changes
+        if conn_str in ("sqlite://", "sqlite:///:memory:"):
+            # The same in-memory database for all the threads (timers, background
+            # writer): its only connection, which the threads take turns to use.
+            # Meant for tests, a session must not be opened while the thread holds
+            # another one.
+            self._eng = create_engine(
+                conn_str,
+                echo=False,
+                poolclass=QueuePool,
+                pool_size=1,
+                max_overflow=0,
+                connect_args={"check_same_thread": False},
+            )
+        else:
+            self._eng = create_engine(conn_str, echo=False)
+        schema.create_all(self._eng)
+        self._writer = (
+            _WriteBehindQueue(self._apply_changes, write_behind_interval_sec)
+            if write_behind_interval_sec is not None
+            else None
+        )
+
+    def flush(self):
+        """Wait until all the queued mutations are written"""
+        if self._writer:
+            self._writer.flush()
+
+    def close(self):
+        if self._writer:
+            self._writer.close()
+            self._writer = None
 
     def get_order(self, id: int) -> Order:
+        self.flush()
         return self._get(_ORDERS_TABLE, id)
 
     def store_order(self, o: Order) -> Order:
         return self._store(_ORDERS_TABLE, o)
 
+    def store_orders(self, orders: list[Order]) -> list[Order]:
+        return self._store_many(_ORDERS_TABLE, orders)
+
     def update_order(self, o: Order):
-        self._update(_ORDERS_TABLE, o)
+        if self._writer:
+            self._writer.submit(OrderChanges(updated={o._id: o}))
+        else:
+            self._update(_ORDERS_TABLE, o)
+
+    def apply_changes(self, changes: OrderChanges):
+        if self._writer:
+            self._writer.submit(changes)
+        else:
+            self._apply_changes(changes)
+
+    def _apply_changes(self, changes: OrderChanges):
+        if changes.is_empty:
+            return
+        with Session(self._eng) as session:
+            self._update_many(session, _ORDERS_TABLE, list(changes.updated.values()))
+            self._remove_many(session, _ORDERS_TABLE, list(changes.removed))
+            if changes.last_match_price is not None:
+                self._set_last_match_price(session, changes.last_match_price)
+            session.commit()
+        for o in changes.updated.values():
+            o.mark_clean()
 
     def remove_order(self, id: int):
-        self._remove(_ORDERS_TABLE, id)
+        if self._writer:
+            self._writer.submit(OrderChanges(removed={id}))
+        else:
+            self._remove(_ORDERS_TABLE, id)
+
+    def iterate_orders(
+        self,
+        callback: Callable[[Order], None],
+        not_expired_at: float | None = None,
+    ):
+        """
+        Stream the orders to the callback, the rows are fetched in chunks.
+
+        Args:
+            not_expired_at: if set, only the orders alive at this time are fetched.
+        """
+        self.flush()
+        where = None
+        if not_expired_at is not None:
+            where = _DbOrder.creation_time + _DbOrder.lifetime_sec >= not_expired_at
+        self._iterate(_ORDERS_TABLE, callback, where)
+
+    def remove_expired_orders(self, now: float):
+        self.flush()
+        expired = _DbOrder.creation_time + _DbOrder.lifetime_sec < now
+        with Session(self._eng) as session:
+            if self._log_order_changes:
+                ids = session.scalars(select(_DbOrder.id).where(expired)).all()
+                self._log_changes(session, ids)
+            session.execute(delete(_DbOrder).where(expired))
+            session.commit()
 
-    def iterate_orders(self, callback: Callable[[Order], None]):
-        self._iterate(_ORDERS_TABLE, callback)
+    def get_order_changes_seq(self) -> int:
+        """The sequence number of the latest logged order change"""
+        self._check_order_changes_logged()
+        self.flush()
+        with Session(self._eng) as session:
+            return session.scalar(select(func.max(_DbOrderChange.seq))) or 0
+
+    def get_orders_changed_since(self, seq: int) -> tuple[int, dict[int, Order | None]]:
+        """
+        The orders changed after the given change sequence number.
+
+        Returns:
+            The latest change sequence number and the current state of the changed
+            orders by id, None for the removed ones.
+
+        Raises:
+            ValueError: the changes since seq are not in the log (pruned already,
+                or seq is ahead of it).
+        """
+        self._check_order_changes_logged()
+        self.flush()
+        with Session(self._eng) as session:
+            changed = select(_DbOrderChange.order_id).where(_DbOrderChange.seq > seq)
+            first_seq, latest_seq = session.execute(
+                select(func.min(_DbOrderChange.seq), func.max(_DbOrderChange.seq))
+            ).one()
+            latest_seq = latest_seq or 0
+            if seq > latest_seq or (first_seq is not None and first_seq > seq + 1):
+                raise ValueError(f"Order changes since {seq} are not logged")
+            res: dict[int, Order | None] = {
+                id: None for id in session.scalars(changed.distinct())
+            }
+            q = select(_DbOrder.__table__).where(_DbOrder.id.in_(changed))
+            for row in session.execute(q):
+                res[row.id] = _ORDERS_TABLE.mk_do(row)
+        return latest_seq, res
+
+    def prune_order_changes(self, upto_seq: int):
+        """Forget the order changes logged before the given sequence number"""
+        self._check_order_changes_logged()
+        with Session(self._eng) as session:
+            # the latest change stays, so the sequence never goes back after a restart
+            session.execute(delete(_DbOrderChange).where(_DbOrderChange.seq < upto_seq))
+            session.commit()
+
+    def get_orders_count_and_max_id(self) -> tuple[int, int]:
+        """The number of stored orders and the greatest order id, 0 if there are none"""
+        self.flush()
+        with Session(self._eng) as session:
+            cnt, max_id = session.execute(
+                select(func.count(), func.max(_DbOrder.id)).select_from(_DbOrder)
+            ).one()
+        return cnt, max_id or 0
 
     @property
     def engine(self) -> Engine:
@@ -35,46 +209,91 @@ class SqlDb(Db):
     def _get(self, table, id):
         with Session(self._eng) as session:
             o = session.get(table.db_class, id)
-            d = table.mk_dict(o, False)
-        return table.do_class(**d)
+            return table.mk_do(o)
 
     def _store(self, table, do):
+        return self._store_many(table, [do])[0]
+
+    def _store_many(self, table, dos: list) -> list:
         with Session(self._eng) as session:
-            d = table.mk_dict(do, True)
-            o_db = table.db_class(**d)
-            session.add(o_db)
+            dbos = [table.db_class(**table.mk_dict(do, True)) for do in dos]
+            session.add_all(dbos)
+            session.flush()  # fills in the generated ids
+            self._log_changes(session, [dbo.id for dbo in dbos])
+            # build the results from the inserted rows instead of reselecting them
+            res = [table.mk_do(dbo) for dbo in dbos]
             session.commit()
-            id = o_db.id
-        return self._get(table, id)
+        return res
 
     def _update(self, table, do):
         with Session(self._eng) as session:
-            id = table.get_id(do)
-            dbo = session.get(table.db_class, id)
-            for field_name, value in table.mk_dict(do, True).items():
-                setattr(dbo, field_name, value)  # updates only changed fields
+            self._update_many(session, table, [do])
             session.commit()
+        do.mark_clean()
+
+    def _update_many(self, session: Session, table, dos: list):
+        """
+        Write the dirty fields of the objects: one targeted UPDATE by primary key
+        per set of changed columns, without loading the rows first.
+        It's up to the caller to mark the objects clean once the session is committed.
+        """
+        rows = [
+            table.mk_update_dict(do, do.dirty_fields) for do in dos if do.dirty_fields
+        ]
+        if not rows:
+            return
+        session.execute(update(table.db_class), rows)
+        self._log_changes(session, [table.get_id(do) for do in dos if do.dirty_fields])
+
+    def _remove_many(self, session: Session, table, ids: list):
+        if ids:
+            session.execute(delete(table.db_class).where(table.db_class.id.in_(ids)))
+            self._log_changes(session, ids)
 
     def _remove(self, table, id):
         with Session(self._eng) as session:
             session.delete(session.get(table.db_class, id))
+            self._log_changes(session, [id])
             session.commit()
 
-    def _iterate(self, table, callback: Callable[[Order], None]):
-        with Session(self._eng) as session:
-            for dbo in session.scalars(select(table.db_class)):
-                d = table.mk_dict(dbo, False)
-                o = table.do_class(**d)
-                callback(o)
+    def _log_changes(self, session: Session, ids: list[int]):
+        if self._log_order_changes and ids:
+            session.execute(insert(_DbOrderChange), [{"order_id": id} for id in ids])
+
+    def _check_order_changes_logged(self):
+        if not self._log_order_changes:
+            raise RuntimeError("Order changes are not logged")
+
+    def _iterate(self, table, callback: Callable[[Order], None], where=None):
+        # plain rows instead of ORM objects: the mapping only needs attribute access
+        q = select(table.db_class.__table__)
+        if where is not None:
+            q = q.where(where)
+        name = table.db_class.__tablename__
+        n = 0
+        with self._eng.connect() as conn:
+            conn = conn.execution_options(yield_per=_ITERATE_CHUNK_SIZE)
+            for n, row in enumerate(conn.execute(q), 1):
+                callback(table.mk_do(row))
+                if n % _ITERATE_CHUNK_SIZE == 0:
+                    logging.info(f"Loaded {n} rows of {name}...")
+        logging.info(f"Loaded {n} rows of {name}")
 
     def store_last_match_price(self, price: Decimal):
+        if self._writer:
+            self._writer.submit(OrderChanges(last_match_price=price))
+            return
         with Session(self._eng) as session:
-            session.query(_DbLastMatchPrice).delete()
-            last_match_price = _DbLastMatchPrice(price=price)
-            session.add(last_match_price)
+            self._set_last_match_price(session, price)
             session.commit()
 
+    @staticmethod
+    def _set_last_match_price(session: Session, price: Decimal):
+        session.query(_DbLastMatchPrice).delete()
+        session.add(_DbLastMatchPrice(price=price))
+
     def get_last_match_price(self) -> Decimal | None:
+        self.flush()
         with Session(self._eng) as session:
             last_match_price = session.query(_DbLastMatchPrice).one_or_none()
             if last_match_price is None:
@@ -82,6 +301,61 @@ class SqlDb(Db):
             return last_match_price.price.quantize(Decimal("0.0001"))
 
 
+_ITERATE_CHUNK_SIZE = 1000
+
+
+class _WriteBehindQueue:
+    """
+    Ordered, coalescing queue of mutations written to the DB by a background thread.
+
+    Pending mutations are merged into a single OrderChanges, so many updates
+    of the same order are written once.
+    """
+
+    def __init__(
+        self, apply: Callable[[OrderChanges], None], flush_interval_sec: float
+    ):
+        self._apply = apply
+        self._interval = flush_interval_sec
+        self._pending = OrderChanges()
+        self._lock = threading.Lock()  # guards _pending
+        self._flush_lock = threading.Lock()  # keeps the batches in order
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="db-write-behind", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, changes: OrderChanges):
+        changes = changes.detach()  # the caller keeps mutating its orders
+        with self._lock:
+            self._pending.merge(changes)
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                changes, self._pending = self._pending, OrderChanges()
+            try:
+                self._apply(changes)
+            except Exception:
+                with self._lock:  # keep the batch for the next attempt
+                    changes.merge(self._pending)
+                    self._pending = changes
+                raise
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self.flush()
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            try:
+                self.flush()
+            except Exception:
+                logging.exception("Failed to write queued changes, will retry")
+
+
 class _Base(DeclarativeBase):
     pass
 
@@ -100,6 +374,12 @@ class _DbOrder(_Base):
     relative_rate: Mapped[Decimal] = mapped_column(nullable=False)
 
 
+class _DbOrderChange(_Base):
+    __tablename__ = "order_changes"
+    seq: Mapped[int] = mapped_column(primary_key=True)
+    order_id: Mapped[int] = mapped_column(nullable=False)
+
+
 class _DbLastMatchPrice(_Base):
     __tablename__ = "last_match_price"
     id: Mapped[int] = mapped_column(primary_key=True)
@@ -125,15 +405,46 @@ class _Field:
 
 @dataclasses.dataclass
 class _Table:
+    """
+    Mapping between a domain object class and a DB class.
+
+    The field list is compiled once into two specialized functions building the dicts,
+    so the per-row conversion does no reflection over the fields.
+    """
+
     do_class: Callable  # FIXME: never used?
     db_class: Callable
     get_id: Callable
     fields: list[_Field]
 
+    def __post_init__(self):
+        self._do2db = self._compile(True)
+        self._db2do = self._compile(False)
+        self._fields_by_do_name = {f.do_name: f for f in self.fields}
+
     def get_id_field(self) -> _Field:
         return [f for f in self.fields if f.is_id][0]
 
     def mk_dict(self, obj: Any, is_do: bool) -> dict:
+        return self._do2db(obj) if is_do else self._db2do(obj)
+
+    def mk_do(self, dbo: Any) -> Any:
+        """Domain object built from a DB object, clean as it's just been loaded"""
+        do = self.do_class(**self._db2do(dbo))
+        do.mark_clean()
+        return do
+
+    def mk_update_dict(self, do: Any, do_names: set[str]) -> dict:
+        """The id and the DB values of the given fields of the domain object"""
+        d = {self.get_id_field().db_name: self.get_id(do)}
+        for name in do_names:
+            f = self._fields_by_do_name[name]
+            value = getattr(do, name)
+            d[f.db_name] = f.do2db(value) if f.do2db else value
+        return d
+
+    def mk_dict_reflective(self, obj: Any, is_do: bool) -> dict:
+        """Reference implementation of mk_dict(), used in tests"""
         d = {}
         for f in self.fields:
             from_field = f.do_name if is_do else f.db_name
@@ -144,6 +455,22 @@ class _Table:
             d[to_field] = value
         return d
 
+    def _compile(self, is_do: bool) -> Callable[[Any], dict]:
+        namespace: dict[str, Any] = {}
+        lines = ["def mk_dict(obj):", "    return {"]
+        for i, f in enumerate(self.fields):
+            from_field = f.do_name if is_do else f.db_name
+            to_field = f.db_name if is_do else f.do_name
+            conv = f.do2db if is_do else f.db2do
+            value = f"obj.{from_field}"
+            if conv:
+                namespace[f"conv{i}"] = conv
+                value = f"conv{i}({value})"
+            lines.append(f"        {to_field!r}: {value},")
+        lines.append("    }")
+        exec("\n".join(lines), namespace)
+        return namespace["mk_dict"]
+
 
 def parse_user_data(user_data: str) -> User:
     if len(user_data.split(",")) != 2:
@@ -152,55 +479,88 @@ def parse_user_data(user_data: str) -> User:
     return User(int(id), name)
 
 
+def _cents2dec(x: int) -> Decimal:  # 2 digits after dot
+    return fixed_point.to_decimal(x, AMOUNT_SCALE)
+
+
+def _dec2cents(x: Decimal) -> int:
+    return fixed_point.from_decimal(x, AMOUNT_SCALE)
+
+
+def _ten_thousandths2dec(x: int) -> Decimal:  # 4 digits after dot
+    return fixed_point.to_decimal(x, PRICE_SCALE)
+
+
+def _dec2ten_thousandths(x: Decimal) -> int:
+    return fixed_point.from_decimal(x, PRICE_SCALE)
+
+
 _ORDERS_TABLE = _Table(
     Order,
     _DbOrder,
     lambda o: o._id,
     [
         _Field("_id", "id", None, None, True),
-        _Field("type", "type", lambda x: int(x), lambda x: OrderType(x)),
+        _Field("type", "type", int, OrderType),
         _Field("lifetime_sec", "lifetime_sec"),
         _Field("creation_time", "creation_time"),
         _Field(
             "user",
             "user",
             lambda x: f"{x.id},{x.name}",
-            lambda x: parse_user_data(x),
+            parse_user_data,
         ),
         _Field(
             "price",
             "price_cents",
-            lambda x: int(x * 10000),
-            lambda x: (x / Decimal(10000.0)).quantize(Decimal("0.0001")),
+            _dec2ten_thousandths,
+            _ten_thousandths2dec,
         ),  # 4 digits after dot
         _Field(
             "amount_initial",
             "amount_initial_cents",
-            lambda x: int(x * 100),
-            lambda x: (x / Decimal(100.0)).quantize(Decimal("0.01")),
+            _dec2cents,
+            _cents2dec,
         ),
         _Field(
             "amount_left",
             "amount_left_cents",
-            lambda x: int(x * 100),
-            lambda x: (x / Decimal(100.0)).quantize(Decimal("0.01")),
+            _dec2cents,
+            _cents2dec,
         ),
         _Field(
             "min_op_threshold",
             "min_op_threshold_cents",
-            lambda x: int(x * 100),
-            lambda x: (x / Decimal(100.0)).quantize(Decimal("0.01")),
+            _dec2cents,
+            _cents2dec,
         ),
         _Field(
             "relative_rate",
             "relative_rate",
-            lambda x: int(x * 10000),
-            lambda x: (x / Decimal(10000.0)).quantize(Decimal("0.0001")),
+            _dec2ten_thousandths,
+            lambda x: _ten_thousandths2dec(round(x)),  # the column is not integer
         ),
     ],
 )
 
 
+def _count_calls(fn: Callable[[], Any]) -> int:
+    """The number of the Python and builtin function calls made by fn"""
+    calls = 0
+
+    def profile(frame, event, arg):
+        nonlocal calls
+        if event in ("call", "c_call"):
+            calls += 1
+
+    sys.setprofile(profile)
+    try:
+        fn()
+    finally:
+        sys.setprofile(None)
+    return calls
+
+
 class _T(unittest.TestCase):
     def setUp(self):
         self.db = SqlDb()
@@ -212,6 +572,17 @@ class _T(unittest.TestCase):
         o = self.db.store_order(o)
         self.assertEqual(OrderType.SELL, o.type)
 
+    def test_store_orders(self):
+        orders = self.db.store_orders(
+            [
+                Order(User(1, "Joe"), OrderType.SELL, 98.12345, 1299.0, 500.0),
+                Order(User(2, "Doe"), OrderType.BUY, 95.0, 1299.0, 500.0),
+            ]
+        )
+        self.assertEqual([1, 2], [o._id for o in orders])
+        self.assertEqual(Decimal("98.1234"), orders[0].price)
+        self.assertEqual(orders, [self.db.get_order(1), self.db.get_order(2)])
+
     def test_update(self):
         o = Order(
             User(1, "Dima"),
@@ -242,6 +613,31 @@ class _T(unittest.TestCase):
         self.db.iterate_orders(lambda o: orders.append(o))
         self.assertEqual(2, len(orders))
 
+    def test_iterate_not_expired(self):
+        now = 1_000_000
+        for i, lifetime_sec in enumerate([100, 50, 200, 10]):
+            self.db.store_order(
+                Order(
+                    User(i),
+                    OrderType.SELL,
+                    98.0,
+                    1299.0,
+                    500.0,
+                    lifetime_sec=lifetime_sec,
+                    creation_time=now - 60,
+                )
+            )
+        orders = []
+        with mock.patch("lib.db_sqla._ITERATE_CHUNK_SIZE", 2):
+            self.db.iterate_orders(orders.append, not_expired_at=now)
+        self.assertEqual([1, 3], [o._id for o in orders])
+        self.assertEqual(set(), orders[0].dirty_fields)
+
+        self.db.remove_expired_orders(now)
+        orders = []
+        self.db.iterate_orders(orders.append)
+        self.assertEqual([1, 3], [o._id for o in orders])
+
     def test_remove(self):
         self.db.store_order(
             Order(
@@ -258,6 +654,150 @@ class _T(unittest.TestCase):
         self.db.iterate_orders(lambda o: orders.append(o))
         self.assertEqual(1, len(orders))
 
+    def test_apply_changes(self):
+        o1 = self.db.store_order(Order(User(1), OrderType.SELL, 98.0, 1299.0, 500.0))
+        o2 = self.db.store_order(Order(User(2), OrderType.BUY, 99.0, 1299.0, 500.0))
+        o3 = self.db.store_order(Order(User(3), OrderType.BUY, 99.0, 1299.0, 500.0))
+        changes = OrderChanges(last_match_price=Decimal("98.5"))
+        o1.amount_left = Decimal(299)
+        changes.update(o1)
+        changes.update(o2)
+        changes.remove(o2._id)
+        changes.remove(o3._id)
+        self.db.apply_changes(changes)
+        orders = []
+        self.db.iterate_orders(lambda o: orders.append(o))
+        self.assertEqual([o1._id], [o._id for o in orders])
+        self.assertEqual(Decimal(299), orders[0].amount_left)
+        self.assertEqual(Decimal("98.5"), self.db.get_last_match_price())
+
+    def test_write_behind(self):
+        fd, path = tempfile.mkstemp(suffix=".sqlite")
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        db = SqlDb(f"sqlite:///{path}", write_behind_interval_sec=60)
+        o1 = db.store_order(Order(User(1), OrderType.SELL, 98.0, 1299.0, 500.0))
+        o2 = db.store_order(Order(User(2), OrderType.BUY, 95.0, 1299.0, 500.0))
+        for amount_left in (1000, 900, 800):
+            o1.amount_left = Decimal(amount_left)
+            db.update_order(o1)
+        db.remove_order(o2._id)
+        db.store_last_match_price(Decimal("96.5"))
+
+        with mock.patch.object(db, "_update_many", wraps=db._update_many) as update:
+            other = SqlDb(f"sqlite:///{path}")
+            self.assertEqual(Decimal(1299), other.get_order(o1._id).amount_left)
+            self.assertIsNone(other.get_last_match_price())
+            db.flush()
+            update.assert_called_once()
+        self.assertEqual(Decimal(800), other.get_order(o1._id).amount_left)
+        self.assertEqual(Decimal("96.5"), other.get_last_match_price())
+        orders = []
+        other.iterate_orders(orders.append)
+        self.assertEqual(1, len(orders))
+
+        o1.amount_left = Decimal(700)
+        db.update_order(o1)
+        db.close()
+        self.assertEqual(Decimal(700), other.get_order(o1._id).amount_left)
+
+    def test_compiled_mapping(self):
+        o = self.db.store_order(
+            Order(User(1, "Joe"), OrderType.SELL, 98.1234, 1299.5, 500.0)
+        )
+        with Session(self.db.engine) as session:
+            dbo = session.get(_DbOrder, o._id)
+            for obj, is_do in ((o, True), (dbo, False)):
+                compiled = _ORDERS_TABLE.mk_dict(obj, is_do)
+                reflective = _ORDERS_TABLE.mk_dict_reflective(obj, is_do)
+                self.assertEqual(reflective, compiled)
+                self.assertEqual(str(reflective), str(compiled))
+
+            def bench(mk_dict):
+                def round_trip():
+                    mk_dict(o, True)
+                    mk_dict(dbo, False)
+
+                return min(timeit.repeat(round_trip, number=2000, repeat=7))
+
+            # wall-clock timings are too noisy on CI, the calls made are asserted
+            logging.info(
+                "mk_dict: compiled %.4fs, reflective %.4fs",
+                bench(_ORDERS_TABLE.mk_dict),
+                bench(_ORDERS_TABLE.mk_dict_reflective),
+            )
+            for obj, is_do in ((o, True), (dbo, False)):
+                compiled = _count_calls(lambda: _ORDERS_TABLE.mk_dict(obj, is_do))
+                reflective = _count_calls(
+                    lambda: _ORDERS_TABLE.mk_dict_reflective(obj, is_do)
+                )
+                # no getattr() per field
+                self.assertLessEqual(compiled, reflective - 5)
+
+    def test_in_memory_connection_taken_in_turns(self):
+        stored = threading.Event()
+
+        def store():
+            self.db.store_order(Order(User(1), OrderType.SELL, 98.0, 1299.0, 500.0))
+            stored.set()
+
+        with self.db.engine.connect() as conn:
+            conn.execute(insert(_DbLastMatchPrice).values(id=1, price=1))
+            t = threading.Thread(target=store)
+            t.start()
+            self.assertFalse(stored.wait(0.2))  # not within this transaction
+            conn.rollback()
+        t.join()
+        self.assertTrue(stored.is_set())
+        self.assertIsNone(self.db.get_last_match_price())
+
+    def test_update_writes_dirty_fields_only(self):
+        o = self.db.store_order(Order(User(1), OrderType.SELL, 98.0, 1299.0, 500.0))
+        self.assertEqual(set(), o.dirty_fields)
+        o.amount_left = Decimal("299.5")
+        statements = []
+        event.listen(
+            self.db.engine,
+            "before_cursor_execute",
+            lambda conn, cursor, statement, *args: statements.append(statement),
+        )
+        self.db.update_order(o)
+        self.assertEqual(1, len(statements))
+        self.assertRegex(
+            statements[0], r"^UPDATE orders SET amount_left_cents=\S+ WHERE orders.id"
+        )
+        self.assertEqual(set(), o.dirty_fields)
+        self.assertEqual(Decimal("299.5"), self.db.get_order(o._id).amount_left)
+
+    def test_order_changes_log(self):
+        self.assertRaises(RuntimeError, self.db.get_order_changes_seq)
+        db = SqlDb(log_order_changes=True)
+        o1, o2, o3 = db.store_orders(
+            [Order(User(i), OrderType.SELL, 98.0, 1299.0, 500.0) for i in range(3)]
+        )
+        seq = db.get_order_changes_seq()
+        self.assertEqual((seq, {}), db.get_orders_changed_since(seq))
+
+        o1.amount_left = Decimal(299)
+        changes = OrderChanges()
+        changes.update(o1)
+        changes.update(o3)  # nothing is dirty
+        changes.remove(o2._id)
+        db.apply_changes(changes)
+        o4 = db.store_order(Order(User(4), OrderType.BUY, 95.0, 1299.0, 500.0))
+        latest_seq, changed = db.get_orders_changed_since(seq)
+        self.assertEqual(db.get_order_changes_seq(), latest_seq)
+        self.assertEqual({o1._id: o1, o2._id: None, o4._id: o4}, changed)
+        self.assertEqual(set(), changed[o1._id].dirty_fields)
+
+        db.prune_order_changes(latest_seq)
+        self.assertEqual(latest_seq, db.get_order_changes_seq())
+        self.assertEqual((latest_seq, {}), db.get_orders_changed_since(latest_seq))
+        # pruned, or ahead of the log
+        self.assertRaises(ValueError, db.get_orders_changed_since, seq)
+        self.assertRaises(ValueError, db.get_orders_changed_since, latest_seq + 1)
+        self.assertEqual((3, o4._id), db.get_orders_count_and_max_id())
+
     def test_store_and_get_last_match_price(self):
         self.db.store_last_match_price(Decimal("120.50"))
         last_price = self.db.get_last_match_price()
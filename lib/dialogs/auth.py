@@ -11,6 +11,13 @@ from lib.dialogs.base import ExchgController
 from lib.dialogs.place_order import CreateOrder
 from lib.rep_sys.rep_sys import RepSysUserId
 from lib.rep_sys.email_auth import EmlAuthState, TooManyAttemptsOrExpiredError
+from lib.comms.email_outbox import DeliveryStatus
+
+_DELIVERY_STATUS_TEXT = {
+    DeliveryStatus.SENDING: "Отправляем код на почту…",
+    DeliveryStatus.SENT: "Код отправлен на почту.",
+    DeliveryStatus.FAILED: "Не удалось отправить код, попробуйте отправить заново.",
+}
 
 
 class AuthMain(ExchgController):
@@ -92,6 +99,14 @@ class AuthEnterCode(ExchgController):
             ],
         )
 
+    def render(self) -> OutMessage:
+        assert self.session.email_auth
+        status = self.session.email_auth.delivery_status
+        self.text = "Введите код:"
+        if status is not None:
+            self.text = f"{_DELIVERY_STATUS_TEXT[status]}\n{self.text}"
+        return super().render()
+
     def process_event(self, e: Event) -> OutMessage:
         if isinstance(e, ButtonAction):
             if e.name == "cancel":
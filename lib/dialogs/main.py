@@ -149,9 +149,7 @@ class Statistics(ExchgController):
     def render(self) -> OutMessage:
         m = super().render()
         # FIXME: should go somewhere in application
-        ex = self.session.exchange
-        ex._check_order_lifetime()  # FIXME: should be removed
-        text = ex.get_stats()["text"]
+        text = self.session.exchange.get_stats()["text"]
         m.text = text
         return m
 
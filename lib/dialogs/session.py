@@ -4,6 +4,7 @@ from lib.application_base import ApplicationBase
 from lib.exchange import Exchange
 from lib.rep_sys import ReputationSystem
 from lib.rep_sys.email_auth import EmailAuthenticator
+from lib.rep_sys.rep_id import RepSysUserId
 
 
 # FIXME: should go to the framework level
@@ -15,3 +16,18 @@ class Session:
     exchange: Exchange
     rep_sys: ReputationSystem
     email_auth: Optional[EmailAuthenticator] = None
+
+    def __getstate__(self):
+        # the authenticator is shared with the app, see get_email_authenticator()
+        state = self.__dict__.copy()
+        state["email_auth"] = self.email_auth is not None
+        return state
+
+    def __setstate__(self, state):
+        has_email_auth = state.pop("email_auth")
+        self.__dict__.update(state)
+        self.email_auth = (
+            self.app.get_email_authenticator(RepSysUserId(self.user_id))
+            if has_email_auth
+            else None
+        )
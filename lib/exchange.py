@@ -1,178 +1,800 @@
-from typing import List, Tuple
+from typing import Callable, Iterator
+from collections.abc import Mapping
+import bisect
+import concurrent.futures
+import contextlib
+import functools
+import heapq
 import logging
+import queue
+import threading
 import time
-import dataclasses
 import unittest
 import pickle
 from decimal import Decimal
-from .db import Db
-from .config import ORDER_LIFETIME_LIMIT
-from . import data
-from .currency_rates import CurrencyConverter
+from .db import Db, OrderChanges
+from .config import ORDER_LIFETIME_LIMIT, EXPIRY_CHECK_PERIOD_SEC, SNAPSHOT_PERIOD_SEC
+from . import data, fixed_point, snapshot
+from .fixed_point import AMOUNT_SCALE, PRICE_SCALE
+from .currency_rates import CurrencyConverter, RepeatTimer
+
+
+class _BookSide:
+    """
+    One side of the order book: orders grouped into price levels, best level first.
+
+    Levels are kept in a sorted list of keys (price for sellers, -price for buyers),
+    orders inside a level are kept in time priority: (creation_time, id).
+    The total amount left of the side's orders is maintained along the way.
+    """
+
+    def __init__(self, best_is_highest: bool):
+        self._sign = -1 if best_is_highest else 1
+        self._level_keys: list[int] = []
+        self._levels: dict[int, list[tuple[int, int]]] = {}
+        self._entries: dict[int, tuple[int, tuple[int, int]]] = {}
+        self._orders: dict[int, data.CompactOrder] = {}
+        self.total_amount_cents = 0
+
+    def __len__(self) -> int:
+        return len(self._orders)
+
+    @property
+    def total_amount(self) -> Decimal:
+        return fixed_point.to_decimal(self.total_amount_cents, AMOUNT_SCALE)
+
+    def add(self, o: data.CompactOrder) -> None:
+        key = self._sign * o.price_cents
+        pos = (o.creation_time, o._id)
+        level = self._levels.get(key)
+        if level is None:
+            level = self._levels[key] = []
+            bisect.insort(self._level_keys, key)
+        bisect.insort(level, pos)
+        self._entries[o._id] = (key, pos)
+        self._orders[o._id] = o
+        self.total_amount_cents += o.amount_left_cents
+
+    def remove(self, _id: int) -> None:
+        key, pos = self._entries.pop(_id)
+        o = self._orders.pop(_id)
+        self.total_amount_cents -= o.amount_left_cents
+        level = self._levels[key]
+        del level[bisect.bisect_left(level, pos)]
+        if not level:
+            del self._levels[key]
+            del self._level_keys[bisect.bisect_left(self._level_keys, key)]
+
+    def best(self) -> data.CompactOrder | None:
+        if not self._level_keys:
+            return None
+        _, _id = self._levels[self._level_keys[0]][0]
+        return self._orders[_id]
+
+    def __iter__(self) -> Iterator[data.CompactOrder]:
+        """
+        Iterate over the orders best first.
+
+        Orders may be removed from the side while iterating (e.g. when they are filled),
+        removed orders are skipped.
+        """
+        key = None
+        while True:
+            i = 0 if key is None else bisect.bisect_right(self._level_keys, key)
+            if i >= len(self._level_keys):
+                return
+            key = self._level_keys[i]
+            for _, _id in list(self._levels[key]):
+                o = self._orders.get(_id)
+                if o is not None:
+                    yield o
+
+
+class OrderBook(Mapping[int, data.CompactOrder]):
+    """
+    In-memory order book: a mapping from order id to order with price-time priority sides.
+
+    Orders are kept as data.CompactOrder, with the User objects interned by user id.
+    Price and amount of an order must not be changed in place while it is in the book,
+    use reprice() and fill() instead.
+    The version is bumped on every change, so derived data (e.g. statistics) can be cached.
+    """
+
+    def __init__(self):
+        self._by_id: dict[int, data.CompactOrder] = {}
+        self._sides = {
+            data.OrderType.SELL: _BookSide(best_is_highest=False),
+            data.OrderType.BUY: _BookSide(best_is_highest=True),
+        }
+        # min-heap of (expiration time, id); entries of removed orders are dropped lazily
+        self._expiry: list[tuple[int, int]] = []
+        self._relative: dict[int, data.CompactOrder] = {}
+        self._by_user: dict[int, dict[int, data.CompactOrder]] = {}
+        self._users: dict[int, data.User] = {}
+        self._touched_users: set[int] = set()
+        self.version = 0
+
+    def __getitem__(self, _id: int) -> data.CompactOrder:
+        return self._by_id[_id]
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._by_id)
+
+    def __len__(self) -> int:
+        return len(self._by_id)
+
+    @property
+    def sellers(self) -> _BookSide:
+        return self._sides[data.OrderType.SELL]
+
+    @property
+    def buyers(self) -> _BookSide:
+        return self._sides[data.OrderType.BUY]
+
+    @property
+    def relative(self) -> list[data.CompactOrder]:
+        """Orders with a price relative to the exchange rate"""
+        return list(self._relative.values())
+
+    @property
+    def user_cnt(self) -> int:
+        return len(self._by_user)
+
+    def orders_for_user(self, user_id: int) -> list[data.CompactOrder]:
+        return list(self._by_user.get(user_id, {}).values())
+
+    def get_for_user(self, user_id: int, _id: int) -> data.CompactOrder | None:
+        return self._by_user.get(user_id, {}).get(_id)
+
+    def pop_touched_users(self) -> set[int]:
+        """Ids of the users whose orders were added, removed or changed since the last call"""
+        touched, self._touched_users = self._touched_users, set()
+        return touched
+
+    def add(self, order: data.Order) -> data.CompactOrder:
+        o = self._index(order)
+        self._sides[o.type].add(o)
+        heapq.heappush(self._expiry, (o.expiration_time, o._id))
+        self.version += 1
+        return o
+
+    def remove(self, _id: int) -> data.CompactOrder:
+        o = self._unindex(_id)
+        self._sides[o.type].remove(_id)
+        self.version += 1
+        if len(self._expiry) > 2 * len(self._by_id) + 64:
+            self._expiry = [e for e in self._expiry if e[1] in self._by_id]
+            heapq.heapify(self._expiry)
+        return o
+
+    def pop_expired(self, now: float) -> list[data.CompactOrder]:
+        """
+        Pop the orders whose lifetime is over from the expiry index.
+
+        The orders stay in the book, it's up to the caller to remove them.
+        """
+        expired = []
+        while self._expiry and self._expiry[0][0] < now:
+            expiration_time, _id = heapq.heappop(self._expiry)
+            o = self._by_id.get(_id)
+            if o is not None and o.expiration_time == expiration_time:
+                expired.append(o)
+        return expired
+
+    def reprice(self, o: data.CompactOrder, price_cents: int) -> None:
+        side = self._sides[o.type]
+        side.remove(o._id)
+        o.price_cents = price_cents
+        side.add(o)
+        self._touched_users.add(o.user.id)
+        self.version += 1
+
+    def reprice_relative(self, rate: Decimal) -> list[data.CompactOrder]:
+        """
+        Set the prices of the relative-rate orders to rate * relative_rate.
+
+        Returns:
+            list[data.CompactOrder]: the orders whose prices have changed.
+        """
+        ratio = rate.as_integer_ratio()
+        moved = []
+        for o in self.relative:
+            price_cents = fixed_point.mul_half_even(o.relative_rate_cents, ratio)
+            if o.price_cents != price_cents:
+                self.reprice(o, price_cents)
+                moved.append(o)
+        return moved
+
+    def fill(self, o: data.CompactOrder, amount_cents: int) -> None:
+        o.amount_left_cents -= amount_cents
+        self._sides[o.type].total_amount_cents -= amount_cents
+        self._touched_users.add(o.user.id)
+        self.version += 1
+
+    def _index(self, order: data.Order) -> data.CompactOrder:
+        """Add the order to the lookups by id, by user and of relative orders"""
+        if order._id is None:
+            raise ValueError("Order ID is None")
+        o = data.CompactOrder.from_order(order, self._users)
+        self._by_id[o._id] = o
+        if o.is_relative:
+            self._relative[o._id] = o
+        self._by_user.setdefault(o.user.id, {})[o._id] = o
+        self._touched_users.add(o.user.id)
+        return o
+
+    def _unindex(self, _id: int) -> data.CompactOrder:
+        o = self._by_id.pop(_id)
+        self._relative.pop(_id, None)
+        user_orders = self._by_user[o.user.id]
+        del user_orders[_id]
+        if not user_orders:
+            del self._by_user[o.user.id]
+            del self._users[o.user.id]
+        self._touched_users.add(o.user.id)
+        return o
+
+
+class _Writer:
+    """
+    Single thread running the commands submitted from any thread, one at a time.
+
+    A command submitted from the writer thread itself runs right away, so commands
+    can call each other.
+    """
+
+    def __init__(self, name: str, after_command: Callable[[], None]):
+        self._after_command = after_command
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._closed = False
+        self._closing = threading.Lock()  # no command is queued after the stop
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    @property
+    def is_current(self) -> bool:
+        return threading.current_thread() is self._thread
+
+    def call(self, fn: Callable):
+        if self.is_current:
+            return fn()
+        future: concurrent.futures.Future = concurrent.futures.Future()
+        with self._closing:
+            if self._closed:
+                raise RuntimeError("The writer is closed")
+            self._queue.put((fn, future))
+        return future.result()
+
+    def close(self) -> None:
+        """Run the queued commands and stop, the later ones are rejected"""
+        if self.is_current:
+            raise RuntimeError("The writer can't close itself")
+        with self._closing:
+            if not self._closed:
+                self._closed = True
+                self._queue.put(None)
+        self._thread.join()
+
+    def _run(self) -> None:
+        while (item := self._queue.get()) is not None:
+            fn, future = item
+            try:
+                res = fn()
+            except BaseException as e:
+                self._publish()
+                future.set_exception(e)
+            else:
+                self._publish()  # before the caller gets the result: read your writes
+                future.set_result(res)
+
+    def _publish(self) -> None:
+        try:
+            self._after_command()
+        except Exception:
+            logging.exception("Failed to publish the command results")
+
+
+def _command(method):
+    """
+    Run the Exchange method on its writer thread, see _Writer.
+
+    The matches committed by the command are reported to on_match afterwards,
+    in the calling thread, so slow callbacks don't hold up the writer.
+    """
+
+    @functools.wraps(method)
+    def wrapper(self: "Exchange", *args, **kwargs):
+        if self._writer.is_current:
+            return method(self, *args, **kwargs)  # a part of the running command
+        res, matches = self._writer.call(
+            functools.partial(self._run_command, method, *args, **kwargs)
+        )
+        if self._on_match:
+            for m in matches:
+                self._on_match(m)
+        return res
+
+    return wrapper
 
 
 class Exchange:
+    """
+    The order book with matching, backed by the DB.
+
+    All the mutations (placing, removing, repricing, expiry) run one at a time
+    on a single writer thread, so the exchange may be used from any thread.
+    Read-only queries don't wait for the writer: they are served from immutable
+    snapshots of the users' orders and of the statistics, published after every
+    command.
+    """
+
     # FIXME: isn't it better not to store any orders in memory and go through the db on every event instead?
 
-    def __init__(self, db: Db, currency_client, on_match=None):
+    def __init__(
+        self,
+        db: Db,
+        currency_client,
+        on_match=None,
+        snapshot_path: str | None = None,
+        columnar_book: bool = False,
+    ):
+        """
+        Args:
+            snapshot_path: if set, the book is loaded from this snapshot file and
+                only the orders changed since it are read from the DB, see
+                write_snapshot(). The DB must log the order changes. The book is
+                loaded from the DB as usual if the snapshot doesn't match it.
+            columnar_book: keep the book in NumPy arrays, see columnar_book.py.
+                Gives the same results, needs numpy installed.
+        """
         self._db = db
+        self._snapshot_path = snapshot_path
         self._on_match = on_match
-        orders: List[Tuple[int, data.Order]] = []
+        # (book version, stats), replaced as a whole
+        self._stats: tuple[int, dict] | None = None
+        self._user_orders: dict[int, tuple[data.Order, ...]] = {}
+        self._writer = _Writer("exchange-writer", self._publish)
+        self._changes: OrderChanges | None = (
+            None  # DB side effects of the current operation
+        )
+        self._pending_matches: list[data.Match] = []
+        # orders whose min_op_threshold went down since they were matched last
+        self._lowered_thresholds: list[data.CompactOrder] = []
+        self._committed_matches: list[data.Match] = []  # to be reported
+        self._timers: list[RepeatTimer] = []
+        if columnar_book:
+            from .columnar_book import ColumnarOrderBook
+
+            self._orders: OrderBook = ColumnarOrderBook()
+        else:
+            self._orders = OrderBook()
+        self.currency_rate: dict | None = None
+        snap = self._read_snapshot()
+        if snap is None or not self._warm_start(snap):
+            now = time.time()
+            self._db.iterate_orders(self._orders.add, not_expired_at=now)
+            self._db.remove_expired_orders(now)
+            self.last_match_price = self._db.get_last_match_price()
 
-        def add(o: data.Order):
-            if o._id is None:
-                raise ValueError("Order ID is None")
-            orders.append((o._id, o))
+        self.currency_converter = currency_client
+        # prices of the stored orders may be stale, the rate could change while we were down
+        self.on_rates_updated()
+        self.currency_converter.subscribe(self.on_rates_updated)
 
-        self._db.iterate_orders(add)
-        self._orders: dict[int, data.Order] = dict(orders)
-        self.last_match_price = self._db.get_last_match_price()
+    def place_order(self, o: data.Order) -> list[data.Match]:
+        """
+        Place an order and match it against the book.
 
-        self.currency_converter = currency_client
-        self.currency_rate = self.currency_converter.get_rate("RUB", "AMD")
+        The book is fully matched before the order arrives, so only the incoming order
+        can produce new matches, and then the orders whose min_op_threshold its fills
+        lowered. Relative-rate orders are repriced on rate updates only.
 
-    def place_order(self, o: data.Order) -> None:
+        Returns:
+            list[data.Match]: the fills produced by the placement.
+        """
         logging.info(f"place_order: {o}")
         if o.lifetime_sec > ORDER_LIFETIME_LIMIT:
             raise ValueError(
                 f"Order lifetime cannot exceed {int(ORDER_LIFETIME_LIMIT/3600)} hours"
             )
 
+        return self._place_order(o)
+
+    @_command
+    def _place_order(self, o: data.Order) -> list[data.Match]:
+        if o.relative_rate != -1.0:
+            # FIXME: workaround to not to force clients to calculate prices
+            o.price = self._relative_price(o)
         o = self._db.store_order(o)
-        self._update_prices()  # FIXME: workaround to not to force clients to calculate prices
-        if o._id is None:
-            raise ValueError("Order ID is None")
-        self._orders[o._id] = o
-        self._check_order_lifetime()  # Removing expired orders
-        self._process_matches()
+        with self._transaction():
+            book_order = self._orders.add(o)
+            self._check_order_lifetime()  # Removing expired orders
+            if o._id not in self._orders:
+                return []  # expired right away
+            fills = self._match_order(book_order)
+            return fills + self._rematch_lowered_thresholds()
+
+    @_command
+    def on_rates_updated(self) -> list[data.Match]:
+        """
+        Reprice relative-rate orders according to the current exchange rate and match the whole book.
+
+        Called by the currency client when it gets new rates.
+
+        Returns:
+            list[data.Match]: the fills produced by the repricing.
+        """
+        try:
+            self.currency_rate = self.currency_converter.get_rate("RUB", "AMD")
+        except Exception:
+            if self.currency_rate is None:
+                raise
+            logging.exception("Failed to get the rate, using the last known one")
+        self._stats = None
+        with self._transaction():
+            self._update_prices()
+            fills = self._process_matches()
+            return fills + self._rematch_lowered_thresholds()
+
+    def schedule_expiry_check(
+        self, period_sec: float = EXPIRY_CHECK_PERIOD_SEC
+    ) -> RepeatTimer:
+        """
+        Remove expired orders in the background, so they leave the book on time
+        instead of waiting for the next user action.
+        """
+        timer = RepeatTimer(period_sec, self._expiry_check_job)
+        timer.daemon = True
+        timer.start()
+        self._timers.append(timer)
+        return timer
+
+    def _expiry_check_job(self) -> None:
+        try:
+            self._check_order_lifetime()
+        except Exception:
+            logging.exception("Failed to remove expired orders")
+
+    def write_snapshot(self) -> None:
+        """
+        Write the book, the last match price and the rate to the snapshot file.
+
+        The snapshot is tagged with the DB's order changes sequence number, the older
+        logged changes aren't needed anymore and are pruned.
+        """
+        assert self._snapshot_path is not None
+        seq, b = self._dump_snapshot()
+        snapshot.write_bytes(self._snapshot_path, b)
+        self._db.prune_order_changes(seq)
+        logging.info(f"Snapshot of {len(self._orders)} orders written, seq {seq}")
+
+    @_command
+    def _dump_snapshot(self) -> tuple[int, bytes]:
+        self._db.flush()  # the book must not be ahead of the DB
+        seq = self._db.get_order_changes_seq()
+        b = snapshot.dumps(
+            snapshot.BookSnapshot(
+                seq,
+                [o.to_order() for o in self._orders.values()],
+                self.last_match_price,
+                self.currency_rate,
+            )
+        )
+        return seq, b
+
+    def schedule_snapshot(self, period_sec: float = SNAPSHOT_PERIOD_SEC) -> RepeatTimer:
+        timer = RepeatTimer(period_sec, self._snapshot_job)
+        timer.daemon = True
+        timer.start()
+        self._timers.append(timer)
+        return timer
+
+    def _snapshot_job(self) -> None:
+        try:
+            self.write_snapshot()
+        except Exception:
+            logging.exception("Failed to write the snapshot")
+
+    def _read_snapshot(self) -> snapshot.BookSnapshot | None:
+        if self._snapshot_path is None:
+            return None
+        try:
+            return snapshot.read(self._snapshot_path)
+        except FileNotFoundError:
+            logging.info("No snapshot, loading the book from the DB")
+        except ValueError:
+            logging.exception("Broken snapshot, loading the book from the DB")
+        return None
+
+    def _warm_start(self, snap: snapshot.BookSnapshot) -> bool:
+        """
+        Load the book from the snapshot and replay the changes made after it.
+
+        The result is checked against the DB first: the change log must cover the
+        snapshot, and the book must have the DB's number of orders and greatest id,
+        which catches changes made bypassing the log.
+
+        Returns:
+            bool: False if the snapshot doesn't fit the DB, the book is left empty then.
+        """
+        try:
+            _, changed = self._db.get_orders_changed_since(snap.changes_seq)
+        except ValueError:
+            logging.exception("Stale snapshot, loading the book from the DB")
+            return False
+        ids = {o._id for o in snap.orders} - changed.keys()
+        ids.update(_id for _id, o in changed.items() if o is not None)
+        expected = (len(ids), max(ids, default=0))
+        in_db = self._db.get_orders_count_and_max_id()
+        if expected != in_db:
+            logging.warning(
+                f"Snapshot doesn't match the DB (orders, max id): {expected} != {in_db}, "
+                "loading the book from the DB"
+            )
+            return False
+
+        for o in snap.orders:
+            if o._id not in changed:
+                self._orders.add(o)
+        for o in changed.values():
+            if o is not None:
+                self._orders.add(o)
+        logging.info(
+            f"Loaded {len(snap.orders)} orders from the snapshot, {len(changed)} changed since"
+        )
+        # a match always changes orders, so the price is only stale if some changed
+        self.last_match_price = (
+            self._db.get_last_match_price() if changed else snap.last_match_price
+        )
+        self.currency_rate = snap.currency_rate
+        self._check_order_lifetime()
+        return True
 
     def list_orders_for_user(self, user: data.User) -> list[data.Order]:
-        return [o for o in self._orders.values() if o.user.id == user.id]
+        """The user's orders as of the last command, they must not be modified"""
+        return list(self._user_orders.get(user.id, ()))
+
+    def get_user_order(self, user: data.User, _id: int) -> data.Order | None:
+        """Get the order if it exists and belongs to the user"""
+        for o in self._user_orders.get(user.id, ()):
+            if o._id == _id:
+                return o
+        return None
+
+    def _publish(self) -> None:
+        """Publish the orders of the users touched by the last command and the stats"""
+        for user_id in self._orders.pop_touched_users():
+            orders = tuple(o.to_order() for o in self._orders.orders_for_user(user_id))
+            if orders:
+                self._user_orders[user_id] = orders
+            else:
+                self._user_orders.pop(user_id, None)
+        if self._stats is None or self._stats[0] != self._orders.version:
+            self._stats = (self._orders.version, self._render_stats())
+
+    def _run_command(self, method, *args, **kwargs) -> tuple:
+        """Run the command on the writer thread, returns its result and the matches to report"""
+        res = method(self, *args, **kwargs)
+        # if the command fails, its committed matches are reported with the next one
+        matches, self._committed_matches = self._committed_matches, []
+        return res, matches
+
+    def close(self) -> None:
+        """Stop the scheduled jobs and the writer, the commands already submitted are run first"""
+        for timer in self._timers:
+            timer.cancel()
+        self._writer.close()
 
     def get_rate(self, from_currency: str, to_currency: str):
         return self.currency_converter.get_rate(from_currency, to_currency)
 
+    @_command
     def _check_order_lifetime(self) -> None:
         """
         Check the lifetime of orders and remove expired orders.
 
-        This method iterates through all the orders in the exchange and checks if their lifetime has exceeded.
-        If an order's lifetime has exceeded, it is removed from the exchange.
+        Orders are popped from the book's expiry index, so only the orders which have
+        actually expired are visited.
 
         Returns:
             None
         """
-        current_time = time.time()
-        expired_orders = [
-            o
-            for o in self._orders.values()
-            if (current_time - o.creation_time) > o.lifetime_sec
-        ]
-        for o in expired_orders:
-            if o._id is None:
-                continue
-            self.remove_order(o._id)
+        with self._transaction():
+            for o in self._orders.pop_expired(time.time()):
+                assert o._id is not None
+                self.remove_order(o._id)
 
-    def _update_prices(self) -> None:
+    def _update_prices(self) -> list[data.CompactOrder]:
         """
-        Update the prices of the orders in the exchange.
+        Update the prices of the relative-rate orders in the exchange.
 
-        This method iterates through all the orders in the exchange and updates their prices.
         The prices are updated according to the current exchange rate.
 
         Returns:
-            None
+            list[data.CompactOrder]: the orders whose prices have changed.
         """
-        self.currency_rate = self.currency_converter.get_rate("RUB", "AMD")
-        for order in self._orders.values():
+        moved = self._orders.reprice_relative(self.currency_rate["rate"])
+        for order in moved:
+            self._db_changes.update(order.to_order(dirty={"price"}))
+        return moved
+
+    def _relative_price(self, o: data.Order) -> Decimal:
+        # as OrderBook.reprice_relative() does, so a reprice at the same rate is a no-op
+        price_cents = fixed_point.mul_half_even(
+            fixed_point.from_decimal(o.relative_rate, PRICE_SCALE),
+            self.currency_rate["rate"].as_integer_ratio(),
+        )
+        return fixed_point.to_decimal(price_cents, PRICE_SCALE)
+
+    def _match_order(self, o: data.CompactOrder) -> list[data.Match]:
+        """
+        Match a single order against the opposite side of the book, best level first.
+
+        Returns:
+            list[data.Match]: the fills of the order.
+        """
+        fills = []
+        is_sell = o.type == data.OrderType.SELL
+        opposite = self._orders.buyers if is_sell else self._orders.sellers
+        for other in opposite:
+            seller, buyer = (o, other) if is_sell else (other, o)
+            if buyer.price_cents < seller.price_cents:
+                break
             if (
-                order.relative_rate != -1.0
-                and order.price != self.currency_rate["rate"] * order.relative_rate
+                seller.amount_left_cents >= buyer.min_op_threshold_cents
+                and buyer.amount_left_cents >= seller.min_op_threshold_cents
             ):
-                order.price = Decimal(
-                    self.currency_rate["rate"] * order.relative_rate
-                ).quantize(Decimal("0.0001"))
-                self._db.update_order(order)
+                fills.append(self._match(seller, buyer))
+                if o.amount_left_cents <= 0:
+                    break
+        return fills
 
-    def _process_matches(self) -> None:
-        self._update_prices()
+    def _rematch_lowered_thresholds(self) -> list[data.Match]:
+        """
+        Match again the orders whose min_op_threshold was lowered by a partial fill.
 
-        sellers = sorted(
-            [o for o in self._orders.values() if o.type == data.OrderType.SELL],
-            key=lambda x: x.price,
-        )
-        buyers = sorted(
-            [o for o in self._orders.values() if o.type == data.OrderType.BUY],
-            key=lambda x: -x.price,
-        )
+        A lower threshold may let an order match counterparties it has skipped, resting
+        ones included, so this goes on until no threshold changes.
 
-        logging.debug(f"S: {sellers}\nB: {buyers}\n")
+        Returns:
+            list[data.Match]: the fills produced.
+        """
+        fills = []
+        while self._lowered_thresholds:
+            o = self._lowered_thresholds.pop()
+            if o._id in self._orders:
+                fills += self._match_order(o)
+        return fills
+
+    def _process_matches(self) -> list[data.Match]:
+        """
+        Match crossing orders of the whole book.
 
+        Sellers are walked from the cheapest one, and each seller is only tried against buyers
+        whose price crosses it, so an uncrossed book costs O(1) to check.
+
+        Returns:
+            list[data.Match]: the fills produced by the sweep.
+        """
+        fills = []
+        sellers = self._orders.sellers
+        buyers = self._orders.buyers
         for seller in sellers:
+            best_buyer = buyers.best()
+            if best_buyer is None or best_buyer.price_cents < seller.price_cents:
+                break  # no buyer crosses this seller, nor any of the more expensive ones
             for buyer in buyers:
+                if buyer.price_cents < seller.price_cents:
+                    break
                 if (
-                    buyer.price >= seller.price
-                    and seller.amount_left >= buyer.min_op_threshold
-                    and buyer.amount_left >= seller.min_op_threshold
+                    seller.amount_left_cents >= buyer.min_op_threshold_cents
+                    and buyer.amount_left_cents >= seller.min_op_threshold_cents
                 ):
-                    match_amount = min(buyer.amount_left, seller.amount_left)
-                    mid_price = round((seller.price + buyer.price) / 2, 4)
-                    seller.amount_left -= match_amount
-                    buyer.amount_left -= match_amount
-                    self._db.update_order(seller)
-                    self._db.update_order(buyer)
-
-                    self.last_match_price = mid_price
-                    self._db.store_last_match_price(mid_price)
-
-                    match = data.Match(
-                        dataclasses.replace(seller),
-                        dataclasses.replace(buyer),
-                        mid_price,
-                        match_amount,
-                    )
-
-                    logging.debug(f"match: {match}")
-                    if self._on_match:
-                        self._on_match(match)
-
-                    # Remove order if amount_left is less than or equal to 0
-                    if seller.amount_left <= 0:
-                        assert seller._id is not None
-                        self.remove_order(seller._id)
-                    else:
-                        seller.min_op_threshold = min(
-                            seller.amount_left, seller.min_op_threshold
-                        )
-
-                    if buyer.amount_left <= 0:
-                        assert buyer._id is not None
-                        self.remove_order(buyer._id)
-                    else:
-                        buyer.min_op_threshold = min(
-                            buyer.amount_left, buyer.min_op_threshold
-                        )
-
+                    fills.append(self._match(seller, buyer))
                     # If the seller's amount_left is less than or equal to 0, move on to the next seller
-                    if seller.amount_left <= 0:  # or buyer.amount_left <= 0:
+                    if seller.amount_left_cents <= 0:
                         break
+        return fills
+
+    def _match(self, seller: data.CompactOrder, buyer: data.CompactOrder) -> data.Match:
+        match_amount_cents = min(buyer.amount_left_cents, seller.amount_left_cents)
+        mid_price = fixed_point.to_decimal(
+            fixed_point.mid_half_even(seller.price_cents, buyer.price_cents),
+            PRICE_SCALE,
+        )
+        self._orders.fill(seller, match_amount_cents)
+        self._orders.fill(buyer, match_amount_cents)
+
+        self.last_match_price = mid_price
+        self._db_changes.last_match_price = mid_price
 
+        match = data.Match(
+            seller.to_order(),
+            buyer.to_order(),
+            mid_price,
+            fixed_point.to_decimal(match_amount_cents, AMOUNT_SCALE),
+        )
+
+        logging.debug(f"match: {match}")
+        self._pending_matches.append(match)  # reported once the changes are committed
+
+        # Remove order if amount_left is less than or equal to 0
+        for o in (seller, buyer):
+            if o.amount_left_cents <= 0:
+                self.remove_order(o._id)
+            else:
+                if o.amount_left_cents < o.min_op_threshold_cents:
+                    o.min_op_threshold_cents = o.amount_left_cents
+                    self._lowered_thresholds.append(o)
+                self._db_changes.update(
+                    o.to_order(dirty={"amount_left", "min_op_threshold"})
+                )
+        return match
+
+    @_command
     def remove_order(self, _id: int) -> None:
-        del self._orders[_id]
-        self._db.remove_order(_id)
+        with self._transaction():
+            self._orders.remove(_id)
+            self._db_changes.remove(_id)
+
+    @_command
+    def remove_user_order(self, user: data.User, _id: int) -> None:
+        """
+        Remove the order if it's still in the book and belongs to the user.
+
+        The check and the removal are one command, so the order can't be filled
+        or expire in between.
+        """
+        if self._orders.get_for_user(user.id, _id) is None:
+            # the user mustn't learn that an order with this id exists
+            raise ValueError(f"Invalid order id: {_id}")
+        self.remove_order(_id)
+
+    @contextlib.contextmanager
+    def _transaction(self) -> Iterator[None]:
+        """
+        Collect the DB side effects of an operation and commit them in one transaction.
+
+        Nested calls join the outer transaction. Matches are reported once the command
+        is done, only the committed ones. Must be called on the writer thread.
+        """
+        if self._changes is not None:
+            yield
+            return
+        self._changes = OrderChanges()
+        try:
+            yield
+        finally:
+            changes, self._changes = self._changes, None
+            matches, self._pending_matches = self._pending_matches, []
+            self._db.apply_changes(changes)
+        self._committed_matches.extend(matches)
+
+    @property
+    def _db_changes(self) -> OrderChanges:
+        assert self._changes is not None, "must be called within _transaction()"
+        return self._changes
 
     def get_stats(self) -> dict:
-        self._update_prices()
+        """
+        Get the market statistics.
+
+        The statistics as of the last command, rendered from the aggregates maintained
+        by the order book when the book or the exchange rate changes. Expired orders
+        are counted until the expiry check removes them, see schedule_expiry_check().
+        """
+        assert self._stats is not None  # published by the first command
+        stats = self._stats[1]
+        return {**stats, "data": dict(stats["data"])}
 
-        sellers = [o for o in self._orders.values() if o.type == data.OrderType.SELL]
-        buyers = [o for o in self._orders.values() if o.type == data.OrderType.BUY]
+    def _render_stats(self) -> dict:
+        best_seller = self._orders.sellers.best()
+        best_buyer = self._orders.buyers.best()
 
-        total_amount_sellers = sum(o.amount_left for o in sellers)
-        total_amount_buyers = sum(o.amount_left for o in buyers)
+        total_amount_sellers = self._orders.sellers.total_amount
+        total_amount_buyers = self._orders.buyers.total_amount
 
-        if sellers:
-            sellers.sort(key=lambda x: x.price)
-            best_seller = sellers[0]
+        if best_seller is not None:
             min_seller_price = best_seller.price
             min_seller_min_op_threshold = best_seller.min_op_threshold
             min_seller_text = (
@@ -186,9 +808,7 @@ class Exchange:
             min_seller_min_op_threshold = None
             total_amount_sellers = 0
 
-        if buyers:
-            buyers.sort(key=lambda x: -x.price)
-            best_buyer = buyers[0]
+        if best_buyer is not None:
             max_buyer_price = best_buyer.price
             max_buyer_min_op_threshold = best_buyer.min_op_threshold
             max_buyer_text = (
@@ -212,7 +832,7 @@ class Exchange:
             "data": {
                 "currency_rate": self.currency_rate,
                 "order_cnt": len(self._orders),
-                "user_cnt": len(set([o.user.id for o in self._orders.values()])),
+                "user_cnt": self._orders.user_cnt,
                 "max_buyer_price": max_buyer_price,
                 "max_buyer_min_op_threshold": max_buyer_min_op_threshold,
                 "min_seller_price": min_seller_price,
@@ -237,8 +857,8 @@ class Exchange:
                 f"Current statistics (to get the full statistics, while being in main menu"
                 " send '/stat' command or press Statistics button):\n"
                 f"  * last match price: {self.last_match_price}\n"
-                f"  * best buyer price: {max_buyer_price if buyers else 'No buyers yet'}\n"
-                f"  * best seller price: {min_seller_price if sellers else 'No sellers yet'}"
+                f"  * best buyer price: {max_buyer_price if best_buyer else 'No buyers yet'}\n"
+                f"  * best seller price: {min_seller_price if best_seller else 'No sellers yet'}"
             ),
         }
 
@@ -0,0 +1,122 @@
+"""
+Integer fixed-point prices and amounts.
+
+A value is an int holding the number of 10^-scale units, the same representation
+as in the DB: prices (and rates) have 4 digits after the dot, amounts have 2.
+Rounding is half to even, as Decimal's quantize() and round() do by default,
+so the results are identical to the Decimal computations they replace.
+Convert to Decimal only to present or hand the values over.
+"""
+
+from decimal import Decimal, ROUND_HALF_EVEN
+import logging
+import random
+import timeit
+import unittest
+
+PRICE_SCALE = 4
+AMOUNT_SCALE = 2
+
+
+def from_decimal(x: Decimal | float | int, scale: int) -> int:
+    """Truncated towards zero, as the DB columns are written"""
+    if isinstance(x, Decimal):
+        return int(x.scaleb(scale))
+    return int(x * 10**scale)
+
+
+def to_decimal(v: int, scale: int) -> Decimal:
+    return Decimal(v).scaleb(-scale)
+
+
+def div_half_even(n: int, d: int) -> int:
+    """n / d rounded half to even, d > 0"""
+    q, r = divmod(n, d)
+    r2 = 2 * r
+    if r2 > d or (r2 == d and q % 2):
+        q += 1
+    return q
+
+
+def mul_half_even(v: int, ratio: tuple[int, int]) -> int:
+    """
+    v * x rounded half to even, the scale of v is kept.
+
+    Args:
+        ratio: x as returned by x.as_integer_ratio(), so it's computed once
+            for many values.
+    """
+    n, d = ratio
+    return div_half_even(v * n, d)
+
+
+def mid_half_even(a: int, b: int) -> int:
+    """(a + b) / 2 rounded half to even"""
+    return div_half_even(a + b, 2)
+
+
+class T(unittest.TestCase):
+    """Property tests against the Decimal computations"""
+
+    def setUp(self):
+        self.rnd = random.Random(42)
+
+    def rnd_fixed(self, max_digits: int = 8) -> int:
+        return self.rnd.randrange(-(10**max_digits), 10**max_digits)
+
+    def test_conversions(self):
+        for _ in range(2000):
+            v = self.rnd_fixed()
+            for scale in (PRICE_SCALE, AMOUNT_SCALE):
+                d = to_decimal(v, scale)
+                self.assertEqual(d, Decimal(v) / 10**scale)
+                self.assertEqual(d.as_tuple().exponent, -scale)
+                self.assertEqual(v, from_decimal(d, scale))
+        self.assertEqual(981234, from_decimal(Decimal("98.12345"), 4))
+        self.assertEqual(981234, from_decimal(98.12345, 4))
+        self.assertEqual(-981234, from_decimal(Decimal("-98.12345"), 4))
+        self.assertEqual(1299, from_decimal(12.99, 2))
+
+    def test_mul(self):
+        for _ in range(5000):
+            v = self.rnd_fixed()
+            x = Decimal(self.rnd_fixed(6)).scaleb(-self.rnd.randrange(0, 7))
+            expected = (x * to_decimal(v, PRICE_SCALE)).quantize(
+                Decimal("0.0001"), ROUND_HALF_EVEN
+            )
+            res = to_decimal(mul_half_even(v, x.as_integer_ratio()), PRICE_SCALE)
+            self.assertEqual(str(expected), str(res), (v, x))
+
+    def test_half_way(self):
+        # exact ties are the interesting cases for the rounding mode
+        for v, x in [(5, "0.5"), (15, "0.5"), (-5, "0.5"), (25, "0.1"), (35, "0.1")]:
+            x = Decimal(x)
+            expected = (x * to_decimal(v, 4)).quantize(Decimal("0.0001"))
+            self.assertEqual(
+                expected, to_decimal(mul_half_even(v, x.as_integer_ratio()), 4)
+            )
+
+    def test_mid(self):
+        for _ in range(5000):
+            a, b = self.rnd_fixed(), self.rnd_fixed()
+            expected = round((to_decimal(a, 4) + to_decimal(b, 4)) / 2, 4)
+            self.assertEqual(str(expected), str(to_decimal(mid_half_even(a, b), 4)))
+
+    def test_timing_vs_decimal(self):
+        rate = Decimal("4.5432")
+        ratio = rate.as_integer_ratio()
+        values = [self.rnd.randrange(1, 10**6) for _ in range(1000)]
+
+        def fixed():
+            for v in values:
+                mul_half_even(v, ratio)
+
+        def dec():
+            for v in values:
+                from_decimal((rate * to_decimal(v, 4)).quantize(Decimal("0.0001")), 4)
+
+        fixed_sec = min(timeit.repeat(fixed, number=10, repeat=7))
+        dec_sec = min(timeit.repeat(dec, number=10, repeat=7))
+        logging.info("x rate: fixed-point %.4fs, Decimal %.4fs", fixed_sec, dec_sec)
+        # about 3.5 times faster, only a loose bound is asserted: CI timings are noisy
+        self.assertLess(fixed_sec, dec_sec)
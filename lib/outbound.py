@@ -0,0 +1,286 @@
+"""
+Outgoing Telegram messages: queued, coalesced and rate limited.
+"""
+
+import collections
+from dataclasses import dataclass
+import logging
+import threading
+import time
+from typing import TYPE_CHECKING, Any, Callable
+import unittest
+
+if TYPE_CHECKING:
+    from .botlib.tg import TgOutgoingMsg
+
+# https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this
+GLOBAL_RATE = 30.0  # messages per second
+CHAT_RATE = 1.0
+CHAT_BURST = 3
+_MAX_TEXT_LEN = 4096
+
+
+class _TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self._rate = rate
+        self._burst = burst
+        self._tokens = burst
+        self._t = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self._burst, self._tokens + (now - self._t) * self._rate)
+        self._t = now
+
+    def delay(self, now: float) -> float:
+        """Seconds until a token is available"""
+        self._refill(now)
+        return max(0.0, (1 - self._tokens) / self._rate)
+
+    def take(self, now: float) -> None:
+        self._refill(now)
+        self._tokens -= 1
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self._tokens >= self._burst
+
+
+class OutboundDispatcher:
+    """
+    Sends the messages in the background, the callers don't wait for Telegram.
+
+    The messages of a chat are sent in order, one at a time, the chats concurrently
+    by `workers` threads. Consecutive plain text messages waiting for the same chat
+    are coalesced into one. The sends are limited to `global_rate` per second
+    overall and `chat_rate` per second per chat (with bursts of `chat_burst`).
+    A send failing with a flood wait (an error with retry_after) is retried after
+    the wait, other failures are logged and the message is dropped.
+    """
+
+    def __init__(
+        self,
+        send: Callable[["TgOutgoingMsg"], Any],
+        workers: int = 4,
+        global_rate: float = GLOBAL_RATE,
+        chat_rate: float = CHAT_RATE,
+        chat_burst: int = CHAT_BURST,
+    ):
+        self._send = send
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._global = _TokenBucket(global_rate, 1)
+        self._cv = threading.Condition()
+        self._pending: dict[int, collections.deque] = {}
+        self._buckets: dict[int, _TokenBucket] = {}
+        self._not_before: dict[int, float] = {}  # flood waits
+        self._busy: set[int] = set()  # chats being sent to
+        self._closed = False
+        self._threads = [
+            threading.Thread(target=self._work, name=f"outbound-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for t in self._threads:
+            t.start()
+
+    def send_message(self, m: "TgOutgoingMsg") -> None:
+        with self._cv:
+            if self._closed:
+                raise RuntimeError("The dispatcher is closed")
+            self._pending.setdefault(m.user_id, collections.deque()).append(m)
+            self._cv.notify()
+
+    def flush(self) -> None:
+        """Wait until the messages queued so far are sent"""
+        with self._cv:
+            self._cv.wait_for(lambda: not self._pending and not self._busy)
+
+    def close(self) -> None:
+        """Send the queued messages and stop"""
+        with self._cv:
+            self._closed = True
+            self._cv.notify_all()
+        for t in self._threads:
+            t.join()
+
+    def _work(self) -> None:
+        while True:
+            with self._cv:
+                chat_id = self._next_chat()
+                if chat_id is None:
+                    return
+                m = self._coalesce(self._pending[chat_id])
+                if not self._pending[chat_id]:
+                    del self._pending[chat_id]
+                self._busy.add(chat_id)
+                self._bucket(chat_id).take(time.monotonic())
+            try:
+                self._send(m)
+            except Exception as e:
+                retry_after = getattr(e, "retry_after", None)
+                with self._cv:
+                    if retry_after is None:
+                        logging.exception(f"Failed to send a message to {chat_id}")
+                    else:
+                        logging.warning(f"Flood wait {retry_after}s for {chat_id}")
+                        self._not_before[chat_id] = time.monotonic() + float(
+                            retry_after
+                        )
+                        self._pending.setdefault(chat_id, collections.deque())
+                        self._pending[chat_id].appendleft(m)
+            with self._cv:
+                self._busy.discard(chat_id)
+                self._cv.notify_all()
+
+    def _next_chat(self) -> int | None:
+        """Wait for a chat which may be sent to, None when closed and all is sent"""
+        while True:
+            now = time.monotonic()
+            wait = None
+            for chat_id in self._pending:
+                if chat_id in self._busy:
+                    continue
+                delay = max(
+                    self._bucket(chat_id).delay(now),
+                    self._not_before.get(chat_id, 0) - now,
+                )
+                if delay <= 0:
+                    delay = self._global.delay(now)
+                    if delay <= 0:
+                        self._global.take(now)
+                        self._not_before.pop(chat_id, None)
+                        return chat_id
+                wait = delay if wait is None else min(wait, delay)
+            if self._closed and not self._pending and not self._busy:
+                return None
+            self._forget_idle_chats(now)
+            self._cv.wait(wait)
+
+    def _bucket(self, chat_id: int) -> _TokenBucket:
+        try:
+            return self._buckets[chat_id]
+        except KeyError:
+            b = self._buckets[chat_id] = _TokenBucket(self._chat_rate, self._chat_burst)
+            return b
+
+    def _forget_idle_chats(self, now: float) -> None:
+        # a full bucket is the same as a new one, so memory stays bounded
+        for chat_id in [
+            c
+            for c, b in self._buckets.items()
+            if c not in self._pending and c not in self._busy and b.is_full(now)
+        ]:
+            del self._buckets[chat_id]
+
+    @staticmethod
+    def _coalesce(q: collections.deque) -> "TgOutgoingMsg":
+        m = q.popleft()
+        if not _is_plain(m):
+            return m
+        parts = [m.text]
+        length = len(m.text)
+        while (
+            q
+            and _is_plain(q[0])
+            and q[0].parse_mode == m.parse_mode
+            and length + 2 + len(q[0].text) <= _MAX_TEXT_LEN
+        ):
+            text = q.popleft().text
+            parts.append(text)
+            length += 2 + len(text)
+        if len(parts) == 1:
+            return m
+        return type(m)(
+            m.user_id, m.user_name, "\n\n".join(parts), parse_mode=m.parse_mode
+        )
+
+
+def _is_plain(m: "TgOutgoingMsg") -> bool:
+    return not (m.keyboard_below or m.inline_keyboard or m.edit_message_with_id)
+
+
+@dataclass
+class _Msg:
+    user_id: int
+    user_name: str | None
+    text: str
+    keyboard_below: Any = None
+    parse_mode: str | None = None
+    inline_keyboard: Any = None
+    edit_message_with_id: int | None = None
+
+
+class _FloodWait(Exception):
+    retry_after = 0.05
+
+
+class T(unittest.TestCase):
+    def setUp(self):
+        self.sent: list[_Msg] = []
+        self.lock = threading.Lock()
+        self.release = threading.Event()
+        self.release.set()
+        self.sending = threading.Event()
+
+    def send(self, m: _Msg):
+        self.sending.set()
+        self.release.wait(10)
+        with self.lock:
+            self.sent.append(m)
+
+    def mk(self, **kwargs) -> OutboundDispatcher:
+        d = OutboundDispatcher(self.send, **kwargs)
+        self.addCleanup(d.close)
+        return d
+
+    def test_coalescing(self):
+        d = self.mk(workers=1, chat_burst=10)
+        self.release.clear()
+        d.send_message(_Msg(1, "Joe", "first"))
+        self.sending.wait(5)
+        for text in ("a", "b"):
+            d.send_message(_Msg(1, "Joe", text))
+        d.send_message(_Msg(1, "Joe", "menu", inline_keyboard=[["x"]]))
+        d.send_message(_Msg(1, "Joe", "c"))
+        self.release.set()
+        d.flush()
+        self.assertEqual(["first", "a\n\nb", "menu", "c"], [m.text for m in self.sent])
+        self.assertEqual([["x"]], self.sent[2].inline_keyboard)
+
+    def test_chats_are_concurrent(self):
+        d = self.mk(workers=2)
+        self.release.clear()
+        d.send_message(_Msg(1, "Joe", "blocked"))
+        done = threading.Event()
+        d._send = lambda m: done.set() if m.user_id == 2 else self.send(m)
+        d.send_message(_Msg(2, "Dow", "other"))
+        self.assertTrue(done.wait(5))
+        self.release.set()
+        d.flush()
+
+    def test_rate_limit(self):
+        d = self.mk(workers=4, chat_rate=20, chat_burst=1)
+        self.release.clear()
+        started = time.monotonic()
+        d.send_message(_Msg(1, "Joe", "menu", inline_keyboard=[["x"]]))
+        d.send_message(_Msg(1, "Joe", "menu", inline_keyboard=[["x"]]))
+        d.send_message(_Msg(1, "Joe", "menu", inline_keyboard=[["x"]]))
+        self.release.set()
+        d.flush()
+        self.assertEqual(3, len(self.sent))
+        self.assertGreaterEqual(time.monotonic() - started, 0.09)  # 2 waits of 1/20s
+
+    def test_flood_wait(self):
+        d = self.mk(workers=1)
+        calls = []
+
+        def send(m):
+            calls.append(m.text)
+            if len(calls) == 1:
+                raise _FloodWait()
+            self.send(m)
+
+        d._send = send
+        d.send_message(_Msg(1, "Joe", "hi"))
+        d.flush()
+        self.assertEqual(["hi", "hi"], calls)
+        self.assertEqual(["hi"], [m.text for m in self.sent])
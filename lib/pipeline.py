@@ -0,0 +1,124 @@
+"""
+Keyed processing pipeline on an asyncio event loop.
+
+Jobs with the same key run one after another in the order they were submitted,
+jobs with different keys run concurrently. The jobs are blocking callables
+(DB commits, SMTP, Telegram API calls), the loop offloads them to a thread pool
+so it only keeps the order and never blocks itself.
+"""
+
+import asyncio
+import concurrent.futures
+import logging
+import threading
+import time
+from typing import Callable, Hashable
+import unittest
+
+
+class KeyedPipeline:
+    def __init__(self, max_workers: int = 8, name: str = "pipeline"):
+        self._loop = asyncio.new_event_loop()
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers, thread_name_prefix=name
+        )
+        self._tails: dict[Hashable, asyncio.Future] = {}  # the last job of each key
+        self._closed = False
+        self._closing = threading.Lock()  # no job is submitted after the stop
+        self._thread = threading.Thread(
+            target=self._loop.run_forever, name=name, daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, key: Hashable, fn: Callable, *args) -> concurrent.futures.Future:
+        """Run fn(*args) after the jobs submitted with the same key before"""
+        with self._closing:
+            if self._closed:
+                raise RuntimeError("The pipeline is closed")
+            return asyncio.run_coroutine_threadsafe(
+                self._run(key, fn, args), self._loop
+            )
+
+    def drain(self) -> None:
+        """Wait until the jobs submitted so far are done"""
+        asyncio.run_coroutine_threadsafe(self._drain(), self._loop).result()
+
+    def close(self) -> None:
+        """Run the jobs submitted so far and stop, the later ones are rejected"""
+        with self._closing:
+            if self._closed:
+                return
+            self._closed = True
+        self.drain()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._executor.shutdown()
+
+    async def _run(self, key: Hashable, fn: Callable, args: tuple):
+        # nothing is awaited before the job takes the tail, so the keys' jobs
+        # are chained in the order they were submitted
+        prev = self._tails.get(key)
+        done = self._loop.create_future()
+        self._tails[key] = done
+        try:
+            if prev is not None:
+                await prev
+            return await self._loop.run_in_executor(self._executor, fn, *args)
+        except Exception:
+            logging.exception(f"Job failed, key: {key}")
+            raise
+        finally:
+            done.set_result(None)
+            if self._tails.get(key) is done:
+                del self._tails[key]
+
+    async def _drain(self) -> None:
+        while self._tails:
+            await asyncio.gather(*self._tails.values())
+
+
+class T(unittest.TestCase):
+    def setUp(self):
+        self.pipeline = KeyedPipeline(max_workers=4)
+        self.addCleanup(self.pipeline.close)
+
+    def test_order_per_key(self):
+        res: dict[int, list] = {1: [], 2: []}
+
+        def job(key, i):
+            time.sleep(0.001 * (i % 3))
+            res[key].append(i)
+
+        for i in range(30):
+            for key in res:
+                self.pipeline.submit(key, job, key, i)
+        self.pipeline.drain()
+        self.assertEqual({1: list(range(30)), 2: list(range(30))}, res)
+
+    def test_keys_dont_wait_for_each_other(self):
+        release = threading.Event()
+        blocked = self.pipeline.submit(1, release.wait, 10)
+        queued = self.pipeline.submit(1, lambda: "after")
+        self.assertEqual("other", self.pipeline.submit(2, lambda: "other").result(10))
+        self.assertFalse(queued.done())
+        release.set()
+        self.assertTrue(blocked.result(10))
+        self.assertEqual("after", queued.result(10))
+
+    def test_failure_doesnt_stop_the_key(self):
+        def fail():
+            raise ValueError("boom")
+
+        with self.assertLogs(level="ERROR"):
+            failed = self.pipeline.submit(1, fail)
+            self.assertRaises(ValueError, failed.result, 10)
+        self.assertEqual(2, self.pipeline.submit(1, lambda: 2).result(10))
+
+    def test_close(self):
+        res = []
+        self.pipeline.submit(1, time.sleep, 0.05)
+        self.pipeline.submit(1, res.append, 1)
+        self.pipeline.close()
+        self.assertEqual([1], res)
+        self.assertRaises(RuntimeError, self.pipeline.submit, 1, res.append, 2)
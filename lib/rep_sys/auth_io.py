@@ -0,0 +1,121 @@
+"""
+Auth records in files, for the bulk import and export: CSV with a header or
+JSON lines, with the fields telegram_id, email_hash and authenticated.
+"""
+
+import csv
+import io
+import json
+from typing import Any, Iterable, Iterator, TextIO
+from unittest import TestCase
+from .auth_rec import AuthRecord
+from .rep_id import RepSysUserId
+
+FORMATS = ("csv", "jsonl")
+_FIELDS = ["telegram_id", "email_hash", "authenticated", "when"]
+_TRUE = ("1", "true", "yes")
+_FALSE = ("0", "false", "no")
+
+
+def read_auths(f: TextIO, fmt: str) -> Iterator[tuple[RepSysUserId, bool]]:
+    """The user ids with their authenticity, ValueError on a malformed line"""
+    if fmt == "csv":
+        reader = csv.DictReader(f)
+        for row in reader:
+            yield _parse(row, reader.line_num)
+    elif fmt == "jsonl":
+        for line_num, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"Line {line_num}: {e}") from e
+            if not isinstance(row, dict):
+                raise ValueError(f"Line {line_num}: an object is expected")
+            yield _parse(row, line_num)
+    else:
+        raise ValueError(f"Unknown format {fmt}, expected one of {FORMATS}")
+
+
+def write_auths(f: TextIO, recs: Iterable[AuthRecord], fmt: str) -> int:
+    """Returns the number of the records written"""
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown format {fmt}, expected one of {FORMATS}")
+    writer = csv.DictWriter(f, _FIELDS) if fmt == "csv" else None
+    if writer:
+        writer.writeheader()
+    n = 0
+    for rec in recs:
+        row = {
+            "telegram_id": rec.uid.telegram_user_id,
+            "email_hash": rec.uid.email_hash,
+            "authenticated": rec.authenticated,
+            "when": rec.when,
+        }
+        if writer:
+            writer.writerow(row)
+        else:
+            f.write(json.dumps(row) + "\n")
+        n += 1
+    return n
+
+
+def _parse(row: dict[str, Any], line_num: int) -> tuple[RepSysUserId, bool]:
+    try:
+        telegram_id = int(row["telegram_id"])
+        email_hash = row.get("email_hash") or None
+        return RepSysUserId(telegram_id, email_hash), _parse_bool(row["authenticated"])
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError(f"Line {line_num}: invalid record {row}") from e
+
+
+def _parse_bool(v: Any) -> bool:
+    if isinstance(v, bool):
+        return v
+    s = str(v).strip().lower()
+    if s in _TRUE:
+        return True
+    if s in _FALSE:
+        return False
+    raise ValueError(f"Invalid boolean {v}")
+
+
+class T(TestCase):
+    def test_csv(self):
+        f = io.StringIO("telegram_id,email_hash,authenticated\n123,hash,true\n555,,0\n")
+        self.assertEqual(
+            [(RepSysUserId(123, "hash"), True), (RepSysUserId(555), False)],
+            list(read_auths(f, "csv")),
+        )
+
+    def test_jsonl(self):
+        f = io.StringIO(
+            '{"telegram_id": 123, "email_hash": "hash", "authenticated": true}\n'
+            "\n"
+            '{"telegram_id": 555, "authenticated": "no"}\n'
+        )
+        self.assertEqual(
+            [(RepSysUserId(123, "hash"), True), (RepSysUserId(555), False)],
+            list(read_auths(f, "jsonl")),
+        )
+
+    def test_malformed(self):
+        f = io.StringIO("telegram_id,authenticated\n123,true\nabc,true\n")
+        with self.assertRaisesRegex(ValueError, "Line 3"):
+            list(read_auths(f, "csv"))
+        f = io.StringIO('{"telegram_id": 123, "authenticated": "maybe"}\n')
+        self.assertRaises(ValueError, list, read_auths(f, "jsonl"))
+
+    def test_round_trip(self):
+        recs = [
+            AuthRecord(RepSysUserId(123, "hash"), True, 1),
+            AuthRecord(RepSysUserId(555), False, 2),
+        ]
+        for fmt in FORMATS:
+            f = io.StringIO()
+            self.assertEqual(2, write_auths(f, recs, fmt))
+            f.seek(0)
+            self.assertEqual(
+                [(r.uid, r.authenticated) for r in recs], list(read_auths(f, fmt))
+            )
@@ -10,6 +10,8 @@ from sqlalchemy import Engine, create_engine
 from sqlalchemy.orm import DeclarativeBase, mapped_column, Mapped, Session
 from .rep_id import RepSysUserId
 from lib.comms.mailer import EmailAddress, Mailer, MailerMock
+from lib.comms.email_outbox import DeliveryStatus, EmailOutbox
+from lib import schema
 
 
 _MAX_ATTEMPTS = 3
@@ -31,28 +33,44 @@ class EmailAuthenticator:
         mailer: Mailer,
         db_eng: Engine,
         max_attempts: int = _MAX_ATTEMPTS,
+        outbox: Optional[EmailOutbox] = None,
     ):
+        """
+        The state is loaded once and kept in memory, the DB is only written to.
+        The table is created by schema.create_all().
+
+        Args:
+            outbox: the codes are sent through it, a new one on the mailer by default.
+        """
         self._user_id = uid
+        self._outbox = outbox if outbox is not None else EmailOutbox(mailer, db_eng)
         self._mailer = mailer
         self._max_attempts = max_attempts
         self._db_eng = db_eng
         self._pers = EmailAuthenticator.State()
-
-        _Base.metadata.create_all(self._db_eng)
         self._load_state()
 
     @property
     def state(self) -> "EmlAuthState":
         return self._pers.state
 
+    @property
+    def delivery_status(self) -> Optional[DeliveryStatus]:
+        """How the latest code email is doing"""
+        assert self._user_id.telegram_user_id is not None
+        return self._outbox.last_status(self._user_id.telegram_user_id)
+
     @property
     def user_id(self) -> RepSysUserId:
         return RepSysUserId(self._user_id.telegram_user_id, self._pers.email_hash)
 
     def send_email(self, email: str):
+        """Move on to waiting for the code, the code is emailed in the background"""
         eaddr = EmailAddress(email)
         if not eaddr.is_valid:
             raise ValueError(f"Invalid email {email}")
+        if not self._mailer.is_allowed(eaddr):
+            raise ValueError(f"Email {eaddr.obfuscated} is not allowed")
 
         self._pers.email_hash = RepSysUserId.hash_email(email)
         if (
@@ -62,25 +80,21 @@ class EmailAuthenticator:
             raise ValueError("Email hash mismatch")
 
         code = self._renerate_rnd_code()
-
-        logging.info(f"Sending code {code} to {eaddr.obfuscated} ...")
-        try:
-            self._mailer.send_email(
-                EmailAddress(email), f"Your code for Exchange Bot is {code}"
-            )
-        except Exception as e:
-            logging.exception(f"Failed to send code to {eaddr.obfuscated}: {e}")
-            raise
-        logging.info(f"Sent code {code} to {eaddr.obfuscated}")
-
         self._pers.code = code
         self._pers.code_ctime = int(time.time())
         self._pers.state = EmlAuthState.WAIT_CODE
         self._save_state()
 
+        assert self._user_id.telegram_user_id is not None
+        self._outbox.enqueue(
+            self._user_id.telegram_user_id,
+            eaddr,
+            f"Your code for Exchange Bot is {code}",
+        )
+        logging.info(f"Queued code {code} to {eaddr.obfuscated}")
+
     def reset(self):
         self.delete()
-        self._load_state()
 
     def is_code_valid(self, code: str) -> bool:
         if self._pers.state != EmlAuthState.WAIT_CODE:
@@ -101,6 +115,7 @@ class EmailAuthenticator:
             self._save_state()
 
     def delete(self):
+        self._pers = EmailAuthenticator.State()
         with Session(self._db_eng) as session:
             dbo = session.get(_EmailAuthState, self._user_id.telegram_user_id)
             if dbo:
@@ -113,29 +128,26 @@ class EmailAuthenticator:
         with Session(self._db_eng) as session:
             dbo = session.get(_EmailAuthState, self._user_id.telegram_user_id)
             if dbo is None:
-                dbo = _EmailAuthState(
-                    telegram_user_id=self._user_id.telegram_user_id,
-                    state=self._pers.state.value,
-                    attempts=self._pers.attempts,
-                )
-                session.add(dbo)
+                return
             self._pers.state = EmlAuthState(dbo.state)
             self._pers.code = dbo.code
             self._pers.email_hash = dbo.email_hash
             self._pers.code_ctime = dbo.code_ctime
             self._pers.attempts = dbo.attempts
-            session.commit()
 
     def _save_state(self):
         try:
             with Session(self._db_eng) as session:
-                dbo = session.get(_EmailAuthState, self._user_id.telegram_user_id)
-                assert dbo
-                dbo.state = self._pers.state.value
-                dbo.code = self._pers.code
-                dbo.email_hash = self._pers.email_hash
-                dbo.code_ctime = self._pers.code_ctime
-                dbo.attempts = self._pers.attempts
+                session.merge(
+                    _EmailAuthState(
+                        telegram_user_id=self._user_id.telegram_user_id,
+                        state=self._pers.state.value,
+                        code=self._pers.code,
+                        email_hash=self._pers.email_hash,
+                        code_ctime=self._pers.code_ctime,
+                        attempts=self._pers.attempts,
+                    )
+                )
                 session.commit()
         except Exception as e:
             logging.exception(f"Failed to save state: {e}")
@@ -174,11 +186,14 @@ class T(TestCase):
     def setUp(self) -> None:
         self.mm = MailerMock()
         self.eng = create_engine("sqlite://")
+        schema.create_all(self.eng)
         self.au = EmailAuthenticator(RepSysUserId(123), self.mm, self.eng)
         return super().setUp()
 
     def test_ctor(self):
         self.assertEqual(EmlAuthState.WAIT_EMAIL, self.au.state)
+        with Session(self.eng) as session:
+            self.assertEqual(0, session.query(_EmailAuthState).count())
 
     def test_happy_path(self):
         self.au.send_email("john@example.net")
@@ -247,6 +262,29 @@ class T(TestCase):
                 TooManyAttemptsOrExpiredError, self.au.is_code_valid, self.au._pers.code
             )
 
+    def test_state_saved_before_delivery(self):
+        class FailingMailer(MailerMock):
+            def send_email(self, to, text):
+                raise ConnectionError("no route")
+
+        au = EmailAuthenticator(RepSysUserId(456), FailingMailer(), self.eng)
+        with self.assertLogs(level="ERROR"):
+            au.send_email("john@example.net")
+        self.assertEqual(EmlAuthState.WAIT_CODE, au.state)
+        self.assertEqual(DeliveryStatus.FAILED, au.delivery_status)
+        other = EmailAuthenticator(RepSysUserId(456), self.mm, self.eng)
+        self.assertEqual(EmlAuthState.WAIT_CODE, other.state)
+
+    def test_delivery_status(self):
+        self.assertIsNone(self.au.delivery_status)
+        self.au.send_email("john@example.net")
+        self.assertEqual(DeliveryStatus.SENT, self.au.delivery_status)
+
+    def test_not_allowed(self):
+        au = EmailAuthenticator(RepSysUserId(456), MailerMock("example.com"), self.eng)
+        self.assertRaises(ValueError, au.send_email, "john@example.net")
+        self.assertEqual(EmlAuthState.WAIT_EMAIL, au.state)
+
     def test_hash_missmatch(self):
         self.au._user_id.email_hash = "hash"
         self.assertRaises(ValueError, self.au.send_email, "test@example.net")
@@ -1,57 +1,151 @@
+import threading
 import time
-from typing import Any, Optional
+import io
+from typing import Any, Optional, TextIO
 from unittest import TestCase, mock
+import cachetools
 
-
-from .rep_sys_db import RepSysDb
+from .. import schema
+from . import auth_io
+from .rep_sys_db import BULK_BATCH_SIZE, ImportResult, RepSysDb
 from .rep_id import RepSysUserId
 from .auth_rec import AuthRecord
 
 
 AUTH_REC_VALIDITY_SEC = 60 * 60 * 24 * 30 * 3  # 90 days
+AUTH_REC_CACHE_TTL_SEC = 60
+AUTH_REC_CACHE_SIZE = 10000
 
 
 class ReputationSystem:
-    def __init__(self, db_engine: Any):
+    def __init__(
+        self,
+        db_engine: Any,
+        cache_ttl_sec: float = AUTH_REC_CACHE_TTL_SEC,
+        cache_size: int = AUTH_REC_CACHE_SIZE,
+    ):
+        """
+        The auth records read are cached for `cache_ttl_sec`, by telegram id and
+        by email hash, the changes made through set_authenticity() are seen at once.
+        """
         self._db_engine = db_engine
         self._db = RepSysDb(db_engine)
+        # (telegram id, None) or (None, email hash) -> the record, None if there's none
+        self._cache: cachetools.TTLCache[
+            tuple[Optional[int], Optional[str]], Optional[AuthRecord]
+        ] = cachetools.TTLCache(maxsize=cache_size, ttl=cache_ttl_sec)
+        self._cache_lock = threading.Lock()
+        self._cache_generation = 0  # changed on each invalidation
+        self._cache_hits = 0
+        self._cache_misses = 0
+
+    @property
+    def cache_hits(self) -> int:
+        return self._cache_hits
+
+    @property
+    def cache_misses(self) -> int:
+        return self._cache_misses
 
     def is_authenticated(self, uid: RepSysUserId) -> bool:
-        try:
-            rec = self._db.get_auth_record(uid)
-            return rec.authenticated and time.time() - rec.when < AUTH_REC_VALIDITY_SEC
-        except KeyError:
+        rec = self._get_auth_record(uid)
+        if rec is None:
             return False
+        return rec.authenticated and time.time() - rec.when < AUTH_REC_VALIDITY_SEC
 
     def enrich_user_id(self, uid: RepSysUserId) -> RepSysUserId:
-        try:
-            rec = self._db.get_auth_record(uid)
-            return rec.uid
-        except KeyError:
-            return uid
+        rec = self._get_auth_record(uid)
+        return rec.uid if rec is not None else uid
 
     def is_id_consistent(self, uid: RepSysUserId) -> bool:
         assert uid.telegram_user_id and uid.email_hash
-        ids = [
-            RepSysUserId(telegram_user_id=uid.telegram_user_id),
-            RepSysUserId(email_hash=uid.email_hash),
-        ]
-        recs: list[Optional[AuthRecord]] = []
-        for id in ids:
-            try:
-                recs.append(self._db.get_auth_record(id))
-            except KeyError:
-                recs.append(None)
-        rec1, rec2 = recs
+        rec1, rec2 = self._get_auth_records(uid)
 
         if (rec1 and rec1.uid != uid) or (rec2 and rec2.uid != uid):
             return False
         return True
 
     def set_authenticity(self, uid: RepSysUserId, is_auth: bool) -> None:
-        if uid.telegram_user_id and uid.email_hash and not self.is_id_consistent(uid):
-            raise ValueError("Inconsistent user id")
-        self._db.set_authenticity(uid, is_auth)
+        # the consistency is checked by the DB in the same transaction
+        try:
+            self._db.set_authenticity(uid, is_auth)
+        finally:
+            self._invalidate(uid)
+
+    def import_auths(
+        self, f: TextIO, fmt: str = "csv", batch_size: int = BULK_BATCH_SIZE
+    ) -> ImportResult:
+        """
+        Set the authenticity of the users listed in the file, see auth_io for the
+        formats. The batches before a malformed line stay imported.
+        """
+        try:
+            return self._db.import_auths(auth_io.read_auths(f, fmt), batch_size)
+        finally:
+            self._invalidate_all()
+
+    def export_auths(self, f: TextIO, fmt: str = "csv") -> int:
+        """Write all the auth records to the file, returns their number"""
+        return auth_io.write_auths(f, self._db.export_auths(), fmt)
+
+    def _get_auth_record(self, uid: RepSysUserId) -> Optional[AuthRecord]:
+        # by the telegram id if it's set, as RepSysDb.get_auth_record()
+        if uid.telegram_user_id is not None:
+            return self._get_auth_records(RepSysUserId(uid.telegram_user_id))[0]
+        if uid.email_hash is not None:
+            return self._get_auth_records(RepSysUserId(email_hash=uid.email_hash))[1]
+        raise ValueError("Either telegram_user_id or email_hash must be set")
+
+    def _get_auth_records(
+        self, uid: RepSysUserId
+    ) -> tuple[Optional[AuthRecord], Optional[AuthRecord]]:
+        """See RepSysDb.get_auth_records()"""
+        tg_key = (uid.telegram_user_id, None)
+        email_key = (None, uid.email_hash)
+        with self._cache_lock:
+            try:
+                recs = (
+                    self._cache[tg_key] if uid.telegram_user_id is not None else None,
+                    self._cache[email_key] if uid.email_hash is not None else None,
+                )
+            except KeyError:
+                self._cache_misses += 1
+                generation = self._cache_generation
+            else:
+                self._cache_hits += 1
+                return recs
+        recs = self._db.get_auth_records(uid)
+        with self._cache_lock:
+            # not if it has changed while being read
+            if generation == self._cache_generation:
+                if uid.telegram_user_id is not None:
+                    self._cache[tg_key] = recs[0]
+                if uid.email_hash is not None:
+                    self._cache[email_key] = recs[1]
+                for rec in recs:
+                    if rec is not None:
+                        # the record is found by either of its ids
+                        self._cache[(rec.uid.telegram_user_id, None)] = rec
+                        if rec.uid.email_hash is not None:
+                            self._cache[(None, rec.uid.email_hash)] = rec
+        return recs
+
+    def _invalidate(self, uid: RepSysUserId) -> None:
+        with self._cache_lock:
+            self._cache_generation += 1
+            for key, rec in list(self._cache.items()):
+                if key in (
+                    (uid.telegram_user_id, None),
+                    (None, uid.email_hash),
+                ) or (
+                    rec is not None and rec.uid.telegram_user_id == uid.telegram_user_id
+                ):
+                    self._cache.pop(key, None)
+
+    def _invalidate_all(self) -> None:
+        with self._cache_lock:
+            self._cache_generation += 1
+            self._cache.clear()
 
 
 class T(TestCase):
@@ -59,6 +153,7 @@ class T(TestCase):
         import sqlalchemy
 
         self.db_engine = sqlalchemy.create_engine("sqlite://")
+        schema.create_all(self.db_engine)
         self.rs = ReputationSystem(self.db_engine)
 
     def test_empty(self):
@@ -101,3 +196,41 @@ class T(TestCase):
         id1 = self.rs.enrich_user_id(RepSysUserId(123))
         self.assertEqual(123, id1.telegram_user_id)
         self.assertEqual("hash", id1.email_hash)
+
+    def test_cache(self):
+        self.assertFalse(self.rs.is_authenticated(RepSysUserId(123)))
+        self.assertFalse(self.rs.is_authenticated(RepSysUserId(123)))
+        self.assertEqual((1, 1), (self.rs.cache_hits, self.rs.cache_misses))
+
+        self.rs.set_authenticity(RepSysUserId(123, "hash"), True)
+        self.assertTrue(self.rs.is_authenticated(RepSysUserId(123)))
+        self.assertTrue(self.rs.is_authenticated(RepSysUserId(None, "hash")))
+        self.assertEqual((2, 2), (self.rs.cache_hits, self.rs.cache_misses))
+
+        # the record cached by the email hash is dropped too
+        self.rs.set_authenticity(RepSysUserId(123), False)
+        self.assertFalse(self.rs.is_authenticated(RepSysUserId(None, "hash")))
+
+    def test_cache_ttl(self):
+        rs = ReputationSystem(self.db_engine, cache_ttl_sec=0)
+        rs.is_authenticated(RepSysUserId(123))
+        rs.is_authenticated(RepSysUserId(123))
+        self.assertEqual((0, 2), (rs.cache_hits, rs.cache_misses))
+
+    def test_import_export(self):
+        self.assertFalse(self.rs.is_authenticated(RepSysUserId(123)))
+        res = self.rs.import_auths(
+            io.StringIO(
+                "telegram_id,email_hash,authenticated\n123,hash,1\n555,hash,1\n"
+            )
+        )
+        self.assertEqual(1, res.imported)
+        self.assertEqual([RepSysUserId(555, "hash")], res.rejected)
+        self.assertTrue(self.rs.is_authenticated(RepSysUserId(123)))
+
+        f = io.StringIO()
+        self.assertEqual(1, self.rs.export_auths(f, "jsonl"))
+        f.seek(0)
+        self.assertEqual(
+            [(RepSysUserId(123, "hash"), True)], list(auth_io.read_auths(f, "jsonl"))
+        )
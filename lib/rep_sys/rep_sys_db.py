@@ -1,16 +1,29 @@
+from dataclasses import dataclass, field
+import itertools
 import time
+from typing import Iterable, Iterator, Optional
 from unittest import TestCase
-from sqlalchemy import Engine, create_engine
+from sqlalchemy import Engine, create_engine, insert, or_, select, update
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import DeclarativeBase, mapped_column, Mapped, Session
+from .. import schema
 from .auth_rec import AuthRecord
 from .rep_id import RepSysUserId
 
 
+BULK_BATCH_SIZE = 1000
+
+
+@dataclass
+class ImportResult:
+    imported: int = 0
+    rejected: list[RepSysUserId] = field(default_factory=list)  # inconsistent ids
+
+
 class RepSysDb:
     def __init__(self, eng):
         assert isinstance(eng, Engine)
-        self._eng = eng
-        _Base.metadata.create_all(self._eng)
+        self._eng = eng  # the table is created by schema.create_all()
 
     def get_auth_record(self, uid: RepSysUserId) -> "AuthRecord":
         with Session(self._eng) as session:
@@ -34,23 +47,162 @@ class RepSysDb:
             uid = RepSysUserId(dbo.telegram_user_id, dbo.email_hash)
             return AuthRecord(uid, dbo.authenticated, dbo.when)
 
+    def get_auth_records(
+        self, uid: RepSysUserId
+    ) -> tuple[Optional[AuthRecord], Optional[AuthRecord]]:
+        """The records with the telegram id and with the email hash, in one query"""
+        with Session(self._eng) as session:
+            by_tg, by_email = self._get_auths(session, uid)
+            return _to_record(by_tg), _to_record(by_email)
+
     def set_authenticity(self, uid: RepSysUserId, is_auth: bool) -> None:
+        """
+        Raises ValueError if the email hash is set and either id is taken by
+        another record, checked in the same transaction as the write.
+        """
         assert uid.telegram_user_id
         t = int(time.time())
-        with Session(self._eng) as session:
-            dbo = session.get(_Auths, uid.telegram_user_id)
-            if dbo is None:
-                dbo = _Auths(
-                    telegram_user_id=uid.telegram_user_id,
-                    email_hash=uid.email_hash,
-                    authenticated=is_auth,
-                    when=t,
+        try:
+            with Session(self._eng) as session, session.begin():
+                by_tg, by_email = self._get_auths(session, uid, for_update=True)
+                if uid.email_hash and (
+                    (by_tg is not None and by_tg.email_hash != uid.email_hash)
+                    or (
+                        by_email is not None
+                        and by_email.telegram_user_id != uid.telegram_user_id
+                    )
+                ):
+                    raise ValueError("Inconsistent user id")
+                if by_tg is None:
+                    session.add(
+                        _Auths(
+                            telegram_user_id=uid.telegram_user_id,
+                            email_hash=uid.email_hash,
+                            authenticated=is_auth,
+                            when=t,
+                        )
+                    )
+                else:
+                    by_tg.authenticated = is_auth
+                    by_tg.when = t
+        except IntegrityError as e:
+            # the ids were taken by a concurrent transaction
+            raise ValueError("Inconsistent user id") from e
+
+    def import_auths(
+        self,
+        auths: Iterable[tuple[RepSysUserId, bool]],
+        batch_size: int = BULK_BATCH_SIZE,
+    ) -> ImportResult:
+        """
+        Upsert the authenticity of many users, a transaction per batch. A user id
+        inconsistent with the records, as for set_authenticity(), is rejected.
+        """
+        res = ImportResult()
+        it = iter(auths)
+        while batch := list(itertools.islice(it, batch_size)):
+            self._import_batch(batch, res)
+        return res
+
+    def export_auths(self, chunk_size: int = BULK_BATCH_SIZE) -> Iterator[AuthRecord]:
+        """All the records by telegram id, read in chunks of `chunk_size`"""
+        last_id: Optional[int] = None
+        while True:
+            q = select(_Auths).order_by(_Auths.telegram_user_id).limit(chunk_size)
+            if last_id is not None:
+                q = q.where(_Auths.telegram_user_id > last_id)
+            with Session(self._eng) as session:
+                chunk = [_to_record(dbo) for dbo in session.scalars(q)]
+            yield from chunk  # type: ignore
+            if len(chunk) < chunk_size:
+                return
+            last_id = chunk[-1].uid.telegram_user_id  # type: ignore
+
+    def _import_batch(
+        self, batch: list[tuple[RepSysUserId, bool]], res: ImportResult
+    ) -> None:
+        t = int(time.time())
+        tg_ids = [uid.telegram_user_id for uid, _ in batch]
+        hashes = [uid.email_hash for uid, _ in batch if uid.email_hash]
+        with Session(self._eng) as session, session.begin():
+            # the existing ids, then the ones added by the batch
+            hash_by_tg: dict[int, Optional[str]] = {}
+            tg_by_hash: dict[str, int] = {}
+            q = (
+                select(_Auths.telegram_user_id, _Auths.email_hash)
+                .where(
+                    or_(
+                        _Auths.telegram_user_id.in_(tg_ids),
+                        _Auths.email_hash.in_(hashes),
+                    )
                 )
-                session.add(dbo)
-            else:
-                dbo.authenticated = is_auth
-                dbo.when = t
-            session.commit()
+                .with_for_update()
+            )
+            for tg_id, email_hash in session.execute(q):
+                hash_by_tg[tg_id] = email_hash
+                if email_hash:
+                    tg_by_hash[email_hash] = tg_id
+
+            inserts: dict[int, dict] = {}
+            updates: dict[int, dict] = {}
+            for uid, is_auth in batch:
+                tg_id, email_hash = uid.telegram_user_id, uid.email_hash
+                if tg_id is None:
+                    raise ValueError(f"No telegram id in {uid}")
+                if email_hash and (
+                    hash_by_tg.get(tg_id, email_hash) != email_hash
+                    or tg_by_hash.get(email_hash, tg_id) != tg_id
+                ):
+                    res.rejected.append(uid)
+                    continue
+                row = {"telegram_user_id": tg_id, "authenticated": is_auth, "when": t}
+                if tg_id in inserts:
+                    inserts[tg_id].update(row)
+                elif tg_id in hash_by_tg:
+                    updates[tg_id] = row
+                else:
+                    inserts[tg_id] = dict(row, email_hash=email_hash)
+                    hash_by_tg[tg_id] = email_hash
+                    if email_hash:
+                        tg_by_hash[email_hash] = tg_id
+                res.imported += 1
+
+            if inserts:
+                session.execute(insert(_Auths), list(inserts.values()))
+            if updates:
+                session.execute(update(_Auths), list(updates.values()))
+
+    @staticmethod
+    def _get_auths(
+        session: Session, uid: RepSysUserId, for_update: bool = False
+    ) -> tuple[Optional["_Auths"], Optional["_Auths"]]:
+        conds = []
+        if uid.telegram_user_id is not None:
+            conds.append(_Auths.telegram_user_id == uid.telegram_user_id)
+        if uid.email_hash is not None:
+            conds.append(_Auths.email_hash == uid.email_hash)
+        if not conds:
+            raise ValueError("Either telegram_user_id or email_hash must be set")
+        q = select(_Auths).where(or_(*conds))
+        if for_update:
+            q = q.with_for_update()
+        by_tg = by_email = None
+        for dbo in session.scalars(q):
+            if uid.telegram_user_id is not None and (
+                dbo.telegram_user_id == uid.telegram_user_id
+            ):
+                by_tg = dbo
+            if uid.email_hash is not None and dbo.email_hash == uid.email_hash:
+                by_email = dbo
+        return by_tg, by_email
+
+
+def _to_record(dbo: Optional["_Auths"]) -> Optional[AuthRecord]:
+    if dbo is None:
+        return None
+    return AuthRecord(
+        RepSysUserId(dbo.telegram_user_id, dbo.email_hash), dbo.authenticated, dbo.when
+    )
 
 
 class _Base(DeclarativeBase):
@@ -69,13 +221,70 @@ class T(TestCase):
 
     def test_empty(self):
         eng = create_engine("sqlite://")
+        schema.create_all(eng)
         rs = RepSysDb(eng)
         self.assertRaises(KeyError, rs.get_auth_record, RepSysUserId(123))
 
     def test_set(self):
         eng = create_engine("sqlite://")
+        schema.create_all(eng)
         rs = RepSysDb(eng)
         rs.set_authenticity(RepSysUserId(123), True)
         self.assertTrue(rs.get_auth_record(RepSysUserId(123)).authenticated)
         rs.set_authenticity(RepSysUserId(123), False)
         self.assertFalse(rs.get_auth_record(RepSysUserId(123)).authenticated)
+
+    def test_get_auth_records(self):
+        eng = create_engine("sqlite://")
+        schema.create_all(eng)
+        rs = RepSysDb(eng)
+        rs.set_authenticity(RepSysUserId(123, "hash"), True)
+        rs.set_authenticity(RepSysUserId(555), True)
+        rec1, rec2 = rs.get_auth_records(RepSysUserId(555, "hash"))
+        assert rec1 and rec2
+        self.assertEqual(RepSysUserId(555), rec1.uid)
+        self.assertEqual(RepSysUserId(123, "hash"), rec2.uid)
+        self.assertEqual((None, None), rs.get_auth_records(RepSysUserId(7, "h")))
+
+    def test_inconsistent(self):
+        eng = create_engine("sqlite://")
+        schema.create_all(eng)
+        rs = RepSysDb(eng)
+        rs.set_authenticity(RepSysUserId(123, "hash"), False)
+        self.assertRaises(
+            ValueError, rs.set_authenticity, RepSysUserId(555, "hash"), True
+        )
+        self.assertRaises(
+            ValueError, rs.set_authenticity, RepSysUserId(123, "hash2"), True
+        )
+        self.assertFalse(rs.get_auth_record(RepSysUserId(123)).authenticated)
+        self.assertRaises(KeyError, rs.get_auth_record, RepSysUserId(555))
+
+    def test_import_export(self):
+        eng = create_engine("sqlite://")
+        schema.create_all(eng)
+        rs = RepSysDb(eng)
+        rs.set_authenticity(RepSysUserId(1, "taken"), True)
+        rs.set_authenticity(RepSysUserId(2), False)
+        res = rs.import_auths(
+            [
+                (RepSysUserId(2), True),  # updated
+                (RepSysUserId(3, "h3"), True),
+                (RepSysUserId(4, "taken"), True),  # rejected
+                (RepSysUserId(5, "h3"), True),  # rejected, taken in the same batch
+                (RepSysUserId(1, "other"), True),  # rejected
+            ]
+            + [(RepSysUserId(i), True) for i in range(10, 20)],
+            batch_size=4,
+        )
+        self.assertEqual(12, res.imported)
+        self.assertEqual(
+            [RepSysUserId(4, "taken"), RepSysUserId(5, "h3"), RepSysUserId(1, "other")],
+            res.rejected,
+        )
+        recs = list(rs.export_auths(chunk_size=5))
+        self.assertEqual(
+            [1, 2, 3] + list(range(10, 20)), [r.uid.telegram_user_id for r in recs]
+        )
+        self.assertTrue(all(r.authenticated for r in recs))
+        self.assertEqual("h3", rs.get_auth_record(RepSysUserId(3)).uid.email_hash)
@@ -0,0 +1,39 @@
+"""
+The DB schema of all the modules, created once at startup.
+"""
+
+import unittest
+from sqlalchemy import Engine, MetaData, create_engine, inspect
+
+
+def all_metadata() -> list[MetaData]:
+    # imported here, the modules themselves use this one
+    from .db_sqla import _Base as exchange
+    from .session_store import _Base as sessions
+    from .comms.email_outbox import _Base as email_outbox
+    from .rep_sys.rep_sys_db import _Base as rep_sys
+    from .rep_sys.email_auth import _Base as email_auth
+
+    return [
+        base.metadata
+        for base in (exchange, sessions, email_outbox, rep_sys, email_auth)
+    ]
+
+
+def create_all(eng: Engine) -> None:
+    """Create the missing tables, in one transaction"""
+    with eng.begin() as conn:
+        for metadata in all_metadata():
+            metadata.create_all(conn)
+
+
+class T(unittest.TestCase):
+    def test_create_all(self):
+        eng = create_engine("sqlite://")
+        create_all(eng)
+        create_all(eng)
+        tables = set(inspect(eng).get_table_names())
+        for metadata in all_metadata():
+            self.assertLessEqual(set(metadata.tables), tables)
+        self.assertIn("email_auth_states", tables)
+        self.assertIn("auths", tables)
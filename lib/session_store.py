@@ -0,0 +1,255 @@
+"""
+The users' dialog sessions: a bounded in-memory cache over a DB table.
+"""
+
+import collections
+import io
+import logging
+import pickle
+import threading
+import time
+from typing import Any
+import unittest
+from unittest import mock
+from sqlalchemy import Engine, LargeBinary, create_engine, delete
+from sqlalchemy.orm import DeclarativeBase, mapped_column, Mapped, Session
+from sqlalchemy.pool import StaticPool
+from . import schema
+
+
+class SessionStore:
+    """
+    Dialog trees by user id, the recently used ones in memory.
+
+    At most `capacity` trees are kept in memory, and none idle for longer than
+    `idle_ttl_sec`. Evicted trees are pickled to the DB and restored on the user's
+    next get(), save_all() on shutdown keeps them over restarts. Objects shared by
+    all the trees (the application, the exchange...) are passed as `services`,
+    they are pickled by name and restored as the same objects.
+
+    A tree which can't be pickled is dropped, the user starts over then.
+    The table is created by schema.create_all().
+    """
+
+    def __init__(
+        self,
+        db_eng: Engine,
+        services: dict[str, Any],
+        capacity: int = 10000,
+        idle_ttl_sec: float = 30 * 60,
+    ):
+        self._db_eng = db_eng
+        self._services = services
+        self._names = {id(obj): name for name, obj in services.items()}
+        self._capacity = capacity
+        self._idle_ttl_sec = idle_ttl_sec
+        self._lock = threading.Lock()
+        # user id -> (last used, tree), the least recently used first
+        self._trees: collections.OrderedDict[int, tuple[float, Any]] = (
+            collections.OrderedDict()
+        )
+        # user id -> [tree, saves in progress], evicted trees until they are in the DB
+        self._saving: dict[int, list] = {}
+        # one save at a time, so the last one written has the tree's latest state
+        self._save_lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._trees)
+
+    def get(self, user_id: int) -> Any | None:
+        """The user's tree from memory or the DB, None if there is none"""
+        with self._lock:
+            try:
+                _, tree = self._trees.pop(user_id)
+            except KeyError:
+                saving = self._saving.get(user_id)
+                tree = saving[0] if saving else None
+        if tree is None:
+            tree = self._load(user_id)
+            if tree is None:
+                return None
+        self.put(user_id, tree)
+        return tree
+
+    def put(self, user_id: int, tree: Any) -> None:
+        """Store the tree as the most recently used one, evicting the stale ones"""
+        now = time.time()
+        evicted = []
+        with self._lock:
+            self._trees.pop(user_id, None)
+            self._trees[user_id] = (now, tree)
+            while self._trees:
+                uid, (last_used, _) = next(iter(self._trees.items()))
+                if (
+                    len(self._trees) <= self._capacity
+                    and now - last_used <= self._idle_ttl_sec
+                ):
+                    break
+                t = self._trees.pop(uid)[1]
+                evicted.append((uid, t))
+                saving = self._saving.setdefault(uid, [t, 0])
+                saving[0] = t
+                saving[1] += 1
+        for uid, t in evicted:
+            try:
+                self._save(uid, t)
+            finally:
+                with self._lock:
+                    saving = self._saving[uid]
+                    saving[1] -= 1
+                    if not saving[1]:
+                        del self._saving[uid]
+
+    def save_all(self) -> None:
+        """Write all the trees in memory to the DB"""
+        with self._lock:
+            trees = [(uid, t) for uid, (_, t) in self._trees.items()]
+        for uid, t in trees:
+            self._save(uid, t)
+
+    def _save(self, user_id: int, tree: Any) -> None:
+        with self._save_lock:
+            self._save_locked(user_id, tree)
+
+    def _save_locked(self, user_id: int, tree: Any) -> None:
+        f = io.BytesIO()
+        pickler = pickle.Pickler(f)
+        pickler.persistent_id = lambda obj: self._names.get(id(obj))  # type: ignore
+        try:
+            pickler.dump(tree)
+        except Exception:
+            logging.exception(f"Can't save the session of {user_id}, dropping it")
+            self._delete(user_id)
+            return
+        with Session(self._db_eng) as session:
+            session.merge(
+                _DialogSession(
+                    user_id=user_id, data=f.getvalue(), when=int(time.time())
+                )
+            )
+            session.commit()
+
+    def _load(self, user_id: int) -> Any | None:
+        with Session(self._db_eng) as session:
+            dbo = session.get(_DialogSession, user_id)
+            if dbo is None:
+                return None
+            data = dbo.data
+        unpickler = pickle.Unpickler(io.BytesIO(data))
+        unpickler.persistent_load = self._services.__getitem__  # type: ignore
+        try:
+            return unpickler.load()
+        except Exception:
+            # e.g. saved by an older version of the dialogs
+            logging.exception(f"Can't restore the session of {user_id}, dropping it")
+            self._delete(user_id)
+            return None
+
+    def _delete(self, user_id: int) -> None:
+        with Session(self._db_eng) as session:
+            session.execute(
+                delete(_DialogSession).where(_DialogSession.user_id == user_id)
+            )
+            session.commit()
+
+
+class _Base(DeclarativeBase):
+    pass
+
+
+class _DialogSession(_Base):
+    __tablename__ = "dialog_sessions"
+
+    user_id: Mapped[int] = mapped_column(primary_key=True)
+    data: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+    when: Mapped[int] = mapped_column(nullable=False)
+
+
+class _Service:
+    pass
+
+
+class _Dialog:
+    def __init__(self, service: _Service):
+        self.service = service
+        self.step = 0
+
+
+class T(unittest.TestCase):
+    def setUp(self):
+        # the same in-memory DB for the threads saving
+        self.eng = create_engine(
+            "sqlite://",
+            poolclass=StaticPool,
+            connect_args={"check_same_thread": False},
+        )
+        schema.create_all(self.eng)
+        self.service = _Service()
+        self.store = self.mk_store()
+
+    def mk_store(self, **kwargs) -> SessionStore:
+        return SessionStore(self.eng, {"service": self.service}, **kwargs)
+
+    def test_lru(self):
+        store = self.mk_store(capacity=2)
+        dialogs = [_Dialog(self.service) for _ in range(3)]
+        for uid, d in enumerate(dialogs):
+            d.step = uid + 10
+            store.put(uid, d)
+        store.get(1)
+        self.assertEqual(2, len(store))
+        self.assertIs(dialogs[2], store.get(2))
+
+        d0 = store.get(0)  # restored from the DB, 1 is evicted instead of it
+        self.assertIsNot(dialogs[0], d0)
+        self.assertEqual(10, d0.step)
+        self.assertIs(self.service, d0.service)
+        self.assertEqual([2, 0], list(store._trees))
+        self.assertEqual(11, store.get(1).step)
+
+    def test_idle_ttl(self):
+        self.store.put(1, _Dialog(self.service))
+        with mock.patch("time.time", return_value=time.time() + 31 * 60):
+            self.store.put(2, _Dialog(self.service))
+        self.assertEqual([2], list(self.store._trees))
+        self.assertIsNotNone(self.store.get(1))
+
+    def test_restart(self):
+        d = _Dialog(self.service)
+        d.step = 3
+        self.store.put(1, d)
+        self.store.save_all()
+        self.assertEqual(3, self.mk_store().get(1).step)
+        self.assertIsNone(self.mk_store().get(2))
+
+    def test_unpicklable(self):
+        d = _Dialog(self.service)
+        d.step = lambda: None  # type: ignore
+        self.store.put(1, d)
+        with self.assertLogs(level="ERROR"):
+            self.store.save_all()
+        self.assertIsNone(self.mk_store().get(1))
+
+    def test_get_while_saving(self):
+        store = self.mk_store(capacity=1)
+        d = _Dialog(self.service)
+        store.put(1, d)
+        saving, release = threading.Event(), threading.Event()
+        save = store._save_locked
+
+        def slow_save(user_id, tree):
+            saving.set()
+            release.wait(10)
+            save(user_id, tree)
+
+        store._save_locked = slow_save  # type: ignore
+        evicting = threading.Thread(target=store.put, args=(2, _Dialog(self.service)))
+        evicting.start()
+        try:
+            self.assertTrue(saving.wait(10))
+            store._capacity = 2  # get() mustn't evict and wait for the save
+            self.assertIs(d, store.get(1))  # neither in memory nor in the DB yet
+        finally:
+            release.set()
+            evicting.join()
+        self.assertEqual({}, store._saving)
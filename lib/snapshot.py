@@ -0,0 +1,237 @@
+"""
+Binary snapshot of the exchange's order book, for a fast warm start.
+
+Layout (little-endian):
+    header:  magic b"EXSN", format version (H), crc32 of the payload (I)
+    payload: changes seq (q), last match price (opt), rate (opt), rate date (str),
+             orders count (I), orders
+    order:   id (q), type (B), lifetime_sec (q), creation_time (d), price (q, x10^4),
+             amount_initial, amount_left, min_op_threshold (q, x10^2),
+             relative_rate (q, x10^4), user id (q), user name (str)
+    opt:     is set (?) + value (q, x10^4)
+    str:     length (H) + utf-8
+"""
+
+import dataclasses
+from decimal import Decimal
+import os
+import struct
+import tempfile
+import unittest
+import zlib
+from . import data, fixed_point
+from .fixed_point import AMOUNT_SCALE, PRICE_SCALE
+
+_MAGIC = b"EXSN"
+_VERSION = 1
+_HEADER = struct.Struct("<4sHI")
+_SEQ = struct.Struct("<q")
+_OPT = struct.Struct("<?q")
+_STR_LEN = struct.Struct("<H")
+_COUNT = struct.Struct("<I")
+_ORDER = struct.Struct("<qBqdqqqqqq")
+
+
+@dataclasses.dataclass
+class BookSnapshot:
+    changes_seq: int  # the DB's order changes high-water mark the book corresponds to
+    orders: list[data.Order]
+    last_match_price: Decimal | None = None
+    currency_rate: dict | None = None
+
+
+def write(path: str, snapshot: BookSnapshot) -> None:
+    """Write the snapshot atomically"""
+    write_bytes(path, dumps(snapshot))
+
+
+def write_bytes(path: str, b: bytes) -> None:
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(b)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def read(path: str) -> BookSnapshot:
+    """Read the snapshot, raises ValueError if it is broken or of an unknown version"""
+    with open(path, "rb") as f:
+        return loads(f.read())
+
+
+def dumps(snapshot: BookSnapshot) -> bytes:
+    rate = snapshot.currency_rate
+    parts = [
+        _SEQ.pack(snapshot.changes_seq),
+        _pack_opt(snapshot.last_match_price),
+        _pack_opt(rate["rate"] if rate else None),
+        _pack_str(str(rate["date"]) if rate and rate["date"] is not None else ""),
+        _COUNT.pack(len(snapshot.orders)),
+    ]
+    for o in snapshot.orders:
+        parts.append(
+            _ORDER.pack(
+                o._id,
+                int(o.type),
+                o.lifetime_sec,
+                o.creation_time,
+                fixed_point.from_decimal(o.price, PRICE_SCALE),
+                fixed_point.from_decimal(o.amount_initial, AMOUNT_SCALE),
+                fixed_point.from_decimal(o.amount_left, AMOUNT_SCALE),
+                fixed_point.from_decimal(o.min_op_threshold, AMOUNT_SCALE),
+                fixed_point.from_decimal(o.relative_rate, PRICE_SCALE),
+                o.user.id,
+            )
+        )
+        parts.append(_pack_str(o.user.name))
+    payload = b"".join(parts)
+    return _HEADER.pack(_MAGIC, _VERSION, zlib.crc32(payload)) + payload
+
+
+def loads(b: bytes) -> BookSnapshot:
+    if len(b) < _HEADER.size:
+        raise ValueError("Snapshot is truncated")
+    magic, version, crc = _HEADER.unpack_from(b)
+    if magic != _MAGIC:
+        raise ValueError("Not a snapshot")
+    if version != _VERSION:
+        raise ValueError(f"Unsupported snapshot version: {version}")
+    payload = memoryview(b)[_HEADER.size :]
+    if zlib.crc32(payload) != crc:
+        raise ValueError("Snapshot checksum mismatch")
+
+    try:
+        (seq,) = _SEQ.unpack_from(payload)
+        pos = _SEQ.size
+        last_match_price, pos = _unpack_opt(payload, pos)
+        rate, pos = _unpack_opt(payload, pos)
+        rate_date, pos = _unpack_str(payload, pos)
+        (cnt,) = _COUNT.unpack_from(payload, pos)
+        pos += _COUNT.size
+        orders = []
+        for _ in range(cnt):
+            fields = _ORDER.unpack_from(payload, pos)
+            pos += _ORDER.size
+            user_name, pos = _unpack_str(payload, pos)
+            orders.append(_mk_order(fields, user_name))
+    except struct.error as e:
+        raise ValueError(f"Snapshot is truncated: {e}")
+
+    return BookSnapshot(
+        seq,
+        orders,
+        last_match_price,
+        {"rate": rate, "date": rate_date or None} if rate is not None else None,
+    )
+
+
+def _mk_order(fields: tuple, user_name: str) -> data.Order:
+    (
+        _id,
+        type_,
+        lifetime_sec,
+        creation_time,
+        price,
+        amount_initial,
+        amount_left,
+        min_op_threshold,
+        relative_rate,
+        user_id,
+    ) = fields
+    o = data.Order(
+        user=data.User(user_id, user_name),
+        type=data.OrderType(type_),
+        price=fixed_point.to_decimal(price, PRICE_SCALE),
+        amount_initial=fixed_point.to_decimal(amount_initial, AMOUNT_SCALE),
+        min_op_threshold=fixed_point.to_decimal(min_op_threshold, AMOUNT_SCALE),
+        lifetime_sec=lifetime_sec,
+        creation_time=(
+            int(creation_time) if creation_time.is_integer() else creation_time
+        ),
+        _id=_id,
+        amount_left=fixed_point.to_decimal(amount_left, AMOUNT_SCALE),
+        relative_rate=fixed_point.to_decimal(relative_rate, PRICE_SCALE),
+    )
+    o.mark_clean()  # it mirrors the DB
+    return o
+
+
+def _pack_opt(value: Decimal | None) -> bytes:
+    return _OPT.pack(
+        value is not None,
+        fixed_point.from_decimal(value, PRICE_SCALE) if value is not None else 0,
+    )
+
+
+def _unpack_opt(b: memoryview, pos: int) -> tuple[Decimal | None, int]:
+    is_set, value = _OPT.unpack_from(b, pos)
+    return (
+        fixed_point.to_decimal(value, PRICE_SCALE) if is_set else None,
+        pos + _OPT.size,
+    )
+
+
+def _pack_str(s: str) -> bytes:
+    encoded = s.encode()
+    return _STR_LEN.pack(len(encoded)) + encoded
+
+
+def _unpack_str(b: memoryview, pos: int) -> tuple[str, int]:
+    (n,) = _STR_LEN.unpack_from(b, pos)
+    pos += _STR_LEN.size
+    if pos + n > len(b):
+        raise struct.error("string is out of the buffer")
+    return bytes(b[pos : pos + n]).decode(), pos + n
+
+
+class T(unittest.TestCase):
+    def setUp(self):
+        o = data.Order(
+            data.User(1, "Joe"),
+            data.OrderType.SELL,
+            Decimal("98.1234"),
+            Decimal("1299.50"),
+            Decimal("500.00"),
+            creation_time=1700000000,
+            _id=7,
+            relative_rate=Decimal("1.0100"),
+        )
+        o.amount_left = Decimal("299.50")
+        self.snapshot = BookSnapshot(
+            42,
+            [o],
+            Decimal("98.5"),
+            {"rate": Decimal("4.5400"), "date": "2024-01-21 00:00:00+00"},
+        )
+
+    def test_round_trip(self):
+        res = loads(dumps(self.snapshot))
+        self.assertEqual(self.snapshot, res)
+        self.assertEqual(str(self.snapshot.orders[0]), str(res.orders[0]))
+        self.assertEqual(set(), res.orders[0].dirty_fields)
+
+    def test_empty(self):
+        snapshot = BookSnapshot(0, [])
+        self.assertEqual(snapshot, loads(dumps(snapshot)))
+
+    def test_corrupted(self):
+        b = bytearray(dumps(self.snapshot))
+        b[-1] ^= 1
+        self.assertRaisesRegex(ValueError, "checksum", loads, bytes(b))
+        self.assertRaisesRegex(ValueError, "truncated", loads, b[:5])
+        self.assertRaisesRegex(ValueError, "Not a snapshot", loads, b"x" * 20)
+
+    def test_version(self):
+        b = dumps(self.snapshot)
+        b = _HEADER.pack(_MAGIC, _VERSION + 1, 0) + b[_HEADER.size :]
+        self.assertRaisesRegex(ValueError, "version", loads, b)
+
+    def test_file(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "book.snapshot")
+            write(path, self.snapshot)
+            self.assertEqual(self.snapshot, read(path))
+            self.assertEqual(["book.snapshot"], os.listdir(d))
@@ -65,6 +65,16 @@ class TestMain(ExchgTestBase):
         self.tg.emulate_incoming_message(777, "Noob", "ab@example.com")
         self.assertIn("Неверный email", self.tg.outgoing[-2].text)
 
+    def test_email_authenticator_cached(self):
+        au = self.app.get_email_authenticator(RepSysUserId(222))
+        self.assertIs(au, self.app.get_email_authenticator(RepSysUserId(222)))
+        self.assertIsNot(au, self.app.get_email_authenticator(RepSysUserId(333)))
+
+    def test_email_authenticator_held_after_eviction(self):
+        au = self.app.get_email_authenticator(RepSysUserId(222))
+        self.app._email_authenticators.clear()  # evicted, still held here
+        self.assertIs(au, self.app.get_email_authenticator(RepSysUserId(222)))
+
 
 class TestEnterEmailStep(ExchgTestBase):
     def setUp(self):
@@ -102,6 +112,7 @@ class TestEnterCodeStep(ExchgTestBase):
 
     def test_ask_code(self):
         self.assertIn("Введите код:", self.tg.outgoing[-1].text)
+        self.assertIn("Код отправлен на почту", self.tg.outgoing[-1].text)
 
     def test_cancel(self):
         self.tg.emulate_incoming_message(222, "Noob", "", keyboard_callback="cancel")
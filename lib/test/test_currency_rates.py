@@ -58,6 +58,23 @@ class TestCurrencyFreaksClient(unittest.TestCase):
         self.assertEqual(client.get_rate("RUB")["rate"], 78.5)
         self.assertEqual(client.get_rate("AMD")["rate"], 520.75)
 
+    @patch("currency_rates.requests.get")
+    @patch("logging.error")
+    def test_update_rates_notifies_on_change(self, mock_error, mock_get):
+        mock_get.return_value.status_code = 200
+        mock_get.return_value.json.return_value = {
+            "rates": {"RUB": 78.5, "AMD": 520.75}
+        }
+        client = CurrencyFreaksClient("API_KEY")
+        notifications = []
+        client.subscribe(lambda: notifications.append(client.get_rate("AMD")))
+        client.update_rates()
+        self.assertEqual(notifications, [])
+        mock_get.return_value.json.return_value = {"rates": {"RUB": 78.5, "AMD": 521.0}}
+        client.update_rates()
+        self.assertEqual(1, len(notifications))
+        self.assertEqual(521.0, notifications[0]["rate"])
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -1,9 +1,15 @@
+import importlib.util
+import random
 import time
 import unittest
 import threading
 import logging
 from decimal import Decimal
 import os
+import tempfile
+from unittest.mock import patch
+from sqlalchemy import text
+from .. import snapshot
 from ..exchange import Exchange
 from ..db_sqla import SqlDb
 from ..data import Order, User, OrderType
@@ -43,6 +49,21 @@ class T(unittest.TestCase):
         self.assertEqual(self.matches[0].sell_order.amount_left, 0)
         self.assertEqual(self.matches[0].buy_order.amount_left, 0)
 
+    def testRestingOrderRematchedAfterThresholdLowered(self):
+        self.exchange.place_order(Order(User(1), OrderType.BUY, 95.0, 2000.0, 1000.0))
+        self.exchange.place_order(Order(User(2), OrderType.SELL, 90.0, 900.0, 100.0))
+        self.assertEqual([], self.matches)
+        # the fill leaves the buyer 800, below its threshold, so the resting seller fits
+        fills = self.exchange.place_order(
+            Order(User(3), OrderType.SELL, 85.0, 1200.0, 100.0)
+        )
+        self.assertEqual([1200, 800], [m.amount for m in fills])
+        self.assertEqual([1200, 800], [m.amount for m in self.matches])
+        self.assertEqual(2, fills[1].sell_order._id)
+        self.assertEqual(
+            [(2, 100)], [(o._id, o.amount_left) for o in self.exchange._orders.values()]
+        )
+
     def testProcessMatchesMultipleMatches(self):
         self.exchange.place_order(
             Order(User(1), OrderType.SELL, 10.0, 50.0, 50.0, lifetime_sec=48 * 60 * 60)
@@ -328,6 +349,271 @@ class T(unittest.TestCase):
         del result["currency_rate"]
         self.assertEqual(result, expected_result)
 
+    def testProcessMatchesTimePriority(self):
+        now = int(time.time())
+        self.exchange.place_order(
+            Order(User(1), OrderType.SELL, 10.0, 50.0, 50.0, creation_time=now - 10)
+        )
+        self.exchange.place_order(
+            Order(User(2), OrderType.SELL, 10.0, 50.0, 50.0, creation_time=now - 20)
+        )
+        self.exchange.place_order(Order(User(3), OrderType.BUY, 10.0, 50.0, 50.0))
+        self.assertEqual(len(self.matches), 1)
+        self.assertEqual(self.matches[0].sell_order.user.id, 2)
+        self.assertEqual([o.user.id for o in self.exchange._orders.values()], [1])
+
+    def testProcessMatchesSkipsUnsuitableThreshold(self):
+        self.exchange.place_order(Order(User(1), OrderType.SELL, 9.0, 100.0, 100.0))
+        self.exchange.place_order(Order(User(2), OrderType.SELL, 9.5, 100.0, 20.0))
+        self.exchange.place_order(Order(User(3), OrderType.BUY, 10.0, 50.0, 10.0))
+        self.assertEqual(len(self.matches), 1)
+        self.assertEqual(self.matches[0].sell_order.user.id, 2)
+        self.assertEqual(self.matches[0].amount, 50)
+
+    def testOrderBookSidesOrdering(self):
+        for i, (t, price) in enumerate(
+            [(OrderType.SELL, 12.0), (OrderType.SELL, 11.0), (OrderType.BUY, 9.0)]
+            + [(OrderType.BUY, 10.0), (OrderType.SELL, 11.0)]
+        ):
+            self.exchange.place_order(Order(User(i), t, price, 100.0, 100.0))
+        sellers = [(o.price, o.user.id) for o in self.exchange._orders.sellers]
+        buyers = [(o.price, o.user.id) for o in self.exchange._orders.buyers]
+        self.assertEqual(sellers, [(11, 1), (11, 4), (12, 0)])
+        self.assertEqual(buyers, [(10, 3), (9, 2)])
+        self.assertEqual(self.exchange._orders.sellers.best().user.id, 1)
+
+    def testPlaceOrderReturnsFills(self):
+        self.assertEqual(
+            self.exchange.place_order(Order(User(1), OrderType.SELL, 10.0, 50.0, 50.0)),
+            [],
+        )
+        self.exchange.place_order(Order(User(2), OrderType.SELL, 9.0, 50.0, 50.0))
+        fills = self.exchange.place_order(
+            Order(User(3), OrderType.BUY, 10.0, 100.0, 50.0)
+        )
+        self.assertEqual(fills, self.matches)
+        self.assertEqual([m.sell_order.user.id for m in fills], [2, 1])
+
+    def testRelativeRateOrderMatchedAfterRatesUpdate(self):
+        self.exchange.place_order(
+            Order(User(1), OrderType.BUY, 1, 100.0, 50.0, relative_rate=Decimal("1.0"))
+        )
+        self.exchange.place_order(Order(User(2), OrderType.SELL, 5.0, 100.0, 50.0))
+        self.assertEqual(len(self.matches), 0)
+        self.assertEqual(self.exchange._orders[1].price, Decimal("4.54"))
+
+        self.exchange.currency_converter.currency_client.rates["AMD"] = 0.6
+        fills = self.exchange.on_rates_updated()
+        self.assertEqual(len(fills), 1)
+        self.assertEqual(fills[0].price, Decimal("5.5"))
+        self.assertEqual(len(self.exchange._orders), 0)
+
+    def testExpiredOrdersRemovedFromDb(self):
+        self.exchange.place_order(
+            Order(User(1), OrderType.BUY, 10.0, 50.0, 50.0, lifetime_sec=60)
+        )
+        self.exchange.place_order(
+            Order(User(2), OrderType.BUY, 10.0, 50.0, 50.0, lifetime_sec=120)
+        )
+        with patch("time.time", return_value=time.time() + 90):
+            self.exchange._check_order_lifetime()
+        self.assertEqual([o.user.id for o in self.exchange._orders.values()], [2])
+        orders = []
+        self.db.iterate_orders(orders.append)
+        self.assertEqual([o.user.id for o in orders], [2])
+
+    def testScheduledExpiryCheck(self):
+        self.exchange.place_order(
+            Order(User(1), OrderType.BUY, 10.0, 50.0, 50.0, lifetime_sec=60)
+        )
+        with patch("time.time", return_value=time.time() + 90):
+            timer = self.exchange.schedule_expiry_check(0.05)
+            time.sleep(0.3)
+            timer.cancel()
+        self.assertEqual(len(self.exchange._orders), 0)
+
+    def testRelativeRateOrdersRepricedOnRatesUpdateOnly(self):
+        currency_client = self.exchange.currency_converter.currency_client
+        self.exchange.place_order(
+            Order(User(1), OrderType.BUY, 1, 100.0, 50.0, relative_rate=Decimal("1.0"))
+        )
+        self.assertEqual(self.exchange._orders[1].price, Decimal("4.54"))
+        self.assertEqual(self.db.get_order(1).price, Decimal("4.54"))
+
+        currency_client.rates["AMD"] = 0.5  # changed behind the exchange's back
+        self.exchange.place_order(Order(User(2), OrderType.SELL, 5.0, 100.0, 50.0))
+        self.exchange.get_stats()
+        self.assertEqual(self.exchange._orders[1].price, Decimal("4.54"))
+
+        currency_client.set_rates({"RUB": 0.1, "AMD": 0.55})
+        self.assertEqual(len(self.matches), 1)
+        self.assertEqual(self.matches[0].price, Decimal("5.25"))
+        self.assertEqual(self.exchange.currency_rate["rate"], Decimal("5.5"))
+
+    def testRepriceAtSameRateKeepsPrices(self):
+        # more digits than the book keeps, and 4.54 * 1.00005 isn't on the grid
+        self.exchange.place_order(
+            Order(
+                User(1), OrderType.BUY, 1, 100.0, 50.0, relative_rate=Decimal("1.00005")
+            )
+        )
+        price = self.exchange._orders[1].price
+        self.assertEqual(price, self.db.get_order(1).price)
+        self.exchange.on_rates_updated()
+        self.assertEqual(price, self.exchange._orders[1].price)
+        self.assertEqual(price, self.db.get_order(1).price)
+
+    def testGetStatsFollowsBookChanges(self):
+        self.exchange.place_order(Order(User(1), OrderType.SELL, 10.0, 100.0, 10.0))
+        self.exchange.place_order(Order(User(1), OrderType.SELL, 11.0, 100.0, 10.0))
+        stats = self.exchange.get_stats()
+        self.assertIs(stats["text"], self.exchange.get_stats()["text"])
+        self.assertEqual(stats["data"]["user_cnt"], 1)
+        self.assertEqual(stats["data"]["total_amount_sellers"], 200)
+
+        self.exchange.place_order(Order(User(2), OrderType.BUY, 10.0, 130.0, 10.0))
+        data = self.exchange.get_stats()["data"]
+        self.assertEqual(data["order_cnt"], 2)
+        self.assertEqual(data["user_cnt"], 2)
+        self.assertEqual(data["total_amount_sellers"], 100)
+        self.assertEqual(data["total_amount_buyers"], 30)
+        self.assertEqual(data["min_seller_price"], 11)
+        self.assertEqual(data["max_buyer_min_op_threshold"], 10)
+        self.assertEqual(data["last_match_price"], 10)
+
+        self.exchange.remove_order(3)
+        data = self.exchange.get_stats()["data"]
+        self.assertEqual(data["user_cnt"], 1)
+        self.assertEqual(data["total_amount_buyers"], 0)
+        self.assertIsNone(data["max_buyer_price"])
+
+    def testUserOrders(self):
+        self.exchange.place_order(Order(User(1), OrderType.SELL, 10.0, 100.0, 10.0))
+        self.exchange.place_order(Order(User(2), OrderType.BUY, 9.0, 100.0, 10.0))
+        self.exchange.place_order(Order(User(1), OrderType.SELL, 11.0, 100.0, 10.0))
+        orders = self.exchange.list_orders_for_user(User(1))
+        self.assertEqual([o._id for o in orders], [1, 3])
+        self.assertEqual(self.exchange.get_user_order(User(1), 3)._id, 3)
+        self.assertIsNone(self.exchange.get_user_order(User(2), 3))
+        self.assertIsNone(self.exchange.get_user_order(User(2), 42))
+
+        self.exchange.place_order(Order(User(3), OrderType.BUY, 10.0, 100.0, 10.0))
+        self.assertEqual(
+            [o._id for o in self.exchange.list_orders_for_user(User(1))], [3]
+        )
+        self.assertEqual(self.exchange.list_orders_for_user(User(3)), [])
+
+    def testRemoveUserOrder(self):
+        self.exchange.place_order(Order(User(1), OrderType.SELL, 10.0, 100.0, 10.0))
+        self.exchange.place_order(Order(User(1), OrderType.SELL, 11.0, 100.0, 10.0))
+        self.assertRaises(ValueError, self.exchange.remove_user_order, User(2), 2)
+        self.exchange.remove_user_order(User(1), 2)
+        self.assertEqual(
+            [1], [o._id for o in self.exchange.list_orders_for_user(User(1))]
+        )
+
+        # validated, then filled before the removal
+        self.assertIsNotNone(self.exchange.get_user_order(User(1), 1))
+        self.exchange.place_order(Order(User(2), OrderType.BUY, 10.0, 100.0, 10.0))
+        with self.assertRaisesRegex(ValueError, "Invalid order id: 1"):
+            self.exchange.remove_user_order(User(1), 1)
+
+    def testMatchCommittedInOneTransaction(self):
+        self.exchange.place_order(Order(User(1), OrderType.SELL, 10.0, 100.0, 50.0))
+        self.exchange.place_order(Order(User(2), OrderType.SELL, 10.0, 100.0, 50.0))
+        with patch.object(
+            self.db, "apply_changes", wraps=self.db.apply_changes
+        ) as apply_changes, patch.object(
+            self.db, "update_order", side_effect=AssertionError
+        ), patch.object(
+            self.db, "remove_order", side_effect=AssertionError
+        ), patch.object(
+            self.db, "store_last_match_price", side_effect=AssertionError
+        ):
+            fills = self.exchange.place_order(
+                Order(User(3), OrderType.BUY, 10.0, 150.0, 50.0)
+            )
+        self.assertEqual(len(fills), 2)
+        apply_changes.assert_called_once()
+        orders = []
+        self.db.iterate_orders(orders.append)
+        self.assertEqual([(o._id, o.amount_left) for o in orders], [(2, 50)])
+        self.assertEqual(self.db.get_last_match_price(), Decimal(10))
+
+    def testConcurrentCommands(self):
+        currency_client = self.exchange.currency_converter.currency_client
+
+        def place(user_id: int):
+            for i in range(30):
+                order_type = OrderType.SELL if (user_id + i) % 2 else OrderType.BUY
+                self.exchange.place_order(
+                    Order(User(user_id), order_type, 98.0 + i % 3, 100.0, 10.0)
+                )
+
+        def update_rates():
+            for i in range(30):
+                currency_client.set_rates({"RUB": 0.1, "AMD": 0.45 + i / 1000})
+
+        threads = [threading.Thread(target=place, args=(u,)) for u in range(4)]
+        threads.append(threading.Thread(target=update_rates))
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        stored = []
+        self.db.iterate_orders(stored.append)
+        self.assertEqual(
+            {o._id: o.amount_left for o in stored},
+            {_id: o.amount_left for _id, o in self.exchange._orders.items()},
+        )
+        placed = Decimal(4 * 30 * 100)
+        matched = sum(m.amount for m in self.matches) * 2
+        self.assertEqual(placed, matched + sum(o.amount_left for o in stored))
+        for u in range(4):
+            self.assertEqual(
+                sorted(o._id for o in stored if o.user.id == u),
+                sorted(o._id for o in self.exchange.list_orders_for_user(User(u))),
+            )
+
+    def testReadsDontWaitForWriter(self):
+        self.exchange.place_order(Order(User(1), OrderType.SELL, 98.0, 100.0, 10.0))
+        self.exchange.get_stats()
+        started, release = threading.Event(), threading.Event()
+
+        def busy():
+            started.set()
+            release.wait(10)
+
+        writer = threading.Thread(target=self.exchange._writer.call, args=(busy,))
+        writer.start()
+        started.wait(10)
+        try:
+            self.assertEqual(1, len(self.exchange.list_orders_for_user(User(1))))
+            self.assertIsNotNone(self.exchange.get_user_order(User(1), 1))
+            self.assertEqual(1, self.exchange.get_stats()["data"]["order_cnt"])
+        finally:
+            release.set()
+            writer.join()
+
+    def testMatchesReportedInCallingThread(self):
+        threads = []
+        self.exchange._on_match = lambda m: threads.append(threading.current_thread())
+        self.exchange.place_order(Order(User(1), OrderType.SELL, 98.0, 100.0, 10.0))
+        self.exchange.place_order(Order(User(2), OrderType.BUY, 98.0, 100.0, 10.0))
+        self.assertEqual([threading.current_thread()], threads)
+
+    def testClose(self):
+        timer = self.exchange.schedule_expiry_check()
+        self.exchange.close()
+        self.assertFalse(self.exchange._writer._thread.is_alive())
+        timer.join(1)
+        self.assertFalse(timer.is_alive())
+        with self.assertRaisesRegex(RuntimeError, "closed"):
+            self.exchange.place_order(Order(User(1), OrderType.SELL, 98.0, 100.0, 10.0))
+        self.assertEqual([], self.exchange.list_orders_for_user(User(1)))
+        self.exchange.close()
+
 
 class ExchangeTestsWithDatabaseFile(unittest.TestCase):
     no = 0
@@ -369,3 +655,197 @@ class ExchangeTestsWithDatabaseFile(unittest.TestCase):
         )
         self.assertEqual(len(self.matches), 1)
         self.assertEqual(len(self.exchange._orders), 0)
+
+    def testExpiredOrdersSkippedOnRestart(self):
+        self.exchange.place_order(
+            Order(User(1), OrderType.SELL, 98.0, 1400.0, 100.0, lifetime_sec=60)
+        )
+        self.exchange.place_order(
+            Order(User(2), OrderType.SELL, 98.0, 1400.0, 100.0, lifetime_sec=600)
+        )
+        with patch("time.time", return_value=time.time() + 120):
+            self.exchange = Exchange(
+                self.db,
+                CurrencyConverter(CurrencyMockClient()),
+                lambda m: self.matches.append(m),
+            )
+        self.assertEqual(list(self.exchange._orders.keys()), [2])
+        orders = []
+        self.db.iterate_orders(orders.append)
+        self.assertEqual([o._id for o in orders], [2])
+
+    def testWarmStartFromSnapshot(self):
+        snapshot_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(snapshot_dir.cleanup)
+        snapshot_path = os.path.join(snapshot_dir.name, "book.snapshot")
+        db = SqlDb(log_order_changes=True)
+
+        def mk_exchange():
+            return Exchange(
+                db,
+                CurrencyConverter(CurrencyMockClient()),
+                lambda m: self.matches.append(m),
+                snapshot_path=snapshot_path,
+            )
+
+        ex = mk_exchange()
+        for i, price in enumerate([98.0, 99.0, 100.0]):
+            ex.place_order(Order(User(i), OrderType.SELL, price, 1000.0, 100.0))
+        ex.place_order(Order(User(3), OrderType.BUY, 97.0, 500.0, 100.0))
+        ex.write_snapshot()
+
+        # changed after the snapshot: a fill, a removal and a new order
+        ex.place_order(Order(User(4), OrderType.BUY, 98.0, 400.0, 100.0))
+        ex.remove_order(2)
+        ex.place_order(Order(User(5), OrderType.BUY, 96.0, 300.0, 100.0))
+
+        with patch.object(db, "iterate_orders") as iterate_orders:
+            restarted = mk_exchange()
+            iterate_orders.assert_not_called()
+        self.assertEqual(dict(ex._orders), dict(restarted._orders))
+        self.assertEqual([1, 3], [o._id for o in restarted._orders.sellers])
+        self.assertEqual(Decimal(600), restarted._orders[1].amount_left)
+        self.assertEqual(ex.last_match_price, restarted.last_match_price)
+
+        with open(snapshot_path, "r+b") as f:
+            f.seek(-1, os.SEEK_END)
+            f.write(b"\0")
+        restarted = mk_exchange()  # falls back to the DB
+        self.assertEqual(dict(ex._orders), dict(restarted._orders))
+
+    def testSnapshotNotMatchingDb(self):
+        snapshot_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(snapshot_dir.cleanup)
+        snapshot_path = os.path.join(snapshot_dir.name, "book.snapshot")
+        db = SqlDb(log_order_changes=True)
+
+        def mk_exchange():
+            return Exchange(
+                db, CurrencyConverter(CurrencyMockClient()), snapshot_path=snapshot_path
+            )
+
+        def assert_loaded_from_db(ids):
+            with patch.object(
+                db, "iterate_orders", wraps=db.iterate_orders
+            ) as iterate_orders:
+                restarted = mk_exchange()
+                iterate_orders.assert_called_once()
+            self.assertEqual(ids, list(restarted._orders))
+
+        ex = mk_exchange()
+        ex.place_order(Order(User(1), OrderType.SELL, 98.0, 1000.0, 100.0))
+        ex.write_snapshot()
+        with open(snapshot_path, "rb") as f:
+            old_snapshot = f.read()
+        ex.place_order(Order(User(2), OrderType.SELL, 99.0, 1000.0, 100.0))
+        ex.place_order(Order(User(3), OrderType.SELL, 100.0, 1000.0, 100.0))
+        ex.write_snapshot()
+
+        # the changes since the old snapshot are pruned from the log
+        snapshot.write_bytes(snapshot_path, old_snapshot)
+        assert_loaded_from_db([1, 2, 3])
+
+        # a change bypassing the log
+        ex.write_snapshot()
+        with db.engine.begin() as conn:
+            conn.execute(text("DELETE FROM orders WHERE id = 3"))
+        assert_loaded_from_db([1, 2])
+
+
+@unittest.skipIf(importlib.util.find_spec("numpy") is None, "numpy is not installed")
+class ColumnarBookTests(unittest.TestCase):
+    def testSameResultsAsPythonBook(self):
+        rnd = random.Random(7)
+        now = time.time()
+        clients = [CurrencyMockClient(), CurrencyMockClient()]
+        matches: list[list] = [[], []]
+        exchanges = [
+            Exchange(
+                SqlDb(),
+                CurrencyConverter(client),
+                m.append,
+                columnar_book=columnar,
+            )
+            for client, m, columnar in zip(clients, matches, (False, True))
+        ]
+        self.assertEqual("ColumnarOrderBook", type(exchanges[1]._orders).__name__)
+
+        for i in range(400):
+            action = rnd.random()
+            if action < 0.05:
+                rates = {"RUB": 0.1, "AMD": round(rnd.uniform(0.44, 0.47), 4)}
+                for client in clients:
+                    client.set_rates(rates)
+            elif action < 0.15 and exchanges[0]._orders:
+                _id = rnd.choice(list(exchanges[0]._orders))
+                for ex in exchanges:
+                    ex.remove_order(_id)
+            else:
+                relative = rnd.random() < 0.3
+                amount = Decimal(rnd.randrange(100, 5000))
+                o = dict(
+                    user=User(rnd.randrange(20), "user"),
+                    type=rnd.choice([OrderType.SELL, OrderType.BUY]),
+                    price=Decimal(rnd.randrange(440, 470)) / 100,
+                    amount_initial=amount,
+                    min_op_threshold=Decimal(rnd.randrange(0, 500)),
+                    lifetime_sec=rnd.choice([60, 600, 3600]),
+                    creation_time=now + i,
+                    relative_rate=(
+                        Decimal(rnd.randrange(9800, 10200)) / 10000
+                        if relative
+                        else Decimal(-1)
+                    ),
+                )
+                for ex in exchanges:
+                    ex.place_order(Order(**o))
+            if i % 50 == 49:
+                with patch("time.time", return_value=now + i + 120):
+                    for ex in exchanges:
+                        ex._check_order_lifetime()
+
+            python_book, columnar_book = (ex._orders for ex in exchanges)
+            self.assertEqual(matches[0], matches[1])
+            self.assertEqual(dict(python_book), dict(columnar_book))
+            for side in ("sellers", "buyers"):
+                self.assertEqual(
+                    list(getattr(python_book, side)),
+                    list(getattr(columnar_book, side)),
+                )
+        self.assertGreater(len(matches[0]), 10)
+        self.assertEqual(exchanges[0].get_stats(), exchanges[1].get_stats())
+
+    def testPlacementDoesntSortTheSide(self):
+        from ..columnar_book import ColumnarOrderBook, _ColumnarSide
+
+        book = ColumnarOrderBook(capacity=4)
+        rnd = random.Random(3)
+        for i in range(1, 40):
+            book.add(
+                Order(
+                    User(i % 5),
+                    rnd.choice([OrderType.SELL, OrderType.BUY]),
+                    Decimal(rnd.randrange(440, 450)) / 100,
+                    Decimal(100),
+                    creation_time=1000 - i % 3,
+                    _id=i,
+                )
+            )
+            if i == 10:
+                list(book.sellers), list(book.buyers)  # the views are built
+                rebuild = patch.object(
+                    _ColumnarSide, "_rebuild", side_effect=AssertionError
+                )
+                rebuild.start()
+                self.addCleanup(rebuild.stop)
+            if i % 7 == 0:
+                book.remove(i - 3)
+                book.reprice(book[i - 1], book[i - 1].price_cents + 1)
+
+        for side, reverse in ((book.sellers, False), (book.buyers, True)):
+            orders = [o for o in book.values() if o.type == side._type]
+            orders.sort(key=lambda o: o._id)
+            orders.sort(key=lambda o: o.creation_time)
+            orders.sort(key=lambda o: o.price_cents, reverse=reverse)
+            self.assertEqual(orders, list(side))
+            self.assertIs(orders[0], side.best())
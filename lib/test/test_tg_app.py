@@ -5,6 +5,8 @@ from ..application import Application
 from ..botlib.tg import TelegramMock
 from ..currency_rates import CurrencyMockClient
 from ..db_sqla import SqlDb
+from ..outbound import OutboundDispatcher
+from ..pipeline import KeyedPipeline
 from .base import ExchgTestBase
 
 
@@ -36,6 +38,70 @@ class TestTgApp(ExchgTestBase):
         m = self.tg.outgoing[-1]
         self.assertEqual("create_order", m.inline_keyboard[0][0].callback_data)
 
+    def test_pipeline(self):
+        pipeline = KeyedPipeline(max_workers=2)
+        self.addCleanup(pipeline.close)
+        tg = TelegramMock()
+        app = Application(
+            self.db,
+            tg,
+            currency_client=CurrencyMockClient(),
+            rep_sys=self.rep_sys,
+            mailer=self.mailer,
+            pipeline=pipeline,
+        )
+        self.addCleanup(app.close)
+        tg.emulate_incoming_message(1, "Joe", "/help")
+        tg.emulate_incoming_message(1, "Joe", "", keyboard_callback="back")
+        pipeline.drain()
+        self.assertIn("Operating Currency Pair", tg.outgoing[0].text)
+        m = tg.outgoing[-1]
+        self.assertEqual("create_order", m.inline_keyboard[0][0].callback_data)
+
+    def test_session_kept_over_restart(self):
+        self.tg.emulate_incoming_message(1, "Joe", "/help")
+        self.app.close()
+        app = Application(
+            self.db,
+            TelegramMock(),
+            currency_client=CurrencyMockClient(),
+            rep_sys=self.rep_sys,
+            mailer=self.mailer,
+        )
+        self.addCleanup(app.close)
+        root = app._sessions.get(1)
+        self.assertEqual("Help", type(root.get_current_active()).__name__)
+        self.assertIs(app, root.session.app)
+
+    def test_match_through_dispatcher(self):
+        tg = TelegramMock()
+        dispatcher = OutboundDispatcher(tg.send_message)
+        self.addCleanup(dispatcher.close)
+        app = Application(
+            self.db,
+            tg,
+            currency_client=CurrencyMockClient(),
+            rep_sys=self.rep_sys,
+            mailer=self.mailer,
+            admin_contacts=self.admin_contacts,
+            dispatcher=dispatcher,
+        )
+        self.addCleanup(app.close)
+        tg.emulate_incoming_message(
+            1, "Joe", "/add SELL 1500 RUB * 98.1 AMD min_amt 100 lifetime_h 1"
+        )
+        tg.emulate_incoming_message(
+            2, "Dow", "/add BUY 1500 RUB * 98.1 AMD min_amt 100 lifetime_h 1"
+        )
+        dispatcher.flush()
+        texts: dict[int, str] = {}
+        for m in tg.outgoing:  # some may be coalesced
+            texts[m.user_id] = texts.get(m.user_id, "") + m.text
+        self.assertEqual({1, 2, *self.admin_contacts}, set(texts))
+        self.assertIn("We got your order", texts[2])
+        self.assertIn("Вы можете приобрести 1500", texts[2])
+        self.assertIn("match!", texts[3])
+
     def test_statistic_button(self):
         self.tg.emulate_incoming_message(1, "Joe", "", keyboard_callback="statistics")
         self.assertEqual(2, len(self.tg.outgoing))
@@ -7,6 +7,9 @@ from dotenv import load_dotenv
 from lib.botlib.tg import TelegramReal
 from lib.currency_rates import CurrencyFreaksClient
 from lib.application import Application
+from lib.config import PIPELINE_WORKERS
+from lib.outbound import OutboundDispatcher
+from lib.pipeline import KeyedPipeline
 from lib.comms.mailer import Mailer, MailerReal, MailerMock
 from lib.db_sqla import SqlDb
 from lib.logger import setup_logging
@@ -52,7 +55,15 @@ if __name__ == "__main__":
     else:
         admin_contacts = list(map(int, admin_contacts_raw.strip().split(",")))
 
-    db = SqlDb(conn_str)
+    flush_interval = os.getenv("EXCH_DB_FLUSH_INTERVAL_SEC")
+    snapshot_path = os.getenv("EXCH_SNAPSHOT_PATH")
+    db = SqlDb(
+        conn_str,
+        write_behind_interval_sec=float(flush_interval) if flush_interval else None,
+        log_order_changes=snapshot_path is not None,
+    )
+    dispatcher = OutboundDispatcher(telegram.send_message)
+    pipeline = KeyedPipeline(max_workers=PIPELINE_WORKERS, name="tg-updates")
     app = Application(
         db=db,
         tg=telegram,
@@ -60,7 +71,17 @@ if __name__ == "__main__":
         admin_contacts=admin_contacts,
         rep_sys=ReputationSystem(db.engine),
         mailer=mailer,
+        snapshot_path=snapshot_path,
+        pipeline=pipeline,
+        dispatcher=dispatcher,
     )
 
     print("Wating for TG messages")
-    telegram.run_forever()
+    try:
+        telegram.run_forever()
+    finally:
+        pipeline.close()
+        app.close()
+        dispatcher.close()
+        mailer.close()
+        db.close()